@@ -10,6 +10,8 @@ Usage:
                             [--model_name=NAME]
                             [--model_version=VERSION]
                             [--use_gpu]
+                            [--backend=BACKEND]
+                            [--offline]
   run_action_recognition.py (-h | --help)
 
 Options:
@@ -19,6 +21,8 @@ Options:
   --model_name=NAME          Name of the model to be used.
   --model_version=VERSION    Version of the model to be used.
   --use_gpu                  Whether to run inference on the GPU or not.
+  --backend=BACKEND          Inference backend, either pytorch or onnxruntime [default: pytorch]
+  --offline                  Process the video file in path_in as fast as possible, without dropping predictions
 """
 from typing import Callable
 from typing import Optional
@@ -118,4 +122,6 @@ if __name__ == "__main__":
         model_name=args['--model_name'] or None,
         model_version=args['--model_version'] or None,
         use_gpu=args['--use_gpu'],
+        backend=args['--backend'],
+        offline=args['--offline'],
     )
@@ -11,6 +11,8 @@ Usage:
                             [--model_name=NAME]
                             [--model_version=VERSION]
                             [--use_gpu]
+                            [--backend=BACKEND]
+                            [--offline]
   run_calorie_estimation.py (-h | --help)
 
 Options:
@@ -28,6 +30,8 @@ Options:
   --model_name=NAME               Name of the model to be used.
   --model_version=VERSION         Version of the model to be used.
   --use_gpu                       Whether to run inference on the GPU or not.
+  --backend=BACKEND               Inference backend, either pytorch or onnxruntime [default: pytorch]
+  --offline                       Process the video file in path_in as fast as possible, without dropping predictions
 """
 from typing import Callable
 from typing import Optional
@@ -138,5 +142,7 @@ if __name__ == "__main__":
         gender=args['--gender'] or None,
         title=args['--title'] or None,
         camera_id=int(args['--camera_id'] or 0),
-        use_gpu=args['--use_gpu']
+        use_gpu=args['--use_gpu'],
+        backend=args['--backend'],
+        offline=args['--offline'],
     )
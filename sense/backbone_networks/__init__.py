@@ -1,2 +1,5 @@
 from .mobilenet import StridedInflatedMobileNetV2
 from .efficientnet import StridedInflatedEfficientNet
+from .optimization import optimize_for_inference
+from .quantization import build_quantized_backbone
+from .quantization import quantize_backbone
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -5,8 +6,34 @@ from torch.nn.modules.utils import _triple
 from sense.downstream_tasks.nn_utils import RealtimeNeuralNet
 
 
+def _memory_format(x):
+    """
+    Return the memory format of a tensor of frames, which is channels_last only if the tensor is
+    actually laid out that way.
+    """
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def _new_frames_buffer(x, shape):
+    """
+    Allocate an uninitialized tensor of the given shape, with the dtype, device and memory format of x.
+    """
+    return torch.empty(shape, dtype=x.dtype, device=x.device, memory_format=_memory_format(x))
+
+
+def _is_reusable_buffer(buffer, shape, x):
+    return (buffer is not None and buffer.shape == shape and buffer.dtype == x.dtype
+            and buffer.device == x.device and _memory_format(buffer) == _memory_format(x))
+
+
 class SteppableConv3dAs2d(nn.Conv2d):
 
+    # Number of sequences whose frames are stacked along the first dimension of the input, see
+    # `rearrange_sequences`
+    batch_size = 1
+
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, **kwargs):
         kernel_size = _triple(kernel_size)
         stride = _triple(stride)
@@ -17,6 +44,8 @@ class SteppableConv3dAs2d(nn.Conv2d):
         self.dilation_temporal = dilation[0]
         self.internal_state = None
         self.internal_padding = True
+        self.reuse_state_buffer = True
+        self._state_buffer = None
 
         in_channels *= self.kernel_size_temporal
 
@@ -32,30 +61,106 @@ class SteppableConv3dAs2d(nn.Conv2d):
         return effective_kernel_size - self.stride_temporal
 
     def forward(self, x):
+        return super().forward(self.step_frames(x))
+
+    def step_frames(self, x):
+        """
+        Pad the input frames with the internal state (if internal padding is used) and rearrange them
+        into the input of the 2D convolution.
+        """
+        if self.batch_size > 1:
+            if self.internal_padding:
+                raise ValueError('A batch of sequences can only be processed without internal padding.')
+            return self.rearrange_sequences(x.reshape(self.batch_size, -1, *x.shape[1:]))
         if self.internal_padding:
             if self.internal_state is None:
                 self.initialize_internal_state(x)
             x = self.pad_internal_state(x)
-        x = self.rearrange_frames(x)
-        return super().forward(x)
+        return self.rearrange_frames(x)
 
     def initialize_internal_state(self, x):
-        self.internal_state = torch.cat(self.temporal_footprint * [torch.zeros_like(x[0:1])])
+        self.internal_state = x.new_zeros((self.temporal_footprint, *x.shape[1:]))
 
     def pad_internal_state(self, x):
-        x = torch.cat([self.internal_state, x])
-        self.internal_state = x[-self.temporal_footprint:]
-        return x
+        """
+        Prepend the internal state to the input frames and keep the last frames as the new internal state.
+
+        During inference, the padded frames are written into a buffer that is allocated once and reused
+        for every step with the same input shape, dtype and memory format. The internal state is then a
+        view on the end of that buffer, which gets moved to its front on the next step.
+        """
+        if not self.reuse_state_buffer or torch.is_grad_enabled():
+            # Writing into the buffer in place would invalidate tensors saved for the backward pass
+            x = torch.cat([self.internal_state, x])
+            self.internal_state = x[-self.temporal_footprint:]
+            return x
+
+        footprint = self.temporal_footprint
+        buffer = self._state_buffer
+        buffer_shape = (footprint + x.shape[0], *x.shape[1:])
+        if not _is_reusable_buffer(buffer, buffer_shape, x):
+            buffer = _new_frames_buffer(x, buffer_shape)
+            self._state_buffer = buffer
+
+        state = self.internal_state
+        if x.shape[0] < footprint:
+            # Source and destination overlap within the buffer
+            state = state.clone()
+        buffer[:footprint].copy_(state)
+        buffer[footprint:].copy_(x)
+        self.internal_state = buffer[-footprint:]
+        return buffer
 
     def rearrange_frames(self, x):
-        num_frames = x.shape[0]
-        x = torch.cat([x[offset: num_frames - self.kernel_size_temporal + offset + 1]
-                       for offset in range(self.kernel_size_temporal)], dim=1)
-        x = x[torch.arange(0, x.shape[0], self.stride_temporal)]
-        return x
+        """
+        Stack each window of `kernel_size_temporal` consecutive frames along the channel dimension,
+        keeping one window every `stride_temporal` frames.
+
+        The windows are returned as a strided view on the input frames, so that no copy is made here
+        as long as the input is contiguous. Channels-last inputs are rearranged with a single copy into
+        a channels-last output.
+        """
+        num_frames, num_channels, height, width = x.shape
+        if num_frames < self.kernel_size_temporal:
+            return _new_frames_buffer(x, (0, self.kernel_size_temporal * num_channels, height, width))
+        if _memory_format(x) == torch.channels_last:
+            x = x.permute(0, 2, 3, 1).unfold(0, self.kernel_size_temporal, self.stride_temporal)
+            x = x.permute(0, 1, 2, 4, 3)
+            x = x.reshape(x.shape[0], height, width, self.kernel_size_temporal * num_channels)
+            return x.permute(0, 3, 1, 2)
+        x = x.unfold(0, self.kernel_size_temporal, self.stride_temporal)
+        x = x.permute(0, 4, 1, 2, 3)
+        return x.reshape(x.shape[0], self.kernel_size_temporal * num_channels, height, width)
+
+    def rearrange_sequences(self, x):
+        """
+        Rearrange the frames of a batch of sequences of shape (batch_size, num_frames, channels, height,
+        width) as in `rearrange_frames`, separately for each sequence. The windows of all sequences are
+        returned one sequence after the other along the first dimension, so that they go through the 2D
+        convolution in a single pass.
+        """
+        batch_size, num_frames, num_channels, height, width = x.shape
+        if num_frames < self.kernel_size_temporal:
+            return x.new_empty((0, self.kernel_size_temporal * num_channels, height, width))
+        x = x.unfold(1, self.kernel_size_temporal, self.stride_temporal)
+        x = x.permute(0, 1, 5, 2, 3, 4)
+        return x.reshape(-1, self.kernel_size_temporal * num_channels, height, width)
+
+    def as_conv2d(self):
+        """
+        Return a plain Conv2d sharing the weights of this layer, which computes its 2D convolution on
+        rearranged frames.
+        """
+        conv2d = nn.Conv2d(self.in_channels, self.out_channels, self.kernel_size, stride=self.stride,
+                           padding=self.padding, dilation=self.dilation, groups=self.groups,
+                           bias=self.bias is not None)
+        conv2d.weight = self.weight
+        conv2d.bias = self.bias
+        return conv2d
 
     def reset(self):
         self.internal_state = None
+        self._state_buffer = None
         return self
 
     def train(self, mode=True):
@@ -65,24 +170,92 @@ class SteppableConv3dAs2d(nn.Conv2d):
 
 class SteppableSparseConv3dAs2d(SteppableConv3dAs2d):
 
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, **kwargs):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, kernel_size_temporal=3,
+                 shift_ratios=(0.25, 0.25, 0.5), **kwargs):
+        """
+        :param kernel_size_temporal:
+            Number of consecutive frames that are mixed together.
+        :param shift_ratios:
+            Fraction of the input channels taken from each of these frames, from the oldest to the
+            most recent one.
+        """
         kernel_size = _triple(kernel_size)
         super().__init__(in_channels, out_channels, (1, *kernel_size[1:]),
                          stride=stride, dilation=dilation, **kwargs)
-        self.kernel_size_temporal = 3
+        if len(shift_ratios) != kernel_size_temporal or abs(sum(shift_ratios) - 1.) > 1e-6:
+            raise ValueError(f'Expected {kernel_size_temporal} shift ratios summing up to 1, '
+                             f'got {shift_ratios}')
+        self.kernel_size_temporal = kernel_size_temporal
+        self.shift_ratios = tuple(shift_ratios)
+        self._shift_buffer = None
+
+    def channel_boundaries(self, num_channels):
+        """
+        Returns the first channel taken from each frame of the temporal window, followed by the number
+        of channels.
+        """
+        boundaries = [0]
+        cumulated_ratio = 0.
+        for ratio in self.shift_ratios[:-1]:
+            cumulated_ratio += ratio
+            boundaries.append(int(num_channels * cumulated_ratio))
+        return boundaries + [num_channels]
 
     def rearrange_frames(self, x):
-        # Note: rewrite this to support other kernel sizes (i.e. != 3) and different mixing ratios
-        quarter = int(x.shape[1] // 4)
-        half = int(x.shape[1] // 2)
-        out = torch.zeros_like(x[2:])
-        out[:, 0:quarter] = x[0:-2, 0:quarter]
-        out[:, quarter:half] = x[1:-1, quarter:half]
-        out[:, half:] = x[2:, half:]
-        indices = [-1 - offset for offset in range(0, out.shape[0], self.stride_temporal)]
-        out = out[indices[::-1]]
+        """
+        Mix each window of `kernel_size_temporal` consecutive frames by taking a different group of
+        channels from each frame, keeping one window every `stride_temporal` frames so that the last
+        window ends on the most recent frame.
+
+        Each channel group is copied with a single strided slice. At inference time, the result is
+        written into an output buffer that is reused across steps.
+        """
+        num_frames, num_channels, height, width = x.shape
+        num_windows = max(0, (num_frames - self.kernel_size_temporal) // self.stride_temporal + 1)
+        output_shape = (num_windows, num_channels, height, width)
+
+        if torch.is_grad_enabled():
+            out = _new_frames_buffer(x, output_shape)
+        else:
+            out = self._shift_buffer
+            if not _is_reusable_buffer(out, output_shape, x):
+                out = _new_frames_buffer(x, output_shape)
+                self._shift_buffer = out
+
+        if num_windows == 0:
+            return out
+
+        first_frame = (num_frames - self.kernel_size_temporal) % self.stride_temporal
+        last_frame = first_frame + (num_windows - 1) * self.stride_temporal + 1
+        boundaries = self.channel_boundaries(num_channels)
+        for offset, (channel_start, channel_end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+            out[:, channel_start:channel_end] = x[first_frame + offset:last_frame + offset:self.stride_temporal,
+                                                  channel_start:channel_end]
         return out
 
+    def rearrange_sequences(self, x):
+        """
+        Rearrange the frames of a batch of sequences of shape (batch_size, num_frames, channels, height,
+        width) as in `rearrange_frames`, separately for each sequence, with the windows of all sequences
+        returned one sequence after the other along the first dimension.
+        """
+        batch_size, num_frames, num_channels, height, width = x.shape
+        num_windows = max(0, (num_frames - self.kernel_size_temporal) // self.stride_temporal + 1)
+        out = x.new_empty((batch_size, num_windows, num_channels, height, width))
+
+        if num_windows > 0:
+            first_frame = (num_frames - self.kernel_size_temporal) % self.stride_temporal
+            last_frame = first_frame + (num_windows - 1) * self.stride_temporal + 1
+            boundaries = self.channel_boundaries(num_channels)
+            for offset, (channel_start, channel_end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+                out[:, :, channel_start:channel_end] = x[:, first_frame + offset:last_frame + offset:
+                                                         self.stride_temporal, channel_start:channel_end]
+        return out.reshape(-1, num_channels, height, width)
+
+    def reset(self):
+        self._shift_buffer = None
+        return super().reset()
+
 
 class ConvReLU(nn.Sequential):
 
@@ -97,6 +270,10 @@ class ConvReLU(nn.Sequential):
 
 class InvertedResidual(nn.Module):  # noqa: D101
 
+    # Number of sequences whose frames are stacked along the first dimension of the input, see
+    # `SteppableConv3dAs2d.rearrange_sequences`
+    batch_size = 1
+
     def __init__(self, in_planes, out_planes, spatial_kernel_size=3, spatial_stride=1, expand_ratio=1,
                  temporal_shift=False, temporal_stride=False, sparse_temporal_conv=False):
         super().__init__()
@@ -140,6 +317,15 @@ class InvertedResidual(nn.Module):  # noqa: D101
         return output_
 
     def realign(self, input_, output_):  # noqa: D102
+        if self.batch_size > 1:
+            # Realign each sequence separately
+            input_ = input_.reshape(self.batch_size, -1, *input_.shape[1:])
+            n_out = output_.shape[0] // self.batch_size
+            if self.temporal_stride:
+                indices = [-1 - 2 * idx for idx in range(n_out)]
+                return input_[:, indices[::-1]].reshape(-1, *input_.shape[2:])
+            return input_[:, -n_out:].reshape(-1, *input_.shape[2:])
+
         n_out = output_.shape[0]
         if self.temporal_stride:
             indices = [-1 - 2 * idx for idx in range(n_out)]
@@ -154,6 +340,8 @@ class StridedInflatedMobileNetV2(RealtimeNeuralNet):
     fps = 16
     step_size = 4
     feature_dim = 1280
+    input_scaling_folded = False
+    channels_last_frames = False
 
     def __init__(self):
         super().__init__()
@@ -191,11 +379,25 @@ class StridedInflatedMobileNetV2(RealtimeNeuralNet):
     def forward(self, video):
         return self.cnn(video)
 
-    def preprocess(self, clip):
-        clip /= 255.
-        clip = clip.transpose(0, 1, 4, 2, 3)
-        clip = torch.Tensor(clip).float()
-        return clip[0]
+    def preprocess(self, clip: np.ndarray) -> torch.Tensor:
+        """
+        Convert a clip of shape (1, T, H, W, 3) with values in [0, 255], e.g. uint8 frames from a video
+        source, into float frames of shape (T, 3, H, W) scaled to [0, 1]. The clip is wrapped without
+        copy and converted in a single pass, the given array is left unchanged.
+
+        The frames are contiguous, unless `channels_last_frames` is set, e.g. by an InferenceEngine with
+        use_channels_last=True. They then keep the channels-last memory layout of the clip, which saves
+        the rearrangement of the pixels.
+
+        If the scaling was folded into the first convolution by `optimize_for_inference`, the frames
+        keep their values in [0, 255].
+        """
+        frames = torch.from_numpy(np.ascontiguousarray(clip[0])).permute(0, 3, 1, 2)
+        memory_format = torch.channels_last if self.channels_last_frames else torch.contiguous_format
+        frames = frames.to(torch.float32, copy=True, memory_format=memory_format)
+        if not self.input_scaling_folded:
+            frames.div_(255.)
+        return frames
 
     @property
     def num_required_frames_per_layer(self):
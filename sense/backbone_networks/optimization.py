@@ -0,0 +1,117 @@
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .mobilenet import ConvReLU
+from .mobilenet import InvertedResidual
+from .mobilenet import StridedInflatedMobileNetV2
+
+
+class InferenceOnlyMixin:
+    """
+    Mixin for modules produced by `optimize_for_inference`, which can only be used in eval mode.
+    """
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError(f'{type(self).__name__} was optimized for inference and cannot be trained. '
+                               f'Build the backbone network without optimization to train it.')
+        return super().train(False)
+
+
+class ScaledInputConvReLU(InferenceOnlyMixin, nn.Sequential):
+    """
+    Eval-only version of the first ConvReLU of a backbone network, taking frames with values in [0, 255]
+    instead of [0, 1]. The scaling of the frames is applied to the few weights of the convolution kernel
+    rather than to every input pixel.
+
+    The convolution and activation are kept as children, so that parameter names are the same as in ConvReLU.
+
+    The scaled weights are computed once and cached. The original weights are kept as parameters, so that
+    state dicts of the original network can still be loaded, which invalidates the cache, as does moving
+    the module to another device or dtype.
+    """
+
+    def __init__(self, conv_relu: ConvReLU, input_scale: float):
+        super().__init__(*conv_relu)
+        self.input_scale = input_scale
+        self.scaled_weight = None  # computed on the first call of `forward`
+        self._register_load_state_dict_pre_hook(self._invalidate_scaled_weight)
+
+    def _invalidate_scaled_weight(self, *args):
+        self.scaled_weight = None
+
+    def _apply(self, fn):
+        self._invalidate_scaled_weight()
+        return super()._apply(fn)
+
+    def forward(self, x):
+        conv = self[0]
+        if self.scaled_weight is None:
+            self.scaled_weight = conv.weight.detach() * self.input_scale
+        return self[1](F.conv2d(x, self.scaled_weight, conv.bias, conv.stride, conv.padding, conv.dilation,
+                                conv.groups))
+
+
+class OptimizedInvertedResidual(InferenceOnlyMixin, InvertedResidual):
+    """
+    Eval-only version of InvertedResidual, sharing the layers of the original block.
+
+    The residual is only realigned if it is actually used, and realignment for temporal strides is a
+    strided view on the input rather than an index-based gather.
+    """
+
+    def __init__(self, inverted_residual: InvertedResidual):
+        nn.Module.__init__(self)
+        self.use_residual = inverted_residual.use_residual
+        self.temporal_shift = inverted_residual.temporal_shift
+        self.temporal_stride = inverted_residual.temporal_stride
+        self.conv = nn.Sequential(*[_optimize_module(layer) for layer in inverted_residual.conv])
+
+    def forward(self, input_):
+        output_ = self.conv(input_)
+        if self.use_residual:
+            output_ += self.realign(input_, output_)
+        return output_
+
+    def realign(self, input_, output_):
+        n_in = input_.shape[0]
+        n_out = output_.shape[0]
+        if self.temporal_stride:
+            return input_[n_in - 2 * n_out + 1::2]
+        return input_[n_in - n_out:]
+
+
+def _optimize_module(module):
+    if isinstance(module, InvertedResidual):
+        return OptimizedInvertedResidual(module)
+    return module
+
+
+def optimize_for_inference(backbone_network: StridedInflatedMobileNetV2,
+                           fold_input_scaling: bool = False) -> StridedInflatedMobileNetV2:
+    """
+    Convert a backbone network into an eval-only form that runs faster on CPU. Residual realignments are
+    simplified and the parameters are frozen. Convolutions and their ReLU6 activations are left as they
+    are, eager PyTorch has no fused kernel for them.
+    The internal states of steppable layers, and therefore the streaming behavior, are unchanged.
+
+    The optimized network can still load state dicts of the original network, but it cannot be put back
+    into training mode.
+
+    :param backbone_network:
+        A StridedInflatedEfficientNet or StridedInflatedMobileNetV2 instance with loaded weights.
+    :param fold_input_scaling:
+        If True, the scaling of the frames to [0, 1] is folded into the first convolution. The network
+        then takes frames with values in [0, 255], as returned by its `preprocess` method, which no
+        longer scales them.
+    :return:
+        The same network instance, modified in place.
+    """
+    backbone_network.eval()
+    backbone_network.requires_grad_(False)
+    layers = [_optimize_module(layer) for layer in backbone_network.cnn]
+    if fold_input_scaling:
+        layers[0] = ScaledInputConvReLU(backbone_network.cnn[0], input_scale=1 / 255.)
+        backbone_network.input_scaling_folded = True
+    backbone_network.cnn = nn.Sequential(*layers)
+    return backbone_network
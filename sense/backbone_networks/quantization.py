@@ -0,0 +1,161 @@
+import warnings
+
+from typing import Iterable
+
+import torch
+import torch.nn as nn
+import torch.nn.quantized
+import torch.quantization
+
+from .mobilenet import ConvReLU
+from .mobilenet import InvertedResidual
+from .mobilenet import SteppableConv3dAs2d
+from .mobilenet import StridedInflatedMobileNetV2
+from .optimization import OptimizedInvertedResidual
+from .optimization import InferenceOnlyMixin
+
+DEFAULT_QUANTIZATION_BACKEND = 'fbgemm'
+
+
+def _as_conv2d(conv):
+    """
+    Return a plain Conv2d computing the same 2D convolution as the given (possibly steppable) convolution.
+    The weights of a steppable convolution are moved to the new layer, so that only its temporal
+    handling remains.
+    """
+    if type(conv) is nn.Conv2d:
+        return conv
+
+    conv2d = conv.as_conv2d()
+    conv.register_parameter('weight', None)
+    conv.register_parameter('bias', None)
+    return conv2d
+
+
+class QuantizableInvertedResidual(InferenceOnlyMixin, InvertedResidual):
+    """
+    InvertedResidual block running on quantized tensors.
+
+    If the block starts with a steppable convolution, the frames are dequantized for the temporal step
+    so that its internal state is kept in full precision, exactly as in the original block. The
+    convolution itself then runs on the quantized frames.
+    """
+
+    def __init__(self, inverted_residual: InvertedResidual):
+        nn.Module.__init__(self)
+        self.use_residual = inverted_residual.use_residual
+        self.temporal_shift = inverted_residual.temporal_shift
+        self.temporal_stride = inverted_residual.temporal_stride
+
+        self.steppable = None
+        layers = []
+        for layer in inverted_residual.conv:
+            sublayers = list(layer) if isinstance(layer, ConvReLU) else [layer]
+            if isinstance(sublayers[0], SteppableConv3dAs2d):
+                self.steppable = sublayers[0]
+            layers.extend([_as_conv2d(sublayers[0]), *sublayers[1:]])
+        self.conv = nn.Sequential(*layers)
+
+        if self.steppable is not None:
+            self.steppable.qconfig = None
+            self.dequant = torch.quantization.DeQuantStub()
+            self.quant = torch.quantization.QuantStub()
+        if self.use_residual:
+            self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, input_):
+        frames = input_
+        if self.steppable is not None:
+            frames = self.quant(self.steppable.step_frames(self.dequant(frames)))
+        output_ = self.conv(frames)
+        if self.use_residual:
+            output_ = self.skip_add.add(output_, self.realign(input_, output_))
+        return output_
+
+    realign = OptimizedInvertedResidual.realign
+
+
+def reset_internal_states(network: nn.Module):
+    """
+    Reset the internal states of all steppable convolutions in the given network.
+    """
+    for module in network.modules():
+        if isinstance(module, SteppableConv3dAs2d):
+            module.reset()
+
+
+def prepare_quantization(backbone_network: StridedInflatedMobileNetV2,
+                         backend: str = DEFAULT_QUANTIZATION_BACKEND) -> StridedInflatedMobileNetV2:
+    """
+    Restructure a backbone network in place so that it runs on quantized tensors, and insert observers
+    recording the range of the activations. After calibration, the network is quantized with
+    `convert_quantization`.
+
+    :param backbone_network:
+        A StridedInflatedEfficientNet or StridedInflatedMobileNetV2 instance with loaded weights.
+    :param backend:
+        Quantized engine used for CPU inference (fbgemm for x86, qnnpack for ARM).
+    """
+    torch.backends.quantized.engine = backend
+    backbone_network.eval()
+    backbone_network.requires_grad_(False)
+
+    layers = [QuantizableInvertedResidual(layer) if isinstance(layer, InvertedResidual) else layer
+              for layer in backbone_network.cnn]
+    # Frames are quantized by the first layer and features are dequantized by the last one
+    layers[0] = nn.Sequential(torch.quantization.QuantStub(), *layers[0])
+    layers[-1] = nn.Sequential(*layers[-1], torch.quantization.DeQuantStub())
+    backbone_network.cnn = nn.Sequential(*layers)
+
+    backbone_network.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(backbone_network, inplace=True)
+    return backbone_network
+
+
+def convert_quantization(backbone_network: StridedInflatedMobileNetV2) -> StridedInflatedMobileNetV2:
+    """
+    Replace the observed layers of a network returned by `prepare_quantization` by their int8 version.
+    """
+    torch.quantization.convert(backbone_network, inplace=True)
+    return backbone_network
+
+
+def quantize_backbone(backbone_network: StridedInflatedMobileNetV2, calibration_clips: Iterable[torch.Tensor],
+                      backend: str = DEFAULT_QUANTIZATION_BACKEND) -> StridedInflatedMobileNetV2:
+    """
+    Apply post-training static int8 quantization to a backbone network, modified in place.
+
+    Activation ranges are calibrated by streaming the given clips through the network, step by step as
+    during inference. Internal states of steppable layers are reset between clips and stay in full
+    precision in the quantized network.
+
+    :param backbone_network:
+        A StridedInflatedEfficientNet or StridedInflatedMobileNetV2 instance with loaded weights.
+    :param calibration_clips:
+        Preprocessed clips of shape (T, 3, H, W), as returned by the `preprocess` method of the network.
+    :param backend:
+        Quantized engine used for CPU inference (fbgemm for x86, qnnpack for ARM).
+    """
+    prepare_quantization(backbone_network, backend)
+
+    with torch.no_grad():
+        for clip in calibration_clips:
+            reset_internal_states(backbone_network)
+            for step in torch.Tensor.split(clip, backbone_network.step_size):
+                backbone_network(step)
+    reset_internal_states(backbone_network)
+
+    return convert_quantization(backbone_network)
+
+
+def build_quantized_backbone(backbone_network: StridedInflatedMobileNetV2,
+                             backend: str = DEFAULT_QUANTIZATION_BACKEND) -> StridedInflatedMobileNetV2:
+    """
+    Turn a freshly created backbone network into the structure of a quantized network, so that the
+    state dict of a network returned by `quantize_backbone` can be loaded into it.
+    """
+    prepare_quantization(backbone_network, backend)
+    with warnings.catch_warnings():
+        # Observers are not calibrated, since all quantization parameters will be loaded
+        warnings.simplefilter('ignore')
+        return convert_quantization(backbone_network)
@@ -1,20 +1,29 @@
 import cv2
+import itertools
 import numpy as np
 import os
 import queue
 import time
 
 from threading import Thread
+from typing import List
 from typing import Optional
 from typing import Tuple
 
+from sense.metrics import MetricsRegistry
+from sense.queues import BoundedQueue
 
-def uniform_frame_sample(video, sample_rate):
+WRITER_POLICIES = ['block', 'drop']
+
+
+def uniform_frame_sample_indices(available_frames, sample_rate):
     """
-    Uniformly sample video frames according to the provided sample_rate.
+    Return the sorted indices of the frames selected by `uniform_frame_sample` in a video of the given
+    number of frames. Frames are repeated when upsampling.
     """
-    available_frames = video.shape[0]
     required_frames = np.round(sample_rate * available_frames).astype(np.int32)
+    if required_frames == 0:
+        return np.zeros(0, dtype=np.int32)
 
     # Get evenly spaced indices. When upsampling, include both endpoints.
     new_indices = np.linspace(0, available_frames - 1, num=required_frames, endpoint=sample_rate >= 1.)
@@ -24,8 +33,68 @@ def uniform_frame_sample(video, sample_rate):
     new_indices += offset
 
     # Round to closest integers
-    new_indices = new_indices.round().astype(np.int32)
-    return video[new_indices]
+    return new_indices.round().astype(np.int32)
+
+
+def uniform_frame_sample(video, sample_rate):
+    """
+    Uniformly sample video frames according to the provided sample_rate.
+    """
+    return video[uniform_frame_sample_indices(video.shape[0], sample_rate)]
+
+
+def letterbox(img: np.ndarray, size: Tuple[int, int], dst: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Pad an image to a square with black borders and resize it to the given size, in a single pass that
+    writes straight into the output image, without any full-resolution intermediate image.
+
+    The result matches resizing the output of `VideoSource.pad_to_square` within one intensity level, and
+    is usually pixel-identical. If the borders fall on whole output pixels, as for common camera
+    resolutions, the image is resized into its region of the output. Otherwise, it is resampled with an
+    affine warp on the same sampling grid.
+
+    :param img:
+        Image of shape (height, width, channels).
+    :param size:
+        Width and height of the output image.
+    :param dst:
+        Optional C-contiguous array of shape (height, width, channels) to write the output into.
+    :return:
+        The padded and resized image.
+    """
+    height, width = img.shape[:2]
+    square_size = max(height, width)
+    pad_top = int((square_size - height) / 2)
+    pad_left = int((square_size - width) / 2)
+    out_width, out_height = size
+    if dst is None:
+        dst = np.empty((out_height, out_width, *img.shape[2:]), dtype=img.dtype)
+
+    if all(length % square_size == 0 for length in [height * out_height, pad_top * out_height,
+                                                    width * out_width, pad_left * out_width]):
+        # Borders are aligned with output pixels, resize the image into its region of the output
+        top = pad_top * out_height // square_size
+        left = pad_left * out_width // square_size
+        bottom = top + height * out_height // square_size
+        right = left + width * out_width // square_size
+        dst[:top] = 0
+        dst[bottom:] = 0
+        dst[top:bottom, :left] = 0
+        dst[top:bottom, right:] = 0
+        if left == 0 and right == out_width:
+            # Full rows of the output are contiguous
+            cv2.resize(img, (right - left, bottom - top), dst=dst[top:bottom])
+        else:
+            dst[top:bottom, left:right] = cv2.resize(img, (right - left, bottom - top))
+        return dst
+
+    # Same sampling grid as cv2.resize on the padded image
+    scale_x = out_width / square_size
+    scale_y = out_height / square_size
+    transform = np.array([[scale_x, 0., (pad_left + 0.5) * scale_x - 0.5],
+                          [0., scale_y, (pad_top + 0.5) * scale_y - 0.5]])
+    cv2.warpAffine(img, transform, size, dst=dst, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    return dst
 
 
 class VideoSource:
@@ -38,7 +107,8 @@ class VideoSource:
                  size: Tuple[int, int] = None,
                  camera_id: int = 0,
                  preserve_aspect_ratio: bool = True,
-                 target_fps: Optional[int] = None):
+                 target_fps: Optional[int] = None,
+                 metrics: Optional[MetricsRegistry] = None):
         """
         :param filename:
             Path to a video file.
@@ -50,13 +120,16 @@ class VideoSource:
             Whether to preserve the aspect ratio of the video frames.
         :param target_fps:
             Framerate that the video should be sampled to. If None is given, framerate of the video is left unchanged.
-            Only relevant if the video is read from a file.
+            Only relevant if the video is read from a file, whose frames are then resampled while decoding it.
+        :param metrics:
+            Registry in which the time spent grabbing ('video_source.grab') and resizing
+            ('video_source.resize') each frame is recorded.
         """
         self.size = size
         self.preserve_aspect_ratio = preserve_aspect_ratio
+        self.metrics = metrics or MetricsRegistry(enabled=False)
 
-        self._frames = None
-        self._frame_idx = 0
+        self._resampled_frames = None
 
         if filename:
             if not os.path.exists(filename):
@@ -65,47 +138,73 @@ class VideoSource:
             self._cam = cv2.VideoCapture(filename)
 
             if target_fps is not None:
-                self._frames = self._read_and_resample_frames(target_fps)
+                self._resampled_frames = self._resample_frames(target_fps)
         else:
             self._cam = cv2.VideoCapture(camera_id)
             self._cam.set(3, 480)  # Set frame width to 480
             self._cam.set(4, 640)  # Set frame height to 640
 
-    def _read_and_resample_frames(self, target_fps):
+    def _resample_frames(self, target_fps):
+        """
+        Read the frames selected by `uniform_frame_sample` one by one, while decoding the video. Only the
+        last decoded frame is kept in memory, and frames that are skipped are only grabbed.
+
+        Frames are selected for the frame count reported by the container, which is only an estimate for
+        many of them, e.g. variable frame rate videos from phones. The tail of the selection is corrected
+        while decoding: frames past the end of a shorter video are not returned, and the frames of a longer
+        video keep being sampled at the same rate after the reported end. If the container reports no frame
+        count, frames are sampled at the same rate from the first frame until the end of the video, which
+        may shift the selection by a frame compared to `uniform_frame_sample`.
+        """
         video_fps = self._cam.get(cv2.CAP_PROP_FPS)
-
-        video = []
-        ret, frame = self._cam.read()
-        while ret:
-            video.append(frame)
-            ret, frame = self._cam.read()
-
-        return uniform_frame_sample(np.array(video), target_fps / video_fps)
+        sample_rate = target_fps / video_fps
+        num_frames = int(self._cam.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        if num_frames > 0:
+            frame_indices = uniform_frame_sample_indices(num_frames, sample_rate)
+            if len(frame_indices):
+                last_idx = frame_indices[-1]
+                tail_indices = (int(round(last_idx + step / sample_rate)) for step in itertools.count(1))
+                frame_indices = itertools.chain(frame_indices, (idx for idx in tail_indices if idx >= num_frames))
+        else:
+            frame_indices = (int(round(step / sample_rate)) for step in itertools.count())
+
+        frame_idx = -1
+        frame = None
+        for next_frame_idx in frame_indices:
+            while frame_idx < next_frame_idx - 1:
+                if not self._cam.grab():
+                    return
+                frame_idx += 1
+            if frame_idx < next_frame_idx:
+                ret, frame = self._cam.read()
+                if not ret:
+                    return
+                frame_idx += 1
+            yield frame
 
     def _get_frame(self):
-        if self._frames is not None:
-            if self._frame_idx < len(self._frames):
-                frame = self._frames[self._frame_idx]
-                self._frame_idx += 1
-                return frame
-        else:
-            ret, frame = self._cam.read()
-            if ret:
-                return frame
+        if self._resampled_frames is not None:
+            return next(self._resampled_frames, None)
 
-        return None
+        ret, frame = self._cam.read()
+        return frame if ret else None
 
     def get_image(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
         """
         Capture image from video stream frame-by-frame.
         The captured image and a scaled copy of the image are returned.
         """
-        img = self._get_frame()
+        with self.metrics.timer('video_source.grab'):
+            img = self._get_frame()
         if img is not None:
-            img_copy = img.copy()
-            if self.preserve_aspect_ratio:
-                img_copy = self.pad_to_square(img)
-            scaled_img = cv2.resize(img_copy, self.size) if self.size else img
+            with self.metrics.timer('video_source.resize'):
+                if not self.size:
+                    scaled_img = img
+                elif self.preserve_aspect_ratio:
+                    scaled_img = letterbox(img, self.size)
+                else:
+                    scaled_img = cv2.resize(img, self.size)
             return img, scaled_img
         else:
             # Could not grab another frame (file ended?)
@@ -126,7 +225,7 @@ class VideoStream(Thread):
     Thread that reads frames from the video source at a given frame rate.
     """
 
-    def __init__(self, video_source: VideoSource, fps: float, queue_size: int = 4):
+    def __init__(self, video_source: VideoSource, fps: float, queue_size: int = 4, policy: str = 'drop_oldest'):
         """
         :param video_source:
             An instance of VideoSource that represents a camera stream or video file.
@@ -134,10 +233,12 @@ class VideoStream(Thread):
             Frame rate of the inference engine.
         :param queue_size:
             Size of the FIFO queue that stores a tuple of image and scaled image.
+        :param policy:
+            What to do with new frames when the queue is full, one of `sense.queues.QUEUE_POLICIES`.
         """
         Thread.__init__(self)
         self.video_source = video_source
-        self.frames = queue.Queue(queue_size)
+        self.frames = BoundedQueue(queue_size, policy)
         self.fps = fps
         self.delta_t = 1.0 / self.fps
         self._shutdown = False
@@ -150,17 +251,34 @@ class VideoStream(Thread):
         """Get an image frame from the FIFO queue of frames."""
         return self.frames.get()
 
+    def stats(self) -> dict:
+        """
+        Return the number of skipped frames ('num_dropped_frames') and the current and maximal number of
+        frames in the queue ('queue_depth' and 'max_queue_depth').
+        """
+        stats = self.frames.stats()
+        return {'num_dropped_frames': stats['num_dropped'], 'queue_depth': stats['depth'],
+                'max_queue_depth': stats['max_depth']}
+
+    def _put_frame(self, image_tuple: Optional[Tuple[np.ndarray, np.ndarray]]):
+        policy = None
+        if image_tuple is None and self.frames.policy == 'drop_newest':
+            # The end of the stream is never dropped
+            policy = 'drop_oldest'
+
+        # Wait in steps, so that a blocked stream can still be stopped
+        while not self._shutdown:
+            try:
+                self.frames.put_with_policy(image_tuple, timeout=1, policy=policy)
+                return
+            except queue.Full:
+                pass
+
     def run(self):
         while not self._shutdown:
             time_start = time.perf_counter()
             image_tuple = self.video_source.get_image()
-
-            if self.frames.full():
-                # Remove one frame
-                self.frames.get_nowait()
-                print("*** Frame skipped ***")
-
-            self.frames.put(image_tuple, False)
+            self._put_frame(image_tuple)
 
             # Last frame was a None
             if image_tuple is None:
@@ -174,6 +292,79 @@ class VideoStream(Thread):
                 time.sleep(delay)
 
 
+class PrefetchingVideoSource(Thread):
+    """
+    Thread that decodes, pads and resizes the frames of a video source ahead of their consumption, into a
+    bounded queue. Unlike VideoStream, frames are read as fast as they are consumed and none is skipped,
+    which suits the offline processing of video files.
+
+    The time spent by the consumer waiting for decoded frames and by the decoder waiting for the consumer
+    to free space in the queue are accumulated in `decode_stall_time` and `compute_stall_time`. If reading
+    the video source fails, the error is stored in `error` and raised by `get_image` in the consumer's thread.
+    """
+
+    def __init__(self, video_source: VideoSource, queue_size: int = 64):
+        """
+        :param video_source:
+            An instance of VideoSource, usually reading from a video file.
+        :param queue_size:
+            Maximum number of decoded frames waiting to be consumed. If 0, the whole video is decoded ahead.
+        """
+        Thread.__init__(self, daemon=True)
+        self.video_source = video_source
+        self.frames = queue.Queue(queue_size)
+        self.decode_stall_time = 0.
+        self.compute_stall_time = 0.
+        self.error = None
+        self._finished = False
+        self._shutdown = False
+
+    def stop(self):
+        """Stop decoding frames ahead."""
+        self._shutdown = True
+
+    def get_image(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Get the next image and its scaled copy, as returned by `VideoSource.get_image`, waiting for it to be
+        decoded if needed. None is returned once the video source is exhausted, and the error of the video
+        source is raised if reading it failed.
+        """
+        if not self._finished:
+            time_start = time.perf_counter()
+            image_tuple = self.frames.get()
+            self.decode_stall_time += time.perf_counter() - time_start
+
+            self._finished = image_tuple is None
+            if not self._finished:
+                return image_tuple
+
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def _put_frame(self, image_tuple: Optional[Tuple[np.ndarray, np.ndarray]]):
+        time_start = time.perf_counter()
+        while not self._shutdown:
+            try:
+                self.frames.put(image_tuple, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.compute_stall_time += time.perf_counter() - time_start
+
+    def run(self):
+        try:
+            image_tuple = self.video_source.get_image()
+            while image_tuple is not None and not self._shutdown:
+                self._put_frame(image_tuple)
+                image_tuple = self.video_source.get_image()
+        except Exception as error:
+            self.error = error
+        finally:
+            # Always mark the end of the stream, so that the consumer never waits forever
+            self._put_frame(None)
+
+
 class VideoWriter:
     """
     VideoWriter writes a video file.
@@ -201,3 +392,112 @@ class VideoWriter:
 
     def release(self):  # noqa: D102
         self.writer.release()
+
+
+class AsyncVideoWriter(Thread):
+    """
+    Thread encoding frames into a video file, so that encoding does not slow down the loop producing the
+    frames. Frames are passed through a bounded queue. When it is full, the caller either waits for space
+    in the queue or the new frame is dropped, depending on the policy. If writing the video fails, e.g.
+    because the file cannot be opened, the error is stored in `error` and raised by `write`.
+    """
+
+    def __init__(self, path: str, fps: float, policy: str = 'block', queue_size: int = 32):
+        """
+        :param path:
+            Path to the video file to be written.
+        :param fps:
+            The number of frames per second.
+        :param policy:
+            What to do with new frames when the queue is full, one of `WRITER_POLICIES`: 'block' waits for
+            space in the queue so that no frame is lost, 'drop' drops the new frame.
+        :param queue_size:
+            Maximum number of frames waiting to be encoded.
+        """
+        Thread.__init__(self, daemon=True)
+        if policy not in WRITER_POLICIES:
+            raise ValueError(f'Unknown video writer policy: {policy}. Available policies: {WRITER_POLICIES}')
+        self.path = path
+        self.fps = fps
+        self.policy = policy
+        self.frames = queue.Queue(queue_size)
+        self.num_dropped_frames = 0
+        self.error = None  # set in `run` if writing the video fails
+        self._writer = None  # created with the size of the first frame
+
+    def write(self, frame: np.ndarray) -> bool:
+        """
+        Add a frame to be written to the video. The error of the writer thread is raised if it stopped,
+        instead of waiting for it forever.
+
+        :return:
+            False if the frame was dropped because the queue was full, True otherwise.
+        """
+        self._check_running()
+        if self.policy == 'block':
+            while True:
+                try:
+                    self.frames.put(frame, timeout=1)
+                    return True
+                except queue.Full:
+                    self._check_running()
+
+        try:
+            self.frames.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.num_dropped_frames += 1
+            return False
+
+    def _check_running(self):
+        if self.error is not None:
+            raise self.error
+        if self.ident is not None and not self.is_alive():
+            raise RuntimeError(f'The video writer of {self.path} stopped unexpectedly.')
+
+    def release(self):
+        """Write the remaining frames and close the video file."""
+        while self.is_alive():
+            try:
+                self.frames.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.join()
+
+    def run(self):
+        try:
+            self._write_frames()
+        except Exception as error:
+            self.error = error
+            raise
+        finally:
+            if self._writer is not None:
+                self._writer.release()
+
+    def _write_frames(self):
+        frame = self.frames.get()
+        while frame is not None:
+            if self._writer is None:
+                self._writer = cv2.VideoWriter(self.path, 0x7634706d, self.fps, (frame.shape[1], frame.shape[0]))
+                if not self._writer.isOpened():
+                    raise RuntimeError(f'Could not open {self.path} for writing.')
+            self._writer.write(frame)
+            frame = self.frames.get()
+
+
+def write_synchronized(video_writers: List[AsyncVideoWriter], frames: List[np.ndarray]) -> bool:
+    """
+    Write one frame with each of the given video writers, e.g. to record a stream both with and without
+    overlays. With the 'drop' policy, the frames are dropped from all videos as soon as the queue of one
+    writer is full, so that the videos stay in sync.
+
+    :return:
+        False if the frames were dropped, True otherwise.
+    """
+    if any(video_writer.policy == 'drop' and video_writer.frames.full() for video_writer in video_writers):
+        for video_writer in video_writers:
+            video_writer.num_dropped_frames += 1
+        return False
+    # Frames are only added from this thread, so the queues cannot fill up in the meantime
+    return all([video_writer.write(frame) for video_writer, frame in zip(video_writers, frames)])
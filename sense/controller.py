@@ -1,15 +1,26 @@
+import json
 import multiprocessing
+import os
 import queue
 
-from collections import Callable
+from typing import Callable
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 
+from sense.camera import AsyncVideoWriter
+from sense.camera import PrefetchingVideoSource
 from sense.camera import VideoSource
 from sense.camera import VideoStream
+from sense.camera import write_synchronized
+from sense.camera import WRITER_POLICIES
 from sense.display import DisplayResults
+from sense.display import RenderThread
 from sense.engine import InferenceEngine
+from sense.engine import InferenceProcess
+from sense.metrics import MetricsRegistry
+from sense.queues import QUEUE_POLICIES
 from sense.downstream_tasks.nn_utils import RealtimeNeuralNet
 from sense.downstream_tasks.postprocess import PostProcessor
 
@@ -17,18 +28,68 @@ import cv2
 import numpy as np
 
 
+class ClipBuffer:
+    """
+    Ring of preallocated uint8 clip buffers, in which the frames from the video stream are copied one
+    by one. Once every `clip_length` frames, a complete clip is returned as a contiguous array, without
+    copying or shifting the previous frames.
+
+    Clips are written to the buffers in turn, so that a returned clip is not overwritten while it is
+    queued or processed by the inference engine.
+    """
+
+    def __init__(self, clip_length: int, frame_size: Tuple[int, int], num_buffers: int = 3):
+        """
+        :param clip_length:
+            Number of frames in each clip, i.e. the step size of the inference engine.
+        :param frame_size:
+            Height and width of the frames.
+        :param num_buffers:
+            Number of clips that can be in use at the same time, including the one being filled.
+        """
+        self.clip_length = clip_length
+        self._buffers = np.zeros((num_buffers, 1, clip_length, *frame_size, 3), dtype=np.uint8)
+        self._buffer_index = 0
+        self._frame_index = 0
+
+    def add_frame(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Copy a frame into the current clip.
+
+        :return:
+            The clip of shape (1, clip_length, height, width, 3) if the frame completed it, None otherwise.
+        """
+        clip = self._buffers[self._buffer_index]
+        clip[0, self._frame_index] = frame
+        self._frame_index += 1
+        if self._frame_index < self.clip_length:
+            return None
+
+        self._frame_index = 0
+        self._buffer_index = (self._buffer_index + 1) % len(self._buffers)
+        return clip
+
+
 class Controller:
     def __init__(
             self,
             neural_network: RealtimeNeuralNet,
             post_processors: Union[PostProcessor, List[PostProcessor]],
-            results_display: DisplayResults,
+            results_display: Optional[DisplayResults],
             callbacks: Optional[List[Callable]] = None,
             camera_id: int = 0,
             path_in: Optional[str] = None,
             path_out: Optional[str] = None,
             use_gpu: bool = True,
-            stop_event: Optional[multiprocessing.Event] = None):
+            stop_event: Optional[multiprocessing.Event] = None,
+            backend: str = 'pytorch',
+            use_inference_process: bool = False,
+            offline: bool = False,
+            render_in_thread: bool = False,
+            recording_policy: str = 'block',
+            record_raw_only: bool = False,
+            metrics: Optional[MetricsRegistry] = None,
+            queue_policy: str = 'drop_oldest'):
         """
         :param neural_network:
             The neural network that produces the predictions for the camera image.
@@ -42,26 +103,85 @@ class Controller:
             The callbacks should return True if the inference should continue, False otherwise.
         :param results_display:
             A display window which shows the current camera image as well as the prediction with the highest
-            probability
+            probability. If None, the controller runs headless: nothing is rendered and predictions are only
+            passed to the callbacks.
         :param camera_id:
             The index of the webcam that is used. Default id is 0.
         :param path_in:
             If provided, use a video file located at the path as the input to the model
         :param path_out:
-            If provided, store the captured video in a file in this location
+            If provided, store the video with the displayed predictions in a file in this location, and the
+            captured video next to it, with a "_raw" suffix. Videos are encoded in background threads.
         :param use_gpu:
             If True, run the model on the GPU
         :param stop_event:
             Event for signalling to stop model inference
+        :param backend:
+            Inference backend used to run the model, either 'pytorch' or 'onnxruntime'
+        :param use_inference_process:
+            If True, run the model in a separate process instead of a thread, which avoids competing for
+            the GIL with video decoding and display
+        :param offline:
+            If True, process the video file given in path_in as fast as possible instead of in real time.
+            No frame, clip or prediction is dropped, so that the predictions are the same for every run.
+        :param render_in_thread:
+            If True, display and record the latest image and predictions in a separate thread, so that
+            rendering never blocks frame ingestion or post-processing. Images are skipped when rendering
+            is slower than the frame rate, including in the recorded videos.
+        :param recording_policy:
+            What to do with new frames when video encoding falls behind, either 'block' to wait for the
+            encoder or 'drop' to skip them in the recorded videos.
+        :param record_raw_only:
+            If True, only record the captured video, together with the predictions of each frame. The video
+            with the displayed predictions can then be rendered later on with `render_recording`.
+        :param metrics:
+            Registry in which the latency of each stage of the pipeline is recorded: reading and resizing
+            frames, waiting for them ('controller.frame_wait'), assembling clips ('controller.clip_assembly'),
+            running the network (except in an inference process), post-processing ('controller.postprocess')
+            and showing the predictions ('display.show'). The summary is logged periodically if the registry
+            has a `log_interval`.
+        :param queue_policy:
+            What to do with new frames and clips when the queues of the video stream and of the inference
+            engine are full, one of `sense.queues.QUEUE_POLICIES`. Dropped frames, clips and predictions
+            are counted, see `stats`. Not used in offline mode, in which nothing is dropped.
         """
-        self.inference_engine = InferenceEngine(neural_network, use_gpu=use_gpu)
+        if recording_policy not in WRITER_POLICIES:
+            raise ValueError(f'Unknown recording policy: {recording_policy}. Available policies: {WRITER_POLICIES}')
+        if results_display is None and path_out and not record_raw_only:
+            raise ValueError('Recording a video with the displayed predictions requires a results display.')
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {queue_policy}. Available policies: {QUEUE_POLICIES}')
+        if use_inference_process and queue_policy != 'drop_oldest':
+            raise ValueError('An inference process only keeps the latest clip, other queue policies are not '
+                             'supported.')
+        if offline:
+            if not path_in:
+                raise ValueError('The offline mode requires a video file as input.')
+            if use_inference_process:
+                raise ValueError('The offline mode is not supported with an inference process, which only '
+                                 'keeps the latest clip.')
+
+        self.metrics = metrics or MetricsRegistry(enabled=False)
+        if use_inference_process:
+            self.inference_engine = InferenceProcess(neural_network, use_gpu=use_gpu, backend=backend)
+        else:
+            self.inference_engine = InferenceEngine(neural_network, use_gpu=use_gpu, backend=backend,
+                                                    lossless=offline, metrics=self.metrics,
+                                                    input_policy=queue_policy)
         video_source = VideoSource(
             camera_id=camera_id,
             size=self.inference_engine.expected_frame_size,
             filename=path_in,
             target_fps=self.inference_engine.fps,
+            metrics=self.metrics,
         )
-        self.video_stream = VideoStream(video_source, self.inference_engine.fps)
+        if offline:
+            # Frames are decoded ahead without pacing nor skipping any
+            self.video_stream = PrefetchingVideoSource(video_source)
+        else:
+            self.video_stream = VideoStream(video_source, self.inference_engine.fps, policy=queue_policy)
+        self.offline = offline
+        self.prediction_pending = False
 
         if isinstance(post_processors, list):
             self.postprocessors = post_processors
@@ -70,13 +190,17 @@ class Controller:
 
         self.callbacks = callbacks or []
 
-        self.frame_index = None
-        self.clip = None
+        self.clip_buffer = None  # created in `_start_inference`
 
         self.results_display = results_display
+        self.render_thread = None  # created in `_start_inference`
+        self.render_in_thread = render_in_thread and results_display is not None
         self.path_out = path_out
-        self.video_recorder = None  # created in `display_prediction`
-        self.video_recorder_raw = None  # created in `display_prediction`
+        self.recording_policy = recording_policy
+        self.record_raw_only = record_raw_only
+        self.predictions_log = None  # created in `_start_inference`
+        self.video_recorder = None  # created in `_start_inference`
+        self.video_recorder_raw = None  # created in `_start_inference`
         self.stop_event = stop_event
 
     def run_inference(self):
@@ -84,47 +208,40 @@ class Controller:
 
         self._start_inference()
 
+        img = None
         while True:
             try:
-                self.frame_index += 1
-
                 # Grab frame if possible
-                img_tuple = self.video_stream.get_image()
+                with self.metrics.timer('controller.frame_wait'):
+                    img_tuple = self.video_stream.get_image()
                 # If not possible, stop
                 if img_tuple is None:
+                    if self.prediction_pending:
+                        # Predictions of the last clip
+                        self.prediction_pending = False
+                        self.process_prediction(None, self._get_prediction_lossless())
+                    # Do not end silently if the inference failed on the last clips
+                    self._check_inference_engine()
                     break
 
                 # Unpack
                 img, numpy_img = img_tuple
 
-                self.clip = np.roll(self.clip, -1, 1)
-                self.clip[:, -1, :, :, :] = numpy_img
-
-                if self.frame_index == self.inference_engine.step_size:
-                    # A new clip is ready
-                    self.inference_engine.put_nowait(self.clip)
-
-                self.frame_index = self.frame_index % self.inference_engine.step_size
+                with self.metrics.timer('controller.clip_assembly'):
+                    clip = self.clip_buffer.add_frame(numpy_img)
 
                 # Get predictions
-                prediction = self.inference_engine.get_nowait()
-
-                prediction_postprocessed = self.postprocess_prediction(prediction)
-
-                self.display_prediction(img, prediction_postprocessed)
+                prediction = self.exchange_clip(clip)
 
-                # Apply callbacks
-                if not all(callback(prediction_postprocessed) for callback in self.callbacks):
+                if not self.process_prediction(img, prediction):
                     break
 
+                self.metrics.log_periodically()
+
             except Exception as e:
                 runtime_error = e
                 break
 
-            # Press escape to exit
-            if cv2.waitKey(1) == 27:
-                break
-
             # Press cancel on sense-studio testing page to stop inference
             if self.stop_event and self.stop_event.is_set():
                 break
@@ -134,54 +251,274 @@ class Controller:
         if runtime_error:
             raise runtime_error
 
+    def exchange_clip(self, clip: Optional[np.ndarray]) -> Optional[Union[np.ndarray, List[np.ndarray]]]:
+        """
+        Send the new clip to the inference engine if one is ready, and return new predictions if available.
+
+        In offline mode, no clip or prediction is dropped: the predictions of each clip are computed while
+        the next clip is gathered, and returned once the next clip is sent. If the inference engine stopped,
+        its error is raised.
+        """
+        if not self.offline:
+            if clip is not None:
+                self.inference_engine.put_nowait(clip)
+            prediction = self.inference_engine.get_nowait()
+            if prediction is None:
+                self._check_inference_engine()
+            return prediction
+
+        if clip is None:
+            return None
+        self._put_clip_lossless(clip)
+        if not self.prediction_pending:
+            # First clip, its predictions are returned with the next clip
+            self.prediction_pending = True
+            return None
+        return self._get_prediction_lossless()
+
+    def _put_clip_lossless(self, clip: np.ndarray):
+        while True:
+            try:
+                self.inference_engine.put(clip, timeout=1)
+                return
+            except queue.Full:
+                self._check_inference_engine()
+
+    def _get_prediction_lossless(self) -> Union[np.ndarray, List[np.ndarray]]:
+        while True:
+            try:
+                return self.inference_engine.get(timeout=1)
+            except queue.Empty:
+                self._check_inference_engine()
+
+    def _check_inference_engine(self):
+        """
+        Raise the error of the inference engine or process if it stopped, instead of waiting for it forever
+        or silently running without predictions.
+        """
+        if not self.inference_engine.is_alive():
+            if self.inference_engine.error is not None:
+                raise self.inference_engine.error
+            raise RuntimeError('The inference engine stopped unexpectedly.')
+
+    def _check_render_thread(self):
+        """
+        Raise the error of the render thread if rendering failed, e.g. when showing or recording an image,
+        instead of silently running without display nor recording.
+        """
+        if self.render_thread is not None and self.render_thread.error is not None:
+            raise self.render_thread.error
+
+    def process_prediction(self, img: Optional[np.ndarray],
+                           prediction: Optional[Union[np.ndarray, List[np.ndarray]]]):
+        """
+        Post-process and render the prediction, then apply the callbacks.
+
+        :param img:
+            The current frame, or None for the predictions of the last clip in offline mode, which come
+            after the last frame. These are then only post-processed, logged and passed to the callbacks,
+            without showing or recording any frame.
+        :return:
+            False if one of the callbacks or the user asks to stop the inference, True otherwise.
+        """
+        with self.metrics.timer('controller.postprocess'):
+            prediction_postprocessed = self.postprocess_prediction(prediction)
+
+        if self.path_out and self.record_raw_only:
+            recorded = img is not None and self.video_recorder_raw.write(img)
+            self.predictions_log.write(_serialize_logged_prediction(prediction, recorded) + '\n')
+
+        if img is None:
+            continue_inference = True
+        elif self.render_thread is not None:
+            self._check_render_thread()
+            self.render_thread.put_nowait(img, prediction_postprocessed)
+            continue_inference = not self.render_thread.stop_requested
+        elif self.results_display is not None:
+            continue_inference = self.render_prediction(img, prediction_postprocessed)
+        else:
+            continue_inference = True
+
+        # Apply callbacks
+        return all(callback(prediction_postprocessed) for callback in self.callbacks) and continue_inference
+
+    def render_prediction(self, img: np.ndarray, prediction_postprocessed: dict) -> bool:
+        """
+        Display and record the image with the prediction.
+
+        :return:
+            False if the user pressed escape to stop the inference, True otherwise.
+        """
+        self.display_prediction(img, prediction_postprocessed)
+
+        # Press escape to exit
+        return not self.results_display.escape_pressed()
+
     def postprocess_prediction(self, prediction):
-        post_processed_data = {}
-        for post_processor in self.postprocessors:
-            post_processed_data.update(post_processor(prediction))
-        return {'prediction': prediction, **post_processed_data}
+        return postprocess_prediction(self.postprocessors, prediction)
 
     def display_prediction(self, img: np.ndarray, prediction_postprocessed: dict):
         # Live display
-        img_augmented = self.results_display.show(img, prediction_postprocessed)
+        with self.metrics.timer('display.show'):
+            img_augmented = self.results_display.show(img, prediction_postprocessed)
 
         # Recording
-        if self.path_out:
-            if self.video_recorder is None or self.video_recorder_raw is None:
-                self._instantiate_video_recorders(img_augmented, img)
+        if self.path_out and not self.record_raw_only:
+            write_synchronized([self.video_recorder, self.video_recorder_raw], [img_augmented, img])
 
-            self.video_recorder.write(img_augmented)
-            self.video_recorder_raw.write(img)
+    def stats(self) -> dict:
+        """
+        Return the counters of dropped data and the depths of the queues of the video stream and of the
+        inference engine, along with the number of frames skipped in the recorded videos. Can be called
+        from another thread while the inference is running.
+        """
+        stats = {}
+        if isinstance(self.video_stream, VideoStream):
+            stats.update(self.video_stream.stats())
+        stats.update(self.inference_engine.stats())
+        for name, video_recorder in [('video_recorder', self.video_recorder),
+                                     ('video_recorder_raw', self.video_recorder_raw)]:
+            if video_recorder is not None:
+                stats[f'num_dropped_frames_{name}'] = video_recorder.num_dropped_frames
+        return stats
 
     def _start_inference(self):
         print("Starting inference")
-        self.clip = np.random.randn(
-            1,
-            self.inference_engine.step_size,
-            self.inference_engine.expected_frame_size[0],
-            self.inference_engine.expected_frame_size[1],
-            3
-        )
-        self.frame_index = 0
+        self.clip_buffer = ClipBuffer(self.inference_engine.step_size, self.inference_engine.expected_frame_size)
         self.inference_engine.start()
         self.video_stream.start()
-        self.results_display.initialize()
+        if self.results_display is not None:
+            self.results_display.initialize()
+        if self.path_out:
+            self._start_video_recorders()
+        if self.render_in_thread:
+            self.render_thread = RenderThread(self.render_prediction)
+            self.render_thread.start()
 
     def _stop_inference(self):
         print("Stopping inference")
-        cv2.destroyAllWindows()
+        if self.render_thread is not None:
+            self.render_thread.stop()
+            self.render_thread.join()
+        if self.results_display is not None:
+            self.results_display.clean_up()
         self.video_stream.stop()
         self.inference_engine.stop()
 
+        stats = self.stats()
+        if stats.get('num_dropped_frames'):
+            print(f"*** {stats['num_dropped_frames']} frames skipped ***")
+        if stats.get('num_dropped_clips'):
+            print(f"*** {stats['num_dropped_clips']} clips skipped ***")
+        if stats.get('num_dropped_predictions'):
+            print(f"*** {stats['num_dropped_predictions']} unused predictions ***")
+
         if self.video_recorder is not None:
             self.video_recorder.release()
+            if self.video_recorder.num_dropped_frames:
+                print(f"*** {self.video_recorder.num_dropped_frames} frames skipped in {self.path_out} ***")
 
         if self.video_recorder_raw is not None:
             self.video_recorder_raw.release()
+            if self.video_recorder_raw.num_dropped_frames:
+                print(f"*** {self.video_recorder_raw.num_dropped_frames} frames skipped in "
+                      f"{self.video_recorder_raw.path} ***")
+
+        if self.predictions_log is not None:
+            self.predictions_log.close()
+
+        # Raise the errors of the render thread and of the video writers once everything is stopped, so that
+        # failures on the last images are not missed
+        self._check_render_thread()
+        for video_recorder in [self.video_recorder, self.video_recorder_raw]:
+            if video_recorder is not None and video_recorder.error is not None:
+                raise video_recorder.error
+
+    def _start_video_recorders(self):
+        path_raw, path_predictions = get_recording_paths(self.path_out)
+        self.video_recorder_raw = AsyncVideoWriter(path_raw, self.inference_engine.fps, self.recording_policy)
+        self.video_recorder_raw.start()
+
+        if self.record_raw_only:
+            self.predictions_log = open(path_predictions, 'w')
+        else:
+            self.video_recorder = AsyncVideoWriter(self.path_out, self.inference_engine.fps, self.recording_policy)
+            self.video_recorder.start()
+
+
+def postprocess_prediction(post_processors: List[PostProcessor],
+                           prediction: Optional[Union[np.ndarray, List[np.ndarray]]]) -> dict:
+    """
+    Apply the post processors to the prediction and gather their outputs, along with the prediction itself
+    under the key 'prediction'.
+    """
+    post_processed_data = {}
+    for post_processor in post_processors:
+        post_processed_data.update(post_processor(prediction))
+    return {'prediction': prediction, **post_processed_data}
+
+
+def get_recording_paths(path_out: str) -> Tuple[str, str]:
+    """
+    Return the paths of the captured video and of the log of predictions recorded along with the video
+    with the displayed predictions at the given path.
+    """
+    root, extension = os.path.splitext(path_out)
+    return f'{root}_raw{extension}', f'{root}_predictions.jsonl'
+
+
+def _serialize_logged_prediction(prediction: Optional[Union[np.ndarray, List[np.ndarray]]], recorded: bool) -> str:
+    multiple_outputs = isinstance(prediction, list)
+    if prediction is not None:
+        prediction = [output.tolist() for output in prediction] if multiple_outputs else prediction.tolist()
+    return json.dumps({'recorded': recorded, 'multiple_outputs': multiple_outputs, 'prediction': prediction})
+
+
+def _deserialize_logged_prediction(line: str) -> Tuple[Optional[Union[np.ndarray, List[np.ndarray]]], bool]:
+    entry = json.loads(line)
+    prediction = entry['prediction']
+    if prediction is not None:
+        prediction = ([np.array(output, dtype=np.float32) for output in prediction] if entry['multiple_outputs']
+                      else np.array(prediction, dtype=np.float32))
+    return prediction, entry['recorded']
+
+
+def render_recording(path_out: str, post_processors: Union[PostProcessor, List[PostProcessor]],
+                     results_display: DisplayResults, policy: str = 'block'):
+    """
+    Render the video with the displayed predictions of a recording made with `record_raw_only`, from the
+    captured video and the logged predictions. The post processors are applied to the same sequence of
+    predictions as during the recording, so that the rendered video is the same as if it had been recorded
+    live.
+
+    :param path_out:
+        Path given to the controller for the recording, where the rendered video is written.
+    :param post_processors:
+        Post processors used during the recording, in a freshly initialized state.
+    :param results_display:
+        The display used to render the predictions. Give it a `display_fn` to render without showing the
+        frames in a window.
+    :param policy:
+        Policy of the video writer, see `AsyncVideoWriter`.
+    """
+    if not isinstance(post_processors, list):
+        post_processors = [post_processors]
+    path_raw, path_predictions = get_recording_paths(path_out)
+
+    video = cv2.VideoCapture(path_raw)
+    video_recorder = AsyncVideoWriter(path_out, video.get(cv2.CAP_PROP_FPS), policy)
+    video_recorder.start()
+    results_display.initialize()
+
+    with open(path_predictions) as predictions_log:
+        for line in predictions_log:
+            prediction, recorded = _deserialize_logged_prediction(line)
+            prediction_postprocessed = postprocess_prediction(post_processors, prediction)
+            if recorded:
+                ret, img = video.read()
+                if not ret:
+                    break
+                video_recorder.write(results_display.show(img, prediction_postprocessed))
 
-    def _instantiate_video_recorders(self, img_augmented, img_raw):
-        self.video_recorder = cv2.VideoWriter(self.path_out, 0x7634706d, self.inference_engine.fps,
-                                              (img_augmented.shape[1], img_augmented.shape[0]))
-
-        path_raw = self.path_out.replace('.mp4', '_raw.mp4')
-        self.video_recorder_raw = cv2.VideoWriter(path_raw, 0x7634706d, self.inference_engine.fps,
-                                                  (img_raw.shape[1], img_raw.shape[0]))
+    video_recorder.release()
+    video.release()
@@ -1,8 +1,11 @@
 import cv2
 import numpy as np
+import queue
 import time
 
 from collections import deque
+from threading import Thread
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Tuple
@@ -527,6 +530,74 @@ class DisplayResults:
                                  cv2.BORDER_CONSTANT)
         return img
 
+    def escape_pressed(self) -> bool:
+        """
+        Process the events of the display window and return whether the escape key was pressed. If images
+        are forwarded to `display_fn` instead of being shown in a window, return False right away.
+        """
+        return self.display_fn is None and cv2.waitKey(1) == 27
+
     def clean_up(self):
         """Close all windows that are created."""
-        cv2.destroyAllWindows()
+        if self.display_fn is None:
+            cv2.destroyAllWindows()
+
+
+class RenderThread(Thread):
+    """
+    Thread rendering the latest image and display data, so that drawing and showing images never blocks
+    the ingestion of frames or the post-processing of predictions. An image that arrives while the previous
+    one is still being rendered replaces any image waiting to be rendered. If rendering fails, the error is
+    stored in `error` and `stop_requested` is set, so that the producer of the images stops and raises it.
+
+    Note that on some platforms, e.g. macOS, OpenCV windows can only be used from the main thread.
+    """
+
+    def __init__(self, render_fn: Callable[[np.ndarray, dict], bool]):
+        """
+        :param render_fn:
+            Function rendering an image with its display data, which returns False if the user asked to
+            stop, e.g. by pressing escape.
+        """
+        Thread.__init__(self, daemon=True)
+        self.render_fn = render_fn
+        self.stop_requested = False
+        self.error = None  # set in `run` if rendering fails
+        self._queue = queue.Queue(1)
+        self._shutdown = False
+
+    def put_nowait(self, img: np.ndarray, display_data: dict):
+        """
+        Add an image and its display data to be rendered, replacing the previous ones if they were not
+        rendered yet.
+        """
+        if self._queue.full():
+            try:
+                # Remove one image
+                self._queue.get_nowait()
+            except queue.Empty:
+                # Taken by the render thread in the meantime
+                pass
+        self._queue.put_nowait((img, display_data))
+
+    def stop(self):
+        """Stop rendering after the current image."""
+        self._shutdown = True
+
+    def run(self):
+        try:
+            self._render()
+        except Exception as error:
+            self.error = error
+            self.stop_requested = True
+            raise
+
+    def _render(self):
+        while not self._shutdown:
+            try:
+                img, display_data = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if not self.render_fn(img, display_data):
+                self.stop_requested = True
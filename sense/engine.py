@@ -1,14 +1,30 @@
+import contextlib
+import copy
+import multiprocessing
 import numpy as np
 import queue
+import time
 import torch
+import warnings
 
+from threading import Event
+from threading import Lock
 from threading import Thread
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
+from sense.backbone_networks.mobilenet import StridedInflatedMobileNetV2
 from sense.downstream_tasks.nn_utils import RealtimeNeuralNet
+from sense.export import OnnxRuntimeNeuralNet
+from sense.export import serialize_onnx
+from sense.export import StatelessNetwork
+from sense.metrics import MetricsRegistry
+from sense.queues import BoundedQueue
+
+BACKENDS = ['pytorch', 'onnxruntime']
 
 
 class InferenceEngine(Thread):
@@ -17,21 +33,78 @@ class InferenceEngine(Thread):
     either using the local machine's CPU or GPU.
     """
 
-    def __init__(self, net: RealtimeNeuralNet, use_gpu: bool = False):
+    def __init__(self, net: RealtimeNeuralNet, use_gpu: bool = False, use_channels_last: bool = False,
+                 use_bfloat16: bool = False, backend: str = 'pytorch', lossless: bool = False,
+                 metrics: Optional[MetricsRegistry] = None, queue_size: int = 1,
+                 input_policy: str = 'drop_oldest', output_policy: str = 'drop_oldest'):
         """
         :param net:
             The neural network to be run by the inference engine.
         :param use_gpu:
             Whether to leverage CUDA or not for neural network inference.
+        :param use_channels_last:
+            Whether to run the network in the channels-last (NHWC) memory format. Its weights are
+            converted once and backbone networks preprocess the frames directly into that format, see
+            `StridedInflatedMobileNetV2.channels_last_frames`. Internal states of steppable layers follow
+            the format of the frames. Frames of other networks are converted after preprocessing.
+        :param use_bfloat16:
+            Whether to run CPU inference under bfloat16 autocast, which requires PyTorch 1.10 or newer.
+            Internal states of steppable layers are then stored in bfloat16 as well.
+        :param backend:
+            Runtime used for inference, one of `BACKENDS`. With 'onnxruntime', the network is exported
+            to ONNX and run on the CPU with ONNX Runtime, which only supports clips with a multiple of
+            `step_size` frames.
+        :param lossless:
+            If True, predictions are never dropped: the engine waits for the previous predictions to be
+            retrieved before outputting new ones, as with the 'block' output policy. Clips should then be
+            added with the blocking `put`.
+        :param metrics:
+            Registry in which the time spent waiting for clips ('engine.queue_wait'), preprocessing them
+            ('engine.preprocess'), transferring them to the device ('engine.to_device'), running the network
+            ('engine.forward') and transferring the predictions back ('engine.to_host') is recorded. On GPU,
+            the forward pass runs asynchronously and is mostly accounted to the transfer back.
+        :param queue_size:
+            Maximum number of clips, respectively predictions, in the input and output queues.
+        :param input_policy:
+            What to do with clips added with `put_nowait` when the input queue is full, one of
+            `sense.queues.QUEUE_POLICIES`. With 'block', `put_nowait` waits for a clip to be processed.
+        :param output_policy:
+            What to do with new predictions when the output queue is full, one of `sense.queues.QUEUE_POLICIES`.
         """
         Thread.__init__(self)
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown inference backend: {backend}. Available backends: {BACKENDS}')
+        if backend == 'onnxruntime':
+            if use_gpu or use_channels_last or use_bfloat16:
+                raise ValueError('The onnxruntime backend does not support GPU, channels-last or bfloat16 '
+                                 'inference.')
+            if not isinstance(net, OnnxRuntimeNeuralNet):
+                net = OnnxRuntimeNeuralNet(serialize_onnx(net))
         self.net = net
+        self.backend = backend
+        self.lossless = lossless
+        self.metrics = metrics or MetricsRegistry(enabled=False)
         self.use_gpu = use_gpu
+        self.use_channels_last = use_channels_last
+        self.use_bfloat16 = use_bfloat16
+        if use_bfloat16:
+            if use_gpu:
+                raise ValueError('bfloat16 autocast is only supported for CPU inference.')
+            if not bfloat16_autocast_available():
+                raise RuntimeError(f'bfloat16 inference requires PyTorch 1.10 or newer, found {torch.__version__}.')
+            if not bfloat16_supported():
+                warnings.warn('This CPU does not support bfloat16 natively, inference will be slower.')
         if use_gpu:
             self.net.cuda()
-        self._queue_in = queue.Queue(1)
-        self._queue_out = queue.Queue(1)
+        if use_channels_last:
+            self.net.to(memory_format=torch.channels_last)
+            for module in self.net.modules():
+                if isinstance(module, StridedInflatedMobileNetV2):
+                    module.channels_last_frames = True
+        self._queue_in = BoundedQueue(queue_size, input_policy)
+        self._queue_out = BoundedQueue(queue_size, 'block' if lossless else output_policy)
         self._shutdown = False
+        self.error = None  # set in `run` if the inference fails
 
     @property
     def expected_frame_size(self) -> Tuple[int, int]:
@@ -48,25 +121,75 @@ class InferenceEngine(Thread):
         """The step size of the inference engine's neural network."""
         return self.net.step_size
 
+    def stats(self) -> dict:
+        """
+        Return the number of clips and predictions dropped so far ('num_dropped_clips' and
+        'num_dropped_predictions'), as well as the current and maximal number of items in the input and
+        output queues.
+        """
+        stats_in = self._queue_in.stats()
+        stats_out = self._queue_out.stats()
+        return {
+            'num_dropped_clips': stats_in['num_dropped'],
+            'num_dropped_predictions': stats_out['num_dropped'],
+            'input_queue_depth': stats_in['depth'],
+            'max_input_queue_depth': stats_in['max_depth'],
+            'output_queue_depth': stats_out['depth'],
+            'max_output_queue_depth': stats_out['max_depth'],
+        }
+
     def put_nowait(self, clip: np.ndarray):
         """
-        Add a new clip to the input queue of inference engine for prediction.
+        Add a new clip to the input queue of inference engine for prediction, applying the input policy
+        if the queue is full. With the 'block' policy, the error of the inference engine is raised if it
+        stops while waiting, instead of waiting for it forever.
 
         :param clip:
             The video frame to be added to the inference engine's input queue.
         """
-        if self._queue_in.full():
-            # Remove one clip
-            self._queue_in.get_nowait()
-        self._queue_in.put_nowait(clip)
+        while True:
+            try:
+                self._queue_in.put_with_policy(clip, timeout=1)
+                return
+            except queue.Full:
+                self._check_running()
+
+    def _check_running(self):
+        if not self.is_alive():
+            if self.error is not None:
+                raise self.error
+            raise RuntimeError('The inference engine stopped unexpectedly.')
 
     def get_nowait(self) -> Optional[np.ndarray]:
         """
         Return a clip from the output queue of the inference engine if available.
         """
-        if self._queue_out.empty():
+        try:
+            return self._queue_out.get_nowait()
+        except queue.Empty:
             return None
-        return self._queue_out.get_nowait()
+
+    def put(self, clip: np.ndarray, timeout: Optional[float] = None):
+        """
+        Add a new clip to the input queue of inference engine for prediction, waiting until the previous
+        clip was taken by the engine.
+
+        :param clip:
+            The video frame to be added to the inference engine's input queue.
+        :param timeout:
+            Maximum time to wait in seconds, after which queue.Full is raised. Wait indefinitely if None.
+        """
+        self._queue_in.put(clip, timeout=timeout)
+
+    def get(self, timeout: Optional[float] = None) -> Union[np.ndarray, List[np.ndarray]]:
+        """
+        Return the next predictions from the output queue of the inference engine, waiting for them to be
+        computed if needed.
+
+        :param timeout:
+            Maximum time to wait in seconds, after which queue.Empty is raised. Wait indefinitely if None.
+        """
+        return self._queue_out.get(timeout=timeout)
 
     def stop(self):
         """Terminate the inference engine."""
@@ -74,8 +197,17 @@ class InferenceEngine(Thread):
 
     def run(self):
         """
-        Keep the inference engine running and inferring predictions from input video frames.
+        Keep the inference engine running and inferring predictions from input video frames. If the inference
+        fails, the error is kept in `error` so that it can be raised by the users of the engine.
         """
+        try:
+            self._run()
+        except Exception as error:
+            self.error = error
+            raise
+
+    def _run(self):
+        wait_start = time.perf_counter()
         while not self._shutdown:
             try:
                 clip = self._queue_in.get(timeout=1)
@@ -83,19 +215,20 @@ class InferenceEngine(Thread):
                 clip = None
 
             if clip is not None:
+                self.metrics.record('engine.queue_wait', time.perf_counter() - wait_start)
                 predictions = self.infer(clip)
 
-                # Remove time dimension
-                if isinstance(predictions, list):
-                    predictions = [pred[0] for pred in predictions]
-                else:
-                    predictions = predictions[0]
+                predictions = _remove_time_dimension(predictions)
 
-                if self._queue_out.full():
-                    # Remove one frame
-                    self._queue_out.get_nowait()
-                    print("*** Unused predictions ***")
-                self._queue_out.put(predictions, block=False)
+                # With the 'block' policy, wait for previous predictions to be retrieved, unless the engine
+                # is stopped
+                while not self._shutdown:
+                    try:
+                        self._queue_out.put_with_policy(predictions, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                wait_start = time.perf_counter()
 
     def infer(self, clip: np.ndarray, batch_size=None) -> Union[np.ndarray, List[np.ndarray]]:
         """
@@ -112,7 +245,7 @@ class InferenceEngine(Thread):
         is a list of numpy.ndarray, one for each output.
 
         :param clip:
-            The video frame to be inferred.
+            The video frames to be inferred, either as uint8 or float values in [0, 255].
         :param batch_size:
             Batch size to perform inference. Warning, only use if you did not remove
             padding from model.
@@ -121,26 +254,494 @@ class InferenceEngine(Thread):
             Predictions from the neural network.
         """
         predictions = []
-        with torch.no_grad():
-            clip = self.net.preprocess(clip)
+        with torch.no_grad(), contextlib.ExitStack() as stack:
+            if self.use_bfloat16:
+                stack.enter_context(torch.autocast('cpu', dtype=torch.bfloat16))
 
-            if self.use_gpu:
-                clip = clip.cuda()
-            if batch_size is None:
-                predictions = self.net(clip)
-            else:
-                for sub_clip in torch.Tensor.split(clip, batch_size):
-                    if sub_clip.shape[0] >= self.net.num_required_frames_per_layer_padding[0]:
-                        predictions.append(self.net(sub_clip))
-                if isinstance(predictions[0], list):
-                    predictions = list(zip(predictions))
-                    predictions = [torch.cat(x, dim=0) for x in predictions]
+            with self.metrics.timer('engine.preprocess'):
+                clip = self.net.preprocess(clip)
+
+            with self.metrics.timer('engine.to_device'):
+                if self.use_gpu:
+                    clip = clip.cuda()
+                if self.use_channels_last:
+                    clip = clip.contiguous(memory_format=torch.channels_last)
+
+            with self.metrics.timer('engine.forward'):
+                if batch_size is None:
+                    predictions = self.net(clip)
                 else:
-                    predictions = torch.cat(predictions, dim=0)
+                    for sub_clip in torch.Tensor.split(clip, batch_size):
+                        if sub_clip.shape[0] >= self.net.num_required_frames_per_layer_padding[0]:
+                            predictions.append(self.net(sub_clip))
+                    if isinstance(predictions[0], list):
+                        predictions = list(zip(predictions))
+                        predictions = [torch.cat(x, dim=0) for x in predictions]
+                    else:
+                        predictions = torch.cat(predictions, dim=0)
 
-        if isinstance(predictions, list):
-            predictions = [pred.cpu().numpy() for pred in predictions]
-        else:
-            predictions = predictions.cpu().numpy()
+        with self.metrics.timer('engine.to_host'):
+            if isinstance(predictions, list):
+                predictions = [pred.float().cpu().numpy() for pred in predictions]
+            else:
+                predictions = predictions.float().cpu().numpy()
 
         return predictions
+
+
+def _remove_time_dimension(predictions: Union[np.ndarray, List[np.ndarray]]) -> Union[np.ndarray, List[np.ndarray]]:
+    if isinstance(predictions, list):
+        return [pred[0] for pred in predictions]
+    return predictions[0]
+
+
+class MultiStreamInferenceEngine(Thread):
+    """
+    MultiStreamInferenceEngine serves several video streams, e.g. from different cameras, with a single
+    copy of the neural network. The clips that are ready for all streams are gathered into one batched
+    forward pass and the predictions are scattered back to each stream.
+
+    The internal states of the steppable layers are kept in slots, one per stream, so that each stream
+    gets exactly the same predictions as with its own InferenceEngine.
+    """
+
+    def __init__(self, net: RealtimeNeuralNet, max_num_streams: int, max_batch_size: Optional[int] = None,
+                 use_gpu: bool = False):
+        """
+        :param net:
+            The neural network to be run by the inference engine, either a backbone network or a Pipe of a
+            backbone network and its classifier heads.
+        :param max_num_streams:
+            Maximum number of streams served at the same time, for which internal states are allocated.
+        :param max_batch_size:
+            Maximum number of streams processed in a single forward pass. Clips of more streams are split
+            into several batches. All ready streams are processed at once if not provided.
+        :param use_gpu:
+            Whether to leverage CUDA or not for neural network inference.
+        """
+        Thread.__init__(self)
+        self.net = net
+        self.max_num_streams = max_num_streams
+        self.max_batch_size = max_batch_size or max_num_streams
+        self.use_gpu = use_gpu
+        self.stateless_network = StatelessNetwork(net).eval()
+        if use_gpu:
+            self.stateless_network.cuda()
+        self.state_slots = self._allocate_state_slots()
+
+        self._lock = Lock()
+        self._free_slots = list(range(max_num_streams))
+        self._queues_in = {}
+        self._queues_out = {}
+        # Dropped clips and predictions of the streams that were removed
+        self._num_dropped_clips_removed = 0
+        self._num_dropped_predictions_removed = 0
+        self._clip_ready = Event()
+        self._shutdown = False
+        self.error = None  # set in `run` if the inference fails
+
+    def _allocate_state_slots(self) -> List[torch.Tensor]:
+        device = 'cuda' if self.use_gpu else 'cpu'
+        frames = torch.zeros(1, self.step_size, 3, *self.expected_frame_size, device=device)
+        with torch.no_grad():
+            _, states = self.stateless_network.forward_streams(frames, [])
+        return [state.new_zeros((self.max_num_streams, *state.shape[1:])) for state in states]
+
+    @property
+    def expected_frame_size(self) -> Tuple[int, int]:
+        """Return the frame size of the video source input."""
+        return self.net.expected_frame_size
+
+    @property
+    def fps(self) -> int:
+        """Frame rate of the inference engine's neural network."""
+        return self.net.fps
+
+    @property
+    def step_size(self) -> int:
+        """The step size of the inference engine's neural network."""
+        return self.net.step_size
+
+    def add_stream(self) -> int:
+        """
+        Register a new video stream, starting from zero-initialized internal states.
+
+        :return:
+            The id of the stream, to be used in `put_nowait` and `get_nowait`.
+        """
+        with self._lock:
+            if not self._free_slots:
+                raise RuntimeError(f'Cannot serve more than {self.max_num_streams} streams.')
+            stream_id = self._free_slots.pop(0)
+            for state_slots in self.state_slots:
+                state_slots[stream_id] = 0.
+            self._queues_in[stream_id] = BoundedQueue(1, 'drop_oldest')
+            self._queues_out[stream_id] = BoundedQueue(1, 'drop_oldest')
+        return stream_id
+
+    def remove_stream(self, stream_id: int):
+        """
+        Stop serving the given stream. Its slot can then be reused by a new stream.
+        """
+        with self._lock:
+            self._num_dropped_clips_removed += self._queues_in.pop(stream_id).num_dropped
+            self._num_dropped_predictions_removed += self._queues_out.pop(stream_id).num_dropped
+            self._free_slots.append(stream_id)
+            self._free_slots.sort()
+
+    def put_nowait(self, stream_id: int, clip: np.ndarray):
+        """
+        Add a new clip of the given stream to the input queue of inference engine for prediction. If the
+        inference failed, its error is raised instead.
+
+        :param stream_id:
+            The id of the stream, as returned by `add_stream`.
+        :param clip:
+            The video frames to be added to the stream's input queue.
+        """
+        self._check_error()
+        self._queues_in[stream_id].put_with_policy(clip)
+        self._clip_ready.set()
+
+    def get_nowait(self, stream_id: int) -> Optional[Union[np.ndarray, List[np.ndarray]]]:
+        """
+        Return the predictions for the given stream from the output queue of the inference engine
+        if available. If the inference failed, its error is raised instead.
+        """
+        self._check_error()
+        try:
+            return self._queues_out[stream_id].get_nowait()
+        except queue.Empty:
+            return None
+
+    def stats(self, stream_id: Optional[int] = None) -> dict:
+        """
+        Return the number of clips and predictions dropped so far ('num_dropped_clips' and
+        'num_dropped_predictions'), either for the given stream or in total over all streams served so far.
+        Only the latest clip and predictions of each stream are kept, older ones are dropped.
+        """
+        with self._lock:
+            if stream_id is not None:
+                return {'num_dropped_clips': self._queues_in[stream_id].num_dropped,
+                        'num_dropped_predictions': self._queues_out[stream_id].num_dropped}
+            return {
+                'num_dropped_clips': self._num_dropped_clips_removed + sum(
+                    queue_in.num_dropped for queue_in in self._queues_in.values()),
+                'num_dropped_predictions': self._num_dropped_predictions_removed + sum(
+                    queue_out.num_dropped for queue_out in self._queues_out.values()),
+            }
+
+    def stop(self):
+        """Terminate the inference engine."""
+        self._shutdown = True
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        """
+        Keep the inference engine running and inferring predictions for all streams with a clip ready. If
+        the inference fails, the error is kept in `error` and raised by `put_nowait` and `get_nowait`.
+        """
+        try:
+            self._run()
+        except Exception as error:
+            self.error = error
+            raise
+
+    def _run(self):
+        while not self._shutdown:
+            if not self._clip_ready.wait(timeout=1):
+                continue
+            self._clip_ready.clear()
+
+            with self._lock:
+                clips = {}
+                for stream_id, queue_in in self._queues_in.items():
+                    if not queue_in.empty():
+                        clips[stream_id] = queue_in.get_nowait()
+                queues_out = {stream_id: self._queues_out[stream_id] for stream_id in clips}
+            if not clips:
+                continue
+
+            predictions_per_stream = self._infer(clips, queues_out)
+
+            for stream_id, predictions in predictions_per_stream.items():
+                predictions = _remove_time_dimension(predictions)
+
+                queues_out[stream_id].put_with_policy(predictions)
+
+    def infer(self, clips: Dict[int, np.ndarray]) -> Dict[int, Union[np.ndarray, List[np.ndarray]]]:
+        """
+        Infer and return predictions for the clips of several streams in batches of up to `max_batch_size`
+        streams, and update the internal states of these streams.
+
+        :param clips:
+            Mapping from stream ids to the clip of each stream. All clips must have the same number
+            of frames.
+        :return:
+            Mapping from stream ids to predictions, in the same format as `InferenceEngine.infer`. Streams
+            which were removed during the inference are left out.
+        """
+        with self._lock:
+            queues_out = {stream_id: self._queues_out.get(stream_id) for stream_id in clips}
+        return self._infer(clips, queues_out)
+
+    def _infer(self, clips: Dict[int, np.ndarray],
+               queues_out: Dict[int, BoundedQueue]) -> Dict[int, Union[np.ndarray, List[np.ndarray]]]:
+        stream_ids = sorted(clips)
+        predictions = {}
+        for batch_start in range(0, len(stream_ids), self.max_batch_size):
+            batch_stream_ids = stream_ids[batch_start:batch_start + self.max_batch_size]
+            predictions.update(self._infer_batch({stream_id: clips[stream_id] for stream_id in batch_stream_ids},
+                                                 queues_out))
+        return predictions
+
+    def _infer_batch(self, clips: Dict[int, np.ndarray],
+                     queues_out: Dict[int, BoundedQueue]) -> Dict[int, Union[np.ndarray, List[np.ndarray]]]:
+        # The lock is only held to read and write the internal states, so that streams can be added and
+        # removed during the forward pass. Each stream is identified by its output queue, which is replaced
+        # when its slot is reused by a new stream, whose states must not be overwritten.
+        stream_ids = list(clips)
+        frames = torch.stack([self.net.preprocess(clips[stream_id]) for stream_id in stream_ids])
+        slots = torch.tensor(stream_ids)
+
+        with torch.no_grad():
+            if self.use_gpu:
+                frames = frames.cuda()
+                slots = slots.cuda()
+            with self._lock:
+                states = [state_slots[slots] for state_slots in self.state_slots]
+            outputs, new_states = self.stateless_network.forward_streams(frames, states)
+            with self._lock:
+                served = [index for index, stream_id in enumerate(stream_ids)
+                          if self._queues_out.get(stream_id) is queues_out[stream_id]]
+                served_slots = slots[served]
+                for state_slots, new_state in zip(self.state_slots, new_states):
+                    state_slots[served_slots] = new_state[served]
+
+        outputs = [output.cpu().numpy() for output in outputs]
+        if self.stateless_network.multiple_outputs:
+            return {stream_ids[index]: [output[index] for output in outputs] for index in served}
+        return {stream_ids[index]: outputs[0][index] for index in served}
+
+
+class SharedArray:
+    """
+    Numpy array in shared memory, which can be passed to a child process on its creation.
+    """
+
+    def __init__(self, context, shape: Tuple[int, ...], dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.buffer = context.RawArray('b', int(np.prod(self.shape)) * self.dtype.itemsize)
+
+    def numpy(self) -> np.ndarray:
+        """Return a numpy view of the shared memory, valid in both processes."""
+        return np.frombuffer(self.buffer, dtype=self.dtype).reshape(self.shape)
+
+
+class InferenceProcess:
+    """
+    Drop-in replacement for InferenceEngine, running the neural network in a separate process so that
+    inference does not compete for the GIL with video decoding, display and post-processing.
+
+    Like in InferenceEngine, only the latest clip and the latest predictions are kept. They are exchanged
+    with the inference process through shared memory buffers, rather than pickled through pipes. If the
+    inference fails, the error is sent back to this process, see `error`.
+    """
+
+    def __init__(self, net: RealtimeNeuralNet, num_threads: Optional[int] = None, clip_dtype=np.uint8,
+                 **engine_options):
+        """
+        :param net:
+            The neural network to be run by the inference process. It is copied into the child process
+            when the process is started, so it must be picklable. To run an ONNX Runtime network, pass the
+            PyTorch network along with backend='onnxruntime', so that it is converted in the child process.
+        :param num_threads:
+            Number of threads used by PyTorch in the inference process. Left unchanged if not provided.
+        :param clip_dtype:
+            Data type of the clips, e.g. uint8 for frames from a video source or float32 for frames with
+            values in [0, 255], which the shared clip buffer is allocated for.
+        :param engine_options:
+            Options of the InferenceEngine running in the inference process, e.g. use_gpu or backend.
+        """
+        if isinstance(net, OnnxRuntimeNeuralNet):
+            raise TypeError('ONNX Runtime sessions cannot be copied into the inference process. Pass the '
+                            'PyTorch network with backend="onnxruntime" instead.')
+        self._expected_frame_size = net.expected_frame_size
+        self._fps = net.fps
+        self._step_size = net.step_size
+
+        context = multiprocessing.get_context('spawn')
+        clip_shape = (1, self.step_size, *self.expected_frame_size, 3)
+        self._clip = SharedArray(context, clip_shape, dtype=clip_dtype)
+        self._clip_lock = context.Lock()
+        self._clip_ready = context.Event()
+
+        # Run a copy of the network once to get the shape of its predictions
+        predictions = InferenceEngine(copy.deepcopy(net)).infer(np.zeros(clip_shape, dtype=np.float32))
+        predictions = _remove_time_dimension(predictions)
+        self._multiple_outputs = isinstance(predictions, list)
+        if not self._multiple_outputs:
+            predictions = [predictions]
+        self._predictions = [SharedArray(context, prediction.shape) for prediction in predictions]
+        self._predictions_lock = context.Lock()
+        self._predictions_ready = context.Event()
+
+        # Clips are only replaced in this process, predictions only in the inference process
+        self._num_dropped_clips = 0
+        self._num_dropped_predictions = context.Value('i', 0, lock=False)
+
+        self._errors = context.SimpleQueue()
+        self._error = None  # received from `_errors` in `error`
+
+        self._ready = context.Event()
+        self._shutdown = context.Event()
+        self._process = context.Process(target=_run_inference_process, args=(
+            net, engine_options, num_threads, self._clip, self._clip_lock, self._clip_ready, self._predictions,
+            self._predictions_lock, self._predictions_ready, self._num_dropped_predictions, self._errors,
+            self._ready, self._shutdown,
+        ))
+
+    @property
+    def expected_frame_size(self) -> Tuple[int, int]:
+        """Return the frame size of the video source input."""
+        return self._expected_frame_size
+
+    @property
+    def fps(self) -> int:
+        """Frame rate of the inference engine's neural network."""
+        return self._fps
+
+    @property
+    def step_size(self) -> int:
+        """The step size of the inference engine's neural network."""
+        return self._step_size
+
+    @property
+    def error(self) -> Optional[Exception]:
+        """
+        The error which terminated the inference process, if any. If the process was killed, e.g. when
+        running out of memory, a RuntimeError with its exit code is returned.
+        """
+        if self._error is None and not self._errors.empty():
+            self._error = self._errors.get()
+        if self._error is None and self._process.exitcode:
+            return RuntimeError(f'The inference process terminated with exit code {self._process.exitcode}.')
+        return self._error
+
+    def is_alive(self) -> bool:
+        """Return True if the inference process is running."""
+        return self._process.is_alive()
+
+    def start(self):
+        """Start the inference process and wait until it is ready to receive clips."""
+        self._process.start()
+        while not self._ready.wait(timeout=1):
+            if not self._process.is_alive():
+                raise self.error or RuntimeError('The inference process terminated unexpectedly.')
+
+    def stop(self):
+        """Terminate the inference process."""
+        self._shutdown.set()
+        self._process.join()
+
+    def put_nowait(self, clip: np.ndarray):
+        """
+        Copy a new clip into the input buffer of the inference process, replacing the previous clip if it
+        was not processed yet.
+
+        :param clip:
+            The video frames to be inferred, of shape (1, step_size, height, width, 3) and of the data type
+            given on creation.
+        """
+        if clip.dtype != self._clip.dtype:
+            raise TypeError(f'Expected a clip of type {self._clip.dtype}, got {clip.dtype}. Set clip_dtype '
+                            f'when creating the InferenceProcess.')
+        with self._clip_lock:
+            if self._clip_ready.is_set():
+                # The previous clip was not processed yet
+                self._num_dropped_clips += 1
+            self._clip.numpy()[:] = clip
+            self._clip_ready.set()
+
+    def get_nowait(self) -> Optional[Union[np.ndarray, List[np.ndarray]]]:
+        """
+        Return the latest predictions of the inference process if they were not returned yet.
+        """
+        if not self._predictions_ready.is_set():
+            return None
+        with self._predictions_lock:
+            predictions = [prediction.numpy().copy() for prediction in self._predictions]
+            self._predictions_ready.clear()
+        return predictions if self._multiple_outputs else predictions[0]
+
+    def stats(self) -> dict:
+        """
+        Return the number of clips replaced before they were processed ('num_dropped_clips') and of
+        predictions replaced before they were retrieved ('num_dropped_predictions').
+        """
+        with self._predictions_lock:
+            num_dropped_predictions = self._num_dropped_predictions.value
+        return {'num_dropped_clips': self._num_dropped_clips, 'num_dropped_predictions': num_dropped_predictions}
+
+
+def _run_inference_process(net, engine_options, num_threads, clip, clip_lock, clip_ready, predictions,
+                           predictions_lock, predictions_ready, num_dropped_predictions, errors, ready, shutdown):
+    try:
+        _infer_clips(net, engine_options, num_threads, clip, clip_lock, clip_ready, predictions, predictions_lock,
+                     predictions_ready, num_dropped_predictions, ready, shutdown)
+    except Exception as error:
+        try:
+            errors.put(error)
+        except Exception:
+            # The error cannot be pickled
+            errors.put(RuntimeError(f'The inference process failed: {error!r}'))
+        raise
+
+
+def _infer_clips(net, engine_options, num_threads, clip, clip_lock, clip_ready, predictions, predictions_lock,
+                 predictions_ready, num_dropped_predictions, ready, shutdown):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    inference_engine = InferenceEngine(net, **engine_options)
+    ready.set()
+
+    while not shutdown.is_set():
+        if not clip_ready.wait(timeout=1):
+            continue
+        with clip_lock:
+            # Copied so that the next clip can be written while this one is processed
+            clip_copy = clip.numpy().copy()
+            clip_ready.clear()
+
+        clip_predictions = _remove_time_dimension(inference_engine.infer(clip_copy))
+        if not isinstance(clip_predictions, list):
+            clip_predictions = [clip_predictions]
+
+        with predictions_lock:
+            if predictions_ready.is_set():
+                num_dropped_predictions.value += 1
+            for prediction, clip_prediction in zip(predictions, clip_predictions):
+                prediction.numpy()[:] = clip_prediction
+            predictions_ready.set()
+
+
+def bfloat16_supported() -> bool:
+    """
+    Return True if the CPU provides native bfloat16 instructions for PyTorch.
+    """
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        # Operator not available in this version of PyTorch
+        return False
+
+
+def bfloat16_autocast_available() -> bool:
+    """
+    Return True if this version of PyTorch supports autocast on CPU, which was added in PyTorch 1.10.
+    """
+    return hasattr(torch, 'autocast')
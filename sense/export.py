@@ -0,0 +1,453 @@
+"""
+Export of streaming networks as pure functions of their input frames and internal states.
+
+Steppable convolutions keep their temporal context as hidden Python attributes, which prevents graph
+compilers from handling them. Here, backbone networks (optionally followed by their classifier heads,
+as in `Pipe`) are rewritten into a network computing `(frames, states) -> (outputs, new_states)`,
+which can be compiled and saved with TorchScript or exported to ONNX and run with ONNX Runtime.
+"""
+import inspect
+import io
+import json
+
+from typing import List
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import onnx
+    import onnxruntime
+except ImportError:
+    onnx = None
+    onnxruntime = None
+
+from sense.backbone_networks.mobilenet import ConvReLU
+from sense.backbone_networks.mobilenet import InvertedResidual
+from sense.backbone_networks.mobilenet import SteppableConv3dAs2d
+from sense.backbone_networks.mobilenet import SteppableSparseConv3dAs2d
+from sense.backbone_networks.mobilenet import StridedInflatedMobileNetV2
+from sense.backbone_networks.optimization import InferenceOnlyMixin
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.downstream_tasks.nn_utils import RealtimeNeuralNet
+
+
+def _merge_streams(x: torch.Tensor) -> torch.Tensor:
+    """
+    Merge the stream and time dimensions of a tensor of shape (S, T, ...) into a batch of frames.
+    """
+    return x.reshape([x.shape[0] * x.shape[1]] + list(x.shape[2:]))
+
+
+def _split_streams(x: torch.Tensor, num_streams: int) -> torch.Tensor:
+    """
+    Split a batch of frames back into a tensor of shape (S, T, ...).
+    """
+    return x.reshape([num_streams, -1] + list(x.shape[1:]))
+
+
+class StatelessModule(nn.Module):
+    """
+    Wrapper giving a module without temporal state the call signature of stateless layers:
+    `(x, states, new_states) -> x`.
+    """
+
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x: torch.Tensor, states: List[torch.Tensor], new_states: List[torch.Tensor]):
+        return _split_streams(self.module(_merge_streams(x)), x.shape[0])
+
+
+class StatelessSteppableConv3dAs2d(nn.Module):
+    """
+    Steppable convolution reading its internal state from `states` and appending its new internal state
+    to `new_states`. An empty list of states stands for zero-initialized states.
+    """
+
+    def __init__(self, steppable: SteppableConv3dAs2d, state_index: int):
+        super().__init__()
+        self.conv = steppable.as_conv2d()
+        self.state_index = state_index
+        self.temporal_footprint = steppable.temporal_footprint
+        self.kernel_size_temporal = steppable.kernel_size_temporal
+        self.stride_temporal = steppable.stride_temporal
+        self.sparse = isinstance(steppable, SteppableSparseConv3dAs2d)
+        self.channel_boundaries = (steppable.channel_boundaries(steppable.in_channels) if self.sparse
+                                   else [0, steppable.in_channels])
+
+    def forward(self, x: torch.Tensor, states: List[torch.Tensor], new_states: List[torch.Tensor]):
+        if len(states) > 0:
+            state = states[self.state_index]
+        else:
+            state = x.new_zeros([x.shape[0], self.temporal_footprint, x.shape[2], x.shape[3], x.shape[4]])
+        x = torch.cat([state, x], dim=1)
+        new_states.append(x[:, x.shape[1] - self.temporal_footprint:])
+
+        if self.sparse:
+            frames = self.shift_frames(x)
+        else:
+            frames = self.rearrange_frames(x)
+        return _split_streams(self.conv(frames), x.shape[0])
+
+    def rearrange_frames(self, x: torch.Tensor):
+        num_streams, num_frames, num_channels, height, width = x.shape
+        x = x.unfold(1, self.kernel_size_temporal, self.stride_temporal).permute(0, 1, 5, 2, 3, 4)
+        return x.reshape(num_streams * x.shape[1], self.kernel_size_temporal * num_channels, height, width)
+
+    def shift_frames(self, x: torch.Tensor):
+        num_windows = (x.shape[1] - self.kernel_size_temporal) // self.stride_temporal + 1
+        first_frame = (x.shape[1] - self.kernel_size_temporal) % self.stride_temporal
+        last_frame = first_frame + (num_windows - 1) * self.stride_temporal + 1
+        channel_groups = []
+        for offset in range(self.kernel_size_temporal):
+            channel_groups.append(x[:, first_frame + offset:last_frame + offset:self.stride_temporal,
+                                    self.channel_boundaries[offset]:self.channel_boundaries[offset + 1]])
+        return _merge_streams(torch.cat(channel_groups, dim=2))
+
+
+class StatelessInvertedResidual(nn.Module):
+
+    def __init__(self, inverted_residual: InvertedResidual, state_index: int):
+        super().__init__()
+        self.use_residual = inverted_residual.use_residual
+        self.temporal_stride = inverted_residual.temporal_stride
+        self.layers = nn.ModuleList(_stateless_layers(inverted_residual.conv, state_index))
+        self.num_states = sum(isinstance(layer, StatelessSteppableConv3dAs2d) for layer in self.layers)
+
+    def forward(self, x: torch.Tensor, states: List[torch.Tensor], new_states: List[torch.Tensor]):
+        output_ = x
+        for layer in self.layers:
+            output_ = layer(output_, states, new_states)
+        if self.use_residual:
+            n_in = x.shape[1]
+            n_out = output_.shape[1]
+            if self.temporal_stride:
+                output_ = output_ + x[:, n_in - 2 * n_out + 1::2]
+            else:
+                output_ = output_ + x[:, n_in - n_out:]
+        return output_
+
+
+def _stateless_layers(layers: nn.Sequential, state_index: int) -> List[nn.Module]:
+    stateless_layers = []
+    for layer in layers:
+        if isinstance(layer, InferenceOnlyMixin):
+            raise ValueError('Optimized or quantized networks cannot be exported, export the original network.')
+        if isinstance(layer, ConvReLU) and isinstance(layer[0], SteppableConv3dAs2d):
+            stateless_layers.append(StatelessSteppableConv3dAs2d(layer[0], state_index))
+            stateless_layers.append(StatelessModule(layer[1]))
+            state_index += 1
+        elif isinstance(layer, InvertedResidual):
+            stateless_layers.append(StatelessInvertedResidual(layer, state_index))
+            state_index += stateless_layers[-1].num_states
+        else:
+            stateless_layers.append(StatelessModule(layer))
+    return stateless_layers
+
+
+class StatelessNetwork(nn.Module):
+    """
+    Backbone network followed by optional classifier heads, computing
+    `(frames, states) -> (outputs, new_states)`.
+
+    Internally, all layers process several independent video streams at once, with tensors of shape
+    (S, T, ...) and internal states holding one slot per stream (see `forward_streams`). `forward`
+    processes the frames of a single stream.
+
+    Outputs are always returned as a list, with the features of the backbone if there is no head.
+    Metadata needed to run the network in `InferenceEngine` is kept as attributes.
+    """
+
+    def __init__(self, net: Union[Pipe, StridedInflatedMobileNetV2]):
+        super().__init__()
+        if isinstance(net, Pipe):
+            backbone_network = net.feature_extractor
+            heads = net.feature_converter if isinstance(net.feature_converter, list) else [net.feature_converter]
+            self.multiple_outputs = isinstance(net.feature_converter, list)
+        else:
+            backbone_network = net
+            heads = []
+            self.multiple_outputs = False
+
+        self.layers = nn.ModuleList(_stateless_layers(backbone_network.cnn, state_index=0))
+        self.heads = nn.ModuleList(heads)
+        self.fps = backbone_network.fps
+        self.step_size = backbone_network.step_size
+        self.expected_frame_size = tuple(backbone_network.expected_frame_size)
+        self.num_required_frames = backbone_network.num_required_frames_per_layer_padding[0]
+
+    def forward(self, frames: torch.Tensor,
+                states: List[torch.Tensor]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        outputs, new_states = self.forward_streams(frames.unsqueeze(0), states)
+        return [output[0] for output in outputs], new_states
+
+    @torch.jit.export
+    def forward_streams(self, frames: torch.Tensor,
+                        states: List[torch.Tensor]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Process the frames of several independent video streams in a single batch.
+
+        :param frames:
+            Frames of shape (S, T, 3, H, W), with the same number of frames T for all S streams.
+        :param states:
+            Internal states with one slot per stream, of shape (S, ...), as previously returned for the
+            same streams in the same order. Empty for zero-initialized states.
+        :return:
+            Outputs of shape (S, T', ...) and the new internal states.
+        """
+        new_states: List[torch.Tensor] = []
+        x = frames
+        for layer in self.layers:
+            x = layer(x, states, new_states)
+
+        outputs: List[torch.Tensor] = []
+        features = _merge_streams(x)
+        for head in self.heads:
+            outputs.append(_split_streams(head(features), x.shape[0]))
+        if len(outputs) == 0:
+            outputs.append(x)
+        return outputs, new_states
+
+    @torch.jit.export
+    def preprocess(self, clip: torch.Tensor) -> torch.Tensor:
+        """
+        Same as the `preprocess` method of the backbone network, for a float tensor of shape
+        (1, T, H, W, 3).
+        """
+        return (clip[0] / 255.).permute(0, 3, 1, 2).contiguous()
+
+
+METADATA_ATTRIBUTES = ['multiple_outputs', 'fps', 'step_size', 'expected_frame_size', 'num_required_frames']
+
+
+def export_torchscript(net: Union[Pipe, StridedInflatedMobileNetV2], path: str):
+    """
+    Compile a backbone network, optionally with its classifier heads, into a stateless TorchScript module
+    and save it to the given path. The exported network can then be loaded with `load_torchscript_network`.
+
+    Classifier heads are traced on the features of an example clip, so they must not contain any data
+    dependent control flow.
+
+    :param net:
+        A backbone network or a Pipe of a backbone network and its classifier heads, in full precision.
+    :param path:
+        Path of the TorchScript file to be written.
+    """
+    net.eval()
+    stateless_network = StatelessNetwork(net).eval()
+
+    example_frames = torch.zeros(1, stateless_network.num_required_frames, 3, *stateless_network.expected_frame_size)
+    with torch.no_grad():
+        features = example_frames
+        for layer in stateless_network.layers:
+            features = layer(features, [], [])
+        stateless_network.heads = nn.ModuleList([torch.jit.trace(head, _merge_streams(features))
+                                                 for head in stateless_network.heads])
+
+    scripted_network = torch.jit.script(stateless_network)
+    if hasattr(torch.jit, 'freeze'):
+        # Inline parameters as constants and fold them where possible (available from PyTorch 1.8)
+        scripted_network = torch.jit.freeze(scripted_network, preserved_attrs=['preprocess', 'forward_streams',
+                                                                               *METADATA_ATTRIBUTES])
+    scripted_network.save(path)
+
+
+class TorchScriptNeuralNet(RealtimeNeuralNet):
+    """
+    Runs a network exported with `export_torchscript`, keeping track of its internal states between
+    calls so that it can be used like the original network.
+    """
+
+    def __init__(self, scripted_network: torch.jit.ScriptModule):
+        super().__init__()
+        self.scripted_network = scripted_network
+        self.states = []
+
+    def forward(self, frames: torch.Tensor):
+        outputs, self.states = self.scripted_network(frames, self.states)
+        return outputs if self.scripted_network.multiple_outputs else outputs[0]
+
+    def preprocess(self, clip: np.ndarray):
+        return self.scripted_network.preprocess(torch.from_numpy(np.asarray(clip, dtype=np.float32)))
+
+    def reset(self):
+        self.states = []
+        return self
+
+    def train(self, mode=True):
+        super().train(mode)
+        return self.reset()
+
+    @property
+    def expected_frame_size(self) -> Tuple[int, int]:
+        return tuple(self.scripted_network.expected_frame_size)
+
+    @property
+    def fps(self) -> int:
+        return self.scripted_network.fps
+
+    @property
+    def step_size(self) -> int:
+        return self.scripted_network.step_size
+
+    @property
+    def num_required_frames_per_layer_padding(self):
+        return {0: self.scripted_network.num_required_frames}
+
+
+class FlatStatelessNetwork(nn.Module):
+    """
+    StatelessNetwork taking each internal state as a separate input and returning the outputs followed
+    by the new internal states, as required for the export to ONNX.
+    """
+
+    def __init__(self, stateless_network: StatelessNetwork):
+        super().__init__()
+        self.stateless_network = stateless_network
+
+    def forward(self, frames, *states):
+        outputs, new_states = self.stateless_network(frames, list(states))
+        return (*outputs, *new_states)
+
+
+def _check_onnx_installed():
+    if onnx is None or onnxruntime is None:
+        raise ImportError('The onnx and onnxruntime packages are required to run networks with ONNX Runtime.')
+
+
+def serialize_onnx(net: Union[Pipe, StridedInflatedMobileNetV2], opset_version: int = 11) -> bytes:
+    """
+    Export a backbone network, optionally with its classifier heads, into a stateless ONNX model that
+    processes one inference step of `step_size` frames at the expected frame size of the network.
+
+    The model takes the frames followed by the internal states as inputs and returns the outputs followed
+    by the new internal states. Metadata needed to run it in `InferenceEngine` is stored in the model
+    properties.
+
+    :param net:
+        A backbone network or a Pipe of a backbone network and its classifier heads, in full precision.
+    :param opset_version:
+        ONNX opset used for the export.
+    :return:
+        The serialized ONNX model.
+    """
+    _check_onnx_installed()
+    net.eval()
+    stateless_network = StatelessNetwork(net).eval()
+
+    frames = torch.zeros(stateless_network.step_size, 3, *stateless_network.expected_frame_size)
+    with torch.no_grad():
+        outputs, states = stateless_network(frames, [])
+
+    input_names = ['frames'] + [f'state_{index}' for index in range(len(states))]
+    output_names = ([f'output_{index}' for index in range(len(outputs))]
+                    + [f'new_state_{index}' for index in range(len(states))])
+    export_options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Recent versions of PyTorch default to an exporter based on torch.export
+        export_options['dynamo'] = False
+    onnx_file = io.BytesIO()
+    torch.onnx.export(FlatStatelessNetwork(stateless_network), (frames, *states), onnx_file,
+                      input_names=input_names, output_names=output_names, opset_version=opset_version,
+                      **export_options)
+
+    onnx_model = onnx.load_from_string(onnx_file.getvalue())
+    onnx.helper.set_model_props(onnx_model, {
+        attribute: json.dumps(getattr(stateless_network, attribute)) for attribute in METADATA_ATTRIBUTES
+    })
+    return onnx_model.SerializeToString()
+
+
+def export_onnx(net: Union[Pipe, StridedInflatedMobileNetV2], path: str, opset_version: int = 11):
+    """
+    Export a backbone network, optionally with its classifier heads, into a stateless ONNX model and save
+    it to the given path. The exported network can then be loaded with `load_onnx_network`.
+
+    :param net:
+        A backbone network or a Pipe of a backbone network and its classifier heads, in full precision.
+    :param path:
+        Path of the ONNX file to be written.
+    :param opset_version:
+        ONNX opset used for the export.
+    """
+    with open(path, 'wb') as f:
+        f.write(serialize_onnx(net, opset_version))
+
+
+class OnnxRuntimeNeuralNet(RealtimeNeuralNet):
+    """
+    Runs a network exported with `export_onnx` on the CPU execution provider of ONNX Runtime, keeping
+    track of its internal states between calls so that it can be used like the original network.
+
+    Since the exported model has static input shapes, clips are processed one inference step at a time,
+    and their number of frames must be a multiple of `step_size`.
+    """
+
+    def __init__(self, onnx_model: Union[str, bytes]):
+        """
+        :param onnx_model:
+            Path to an ONNX file or serialized ONNX model, as returned by `serialize_onnx`.
+        """
+        super().__init__()
+        _check_onnx_installed()
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_model, session_options,
+                                                    providers=['CPUExecutionProvider'])
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.metadata = {attribute: json.loads(metadata[attribute]) for attribute in METADATA_ATTRIBUTES}
+        self.state_names = [state.name for state in self.session.get_inputs()[1:]]
+        self.num_outputs = len(self.session.get_outputs()) - len(self.state_names)
+        self.initial_states = {state.name: np.zeros(state.shape, dtype=np.float32)
+                               for state in self.session.get_inputs()[1:]}
+        self.states = self.initial_states
+
+    def forward(self, frames: torch.Tensor):
+        frames = frames.numpy()
+        if frames.shape[0] % self.step_size != 0:
+            raise ValueError(f'ONNX Runtime networks process clips of a multiple of {self.step_size} frames, '
+                             f'got {frames.shape[0]} frames.')
+
+        outputs = [[] for _ in range(self.num_outputs)]
+        for step in np.split(frames, frames.shape[0] // self.step_size):
+            results = self.session.run(None, {'frames': step, **self.states})
+            self.states = dict(zip(self.state_names, results[self.num_outputs:]))
+            for output, result in zip(outputs, results):
+                output.append(result)
+
+        outputs = [torch.from_numpy(np.concatenate(output)) for output in outputs]
+        return outputs if self.metadata['multiple_outputs'] else outputs[0]
+
+    def preprocess(self, clip: np.ndarray):
+        clip = np.asarray(clip[0], dtype=np.float32) / 255.
+        return torch.from_numpy(np.ascontiguousarray(clip.transpose(0, 3, 1, 2)))
+
+    def reset(self):
+        self.states = self.initial_states
+        return self
+
+    def train(self, mode=True):
+        super().train(mode)
+        return self.reset()
+
+    @property
+    def expected_frame_size(self) -> Tuple[int, int]:
+        return tuple(self.metadata['expected_frame_size'])
+
+    @property
+    def fps(self) -> int:
+        return self.metadata['fps']
+
+    @property
+    def step_size(self) -> int:
+        return self.metadata['step_size']
+
+    @property
+    def num_required_frames_per_layer_padding(self):
+        return {0: self.step_size}
@@ -1,7 +1,10 @@
 import glob
+import hashlib
 import itertools
 import json
+import multiprocessing
 import os
+from typing import Optional
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -14,7 +17,11 @@ from sklearn.metrics import confusion_matrix
 from sense import camera
 from sense import engine
 from sense import SPLITS
+from sense.backbone_networks.mobilenet import InvertedResidual
+from sense.backbone_networks.mobilenet import SteppableConv3dAs2d
+from sense.backbone_networks.mobilenet import SteppableSparseConv3dAs2d
 from sense.engine import InferenceEngine
+from sense.loading import ModelConfig
 from sense.utils import clean_pipe_state_dict_key
 from tools import directories
 from tools.sense_studio import utils
@@ -22,6 +29,10 @@ from tools.sense_studio import utils
 MODEL_TEMPORAL_DEPENDENCY = 45
 MODEL_TEMPORAL_STRIDE = 4
 
+FEATURE_STORE_DATA = 'feature_store.npy'
+FEATURE_STORE_INDEX = 'feature_store_index.json'
+FEATURE_CACHE_MANIFEST = 'feature_cache_manifest.json'
+
 
 def set_internal_padding_false(module):
     """
@@ -31,6 +42,202 @@ def set_internal_padding_false(module):
         module.internal_padding = False
 
 
+def set_batch_size(net, batch_size):
+    """
+    Set the number of sequences whose frames are stacked along the first dimension of the inputs of the
+    steppable layers, so that a whole batch of sequences can go through the network in a single forward
+    pass. Only supported with internal padding turned off, see `set_internal_padding_false`.
+    """
+    for module in net.modules():
+        if isinstance(module, (SteppableConv3dAs2d, InvertedResidual)):
+            module.batch_size = batch_size
+
+
+def _supports_batched_sequences(net):
+    return not any(getattr(module, 'internal_padding', False) for module in net.modules())
+
+
+def get_num_output_frames(net, num_frames):
+    """
+    Return the number of outputs of a network without internal padding for an input of `num_frames` frames.
+    """
+    for module in net.modules():
+        if isinstance(module, SteppableConv3dAs2d):
+            num_frames = max(0, (num_frames - module.kernel_size_temporal) // module.stride_temporal + 1)
+    return num_frames
+
+
+def get_padding_multiple(net):
+    """
+    Return the number of frames of which the padding at the beginning of the inputs of a network without
+    internal padding must be a multiple, for the outputs of the original frames to be unchanged.
+
+    The temporal windows of sparse steppable layers are aligned on the last frame, so that padding does not
+    shift them. Those of the other steppable layers start from the first frame, so that with a temporal
+    stride, padding must be a multiple of the product of the temporal strides up to these layers.
+    """
+    padding_multiple = 1
+    total_stride = 1
+    for module in net.modules():
+        if isinstance(module, SteppableConv3dAs2d):
+            total_stride *= module.stride_temporal
+            if module.stride_temporal > 1 and not isinstance(module, SteppableSparseConv3dAs2d):
+                padding_multiple = total_stride
+    return padding_multiple
+
+
+def pad_collate(batch):
+    """
+    Collate samples of a FeaturesDataset with features of different lengths, e.g. whole videos for validation.
+
+    Features are padded with zeros at the beginning, since the temporal windows of sparse steppable layers
+    are aligned on the last frame: the last outputs for padded features are then the same as for the original
+    features. This does not hold for networks with temporally strided layers whose windows start from the
+    first frame, unless the padding is a multiple of `get_padding_multiple`, see `run_epoch`. Temporal
+    annotations are padded at the end with -100, as for videos without annotations.
+
+    :return:
+        Features of shape (batch_size, max_num_frames, ...), labels, temporal annotations of shape
+        (batch_size, max_num_annotations) and the number of frames of each sample.
+    """
+    features, labels, temporal_annotations = zip(*batch)
+    num_frames = [len(sample_features) for sample_features in features]
+    padded_features = np.zeros((len(batch), max(num_frames), *features[0].shape[1:]), dtype=features[0].dtype)
+    for sample_features, padded_sample_features in zip(features, padded_features):
+        padded_sample_features[len(padded_sample_features) - len(sample_features):] = sample_features
+
+    padded_annotations = np.full((len(batch), max(map(len, temporal_annotations))), -100, dtype=np.int64)
+    for annotation, padded_annotation in zip(temporal_annotations, padded_annotations):
+        padded_annotation[:len(annotation)] = annotation
+
+    return [torch.from_numpy(padded_features), torch.tensor(labels), torch.from_numpy(padded_annotations),
+            torch.tensor(num_frames)]
+
+
+def masked_mean(outputs, mask):
+    """
+    Average outputs of shape (batch_size, num_frames, num_classes) over the frames selected by a boolean
+    mask of shape (batch_size, num_frames).
+    """
+    mask = mask.unsqueeze(-1).to(outputs.dtype)
+    return (outputs * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+def masked_frame_loss(criterion, outputs, targets, mask):
+    """
+    Return the loss of each sample for per-frame outputs of shape (batch_size, num_frames, num_classes) and
+    targets of shape (batch_size, num_frames), averaged over the frames selected by a boolean mask of shape
+    (batch_size, num_frames) as the criterion would for each sample separately.
+    """
+    return torch.stack([criterion(sample_outputs[sample_mask], sample_targets[sample_mask])
+                        for sample_outputs, sample_targets, sample_mask in zip(outputs, targets, mask)])
+
+
+class FeatureStore:
+    """
+    Consolidated store of the features of all videos in a features directory, i.e. for one split, model and
+    number of finetuned layers. The features of all videos are concatenated along the time dimension into a
+    single memory-mapped data file, and an index gives the offset and number of rows of each video. Reading a
+    window of features then only reads these rows, instead of opening and reading a whole file per video.
+
+    The per-video feature files are kept, and the store is rebuilt by `build_feature_store` whenever one
+    of them is added, removed or modified. Since the store doubles the disk space taken by the features, it
+    is only used on request, see the `use_feature_store` option of `generate_data_loader`.
+    """
+
+    def __init__(self, features_dir):
+        """
+        :param features_dir:
+            Directory containing the store, as built by `build_feature_store`.
+        """
+        self.features_dir = features_dir
+        with open(os.path.join(features_dir, FEATURE_STORE_INDEX)) as f:
+            self.index = json.load(f)
+        self._data = None  # mapped on first access, e.g. in each data loader worker
+
+    def _key(self, path_features):
+        return os.path.relpath(path_features, self.features_dir).replace(os.sep, '/')
+
+    def __contains__(self, path_features):
+        return self._key(path_features) in self.index
+
+    def get(self, path_features) -> np.ndarray:
+        """
+        Return the features of the video stored at the given path as a read-only memory-mapped array, from
+        which windows can be sliced without reading the other rows.
+        """
+        if self._data is None:
+            self._data = np.load(os.path.join(self.features_dir, FEATURE_STORE_DATA), mmap_mode='r')
+        entry = self.index[self._key(path_features)]
+        return self._data[entry['offset']:entry['offset'] + entry['length']]
+
+
+def build_feature_store(features_dir):
+    """
+    Consolidate the features of all videos in the given features directory into a `FeatureStore`, unless
+    an up-to-date store already exists. The store is rebuilt entirely if any feature file changed.
+
+    :param features_dir:
+        Directory with one sub-directory of .npy feature files per label.
+    :return:
+        The feature store, or None if there are no features in the directory.
+    """
+    paths_features = sorted(glob.glob(os.path.join(features_dir, '*', '*.npy')))
+    if not paths_features:
+        return None
+
+    file_stats = {}
+    for path_features in paths_features:
+        stat = os.stat(path_features)
+        key = os.path.relpath(path_features, features_dir).replace(os.sep, '/')
+        file_stats[key] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    path_index = os.path.join(features_dir, FEATURE_STORE_INDEX)
+    path_data = os.path.join(features_dir, FEATURE_STORE_DATA)
+    if os.path.exists(path_index) and os.path.exists(path_data):
+        with open(path_index) as f:
+            index = json.load(f)
+        if {key: {'mtime_ns': entry['mtime_ns'], 'size': entry['size']}
+                for key, entry in index.items()} == file_stats:
+            return FeatureStore(features_dir)
+
+    # Only read the headers to find the total number of rows
+    headers = [_read_npy_header(path_features) for path_features in paths_features]
+    dtype = headers[0][1]
+    row_shape = headers[0][0][1:]
+    if any(shape[1:] != row_shape for shape, _ in headers):
+        raise ValueError(f'Features in {features_dir} do not all have the same shape.')
+
+    index = {}
+    path_data_tmp = path_data + '.tmp'
+    data = np.lib.format.open_memmap(path_data_tmp, mode='w+', dtype=dtype,
+                                     shape=(sum(shape[0] for shape, _ in headers), *row_shape))
+    offset = 0
+    for path_features, (key, stats), (shape, _) in zip(paths_features, file_stats.items(), headers):
+        data[offset:offset + shape[0]] = np.load(path_features)
+        index[key] = {'offset': offset, 'length': shape[0], **stats}
+        offset += shape[0]
+    data.flush()
+    del data
+
+    # Replace the previous store only once the new one is complete
+    os.replace(path_data_tmp, path_data)
+    with open(path_index + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path_index + '.tmp', path_index)
+    return FeatureStore(features_dir)
+
+
+def _read_npy_header(path):
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
 class FeaturesDataset(torch.utils.data.Dataset):
     """ Features dataset.
 
@@ -43,11 +250,14 @@ class FeaturesDataset(torch.utils.data.Dataset):
 
     For training with temporal annotations, samples from the background label and non-background label
     are returned with approximately the same probability.
+
+    If a FeatureStore is given, features are sliced from it instead of being loaded from each file.
     """
 
     def __init__(self, files, labels, temporal_annotation, full_network_minimum_frames,
-                 num_timesteps=None, stride=4):
+                 num_timesteps=None, stride=4, feature_store=None):
         self.files = files
+        self.feature_store = feature_store
         self.labels = labels
         self.num_timesteps = num_timesteps
         self.stride = stride
@@ -59,7 +269,10 @@ class FeaturesDataset(torch.utils.data.Dataset):
         return len(self.files)
 
     def __getitem__(self, idx):
-        features = np.load(self.files[idx])
+        if self.feature_store is not None and self.files[idx] in self.feature_store:
+            features = self.feature_store.get(self.files[idx])
+        else:
+            features = np.load(self.files[idx])
         num_preds = features.shape[0]
 
         temporal_annotation = self.temporal_annotations[idx]
@@ -94,13 +307,15 @@ class FeaturesDataset(torch.utils.data.Dataset):
             # will assume that we need only one output
         if temporal_annotation is None or len(temporal_annotation) == 0:
             temporal_annotation = np.array([-100])
+        # Only read the selected rows from a memory-mapped store
+        features = np.array(features)
         return [features, self.labels[idx], temporal_annotation]
 
 
 def generate_data_loader(project_config, features_dir, tags_dir, label_names, label2int,
                          label2int_temporal_annotation, num_timesteps=5, batch_size=16, shuffle=True,
                          stride=4, temporal_annotation_only=False,
-                         full_network_minimum_frames=MODEL_TEMPORAL_DEPENDENCY):
+                         full_network_minimum_frames=MODEL_TEMPORAL_DEPENDENCY, use_feature_store=False):
     # Find pre-computed features and derive corresponding labels
     labels_string = []
     temporal_annotation = []
@@ -147,28 +362,54 @@ def generate_data_loader(project_config, features_dir, tags_dir, label_names, la
         labels = [x for x, y in zip(labels, temporal_annotation) if y is not None]
         temporal_annotation = [x for x in temporal_annotation if x is not None]
 
+    if num_timesteps is None and not shuffle and batch_size > 1:
+        # Batch whole videos of similar lengths together to limit padding
+        order = sorted(range(len(features)), key=lambda index: _read_npy_header(features[index])[0][0])
+        features = [features[index] for index in order]
+        labels = [labels[index] for index in order]
+        temporal_annotation = [temporal_annotation[index] for index in order]
+
     # Build data-loader
+    feature_store = build_feature_store(features_dir) if use_feature_store else None
     dataset = FeaturesDataset(features, labels, temporal_annotation,
                               num_timesteps=num_timesteps, stride=stride,
-                              full_network_minimum_frames=full_network_minimum_frames)
+                              full_network_minimum_frames=full_network_minimum_frames,
+                              feature_store=feature_store)
     try:
-        return torch.utils.data.DataLoader(dataset, shuffle=shuffle, batch_size=batch_size)
+        # Whole videos of different lengths are padded to be processed in batches
+        collate_fn = pad_collate if num_timesteps is None and batch_size > 1 else None
+        return torch.utils.data.DataLoader(dataset, shuffle=shuffle, batch_size=batch_size, collate_fn=collate_fn)
     except ValueError:
         # The project is temporal, but annotations do not exist for train or valid.
         return None
 
 
-def extract_frames(video_path, inference_engine, path_frames=None, return_frames=True):
+def prefetch_frames(video_path, inference_engine):
+    """
+    Start decoding the frames of a video in a separate thread, to be read later on by `extract_frames`.
+    Only a few frames are decoded ahead, as for live camera streams, so that the frames of the next video
+    are not all held in memory along with those of the current one.
+    """
+    video_source = camera.VideoSource(size=inference_engine.expected_frame_size,
+                                      filename=video_path,
+                                      target_fps=inference_engine.fps)
+    prefetching_video_source = camera.PrefetchingVideoSource(video_source, queue_size=4)
+    prefetching_video_source.start()
+    return prefetching_video_source
+
+
+def extract_frames(video_path, inference_engine, path_frames=None, return_frames=True, video_source=None):
     save_frames = path_frames is not None and not os.path.exists(path_frames)
 
     if not save_frames and not return_frames:
         # Nothing to do
         return None
 
-    # Read frames from video
-    video_source = camera.VideoSource(size=inference_engine.expected_frame_size,
-                                      filename=video_path,
-                                      target_fps=inference_engine.fps)
+    # Read frames from video, unless they are already being decoded by the given video source
+    if video_source is None:
+        video_source = camera.VideoSource(size=inference_engine.expected_frame_size,
+                                          filename=video_path,
+                                          target_fps=inference_engine.fps)
     frames = []
 
     while True:
@@ -221,8 +462,117 @@ def compute_features(path_features, inference_engine, frames, batch_size=None, n
     np.save(path_features, features)
 
 
+def compute_file_hash(path, chunk_size=2 ** 20):
+    """
+    Return the SHA-256 hash of the content of a file, read in chunks of `chunk_size` bytes.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def compute_weights_hash(net):
+    """
+    Return the SHA-256 hash of the names and values of all the weights and buffers of a network.
+    """
+    weights_hash = hashlib.sha256()
+    for name, value in sorted(net.state_dict().items()):
+        weights_hash.update(name.encode())
+        weights_hash.update(value.detach().cpu().numpy().tobytes())
+    return weights_hash.hexdigest()
+
+
+def get_feature_cache_key(video_hash, model_config, weights_hash, num_layers_to_finetune, num_timesteps):
+    """
+    Return everything the features of a video depend on: the content of the video, the backbone network
+    and its weights, and the parameters of the extraction.
+
+    :param video_hash:
+        Hash of the content of the video, see `FeatureCacheManifest.get_video_hash`.
+    """
+    return {
+        'video_sha256': video_hash,
+        'model': model_config.combined_model_name if model_config else None,
+        'weights_sha256': weights_hash,
+        'num_layers_to_finetune': num_layers_to_finetune,
+        'num_timesteps': num_timesteps,
+    }
+
+
+class FeatureCacheManifest:
+    """
+    Manifest of the features files in a directory, recording the key each file was computed from, see
+    `get_feature_cache_key`. Features are only reused if their key is unchanged, so that a video re-recorded
+    under the same name or a change of the backbone weights triggers a new extraction of the affected
+    features, while all other features are kept.
+
+    The size and modification time of each video are recorded along with its hash, so that videos are
+    only hashed again once one of them changed.
+    """
+
+    def __init__(self, features_dir):
+        """
+        :param features_dir:
+            Directory containing the features files and the manifest.
+        """
+        self.path = os.path.join(features_dir, FEATURE_CACHE_MANIFEST)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                # Entries of manifests saved without the video stats are dropped, their features recomputed
+                self.entries = {name: entry for name, entry in json.load(f).items() if 'key' in entry}
+        self._video_stats = {}  # filled in `get_video_hash`
+
+    def get_video_hash(self, path_features, video_path) -> str:
+        """
+        Return the hash of the content of the video the given features file is computed from. The hash
+        recorded in the manifest is reused if the size and modification time of the video are unchanged.
+        """
+        name = os.path.basename(path_features)
+        stat = os.stat(video_path)
+        video_stat = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        self._video_stats[name] = video_stat
+
+        entry = self.entries.get(name)
+        if entry and entry.get('video_stat') == video_stat:
+            return entry['key']['video_sha256']
+
+        video_hash = compute_file_hash(video_path)
+        if entry and entry['key']['video_sha256'] == video_hash:
+            # Only the modification time changed, e.g. the video was copied
+            entry['video_stat'] = video_stat
+            self._save()
+        return video_hash
+
+    def is_valid(self, path_features, key) -> bool:
+        """
+        Return True if the features file exists and was computed from the given key.
+        """
+        entry = self.entries.get(os.path.basename(path_features))
+        return os.path.isfile(path_features) and entry is not None and entry['key'] == key
+
+    def update(self, path_features, key):
+        """
+        Record the key the given features file was just computed from and save the manifest, so that
+        features computed before an interruption are not recomputed.
+        """
+        name = os.path.basename(path_features)
+        self.entries[name] = {'key': key, 'video_stat': self._video_stats.get(name)}
+        self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        path_tmp = f'{self.path}.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(path_tmp, self.path)
+
+
 def compute_frames_and_features(inference_engine: InferenceEngine, project_path: str, videos_dir: str,
-                                frames_dir: str, features_dir: str):
+                                frames_dir: str, features_dir: str, num_layers_to_finetune: int,
+                                model_config: Optional[ModelConfig] = None):
     """
     Split the videos in the given directory into frames and compute features on each frame.
     Results are stored in the given directories for frames and features.
@@ -238,6 +588,12 @@ def compute_frames_and_features(inference_engine: InferenceEngine, project_path:
         numbered .jpg files in there.
     :param features_dir:
         Directory where computed features should be stored. One .npy file will be created per video.
+    :param num_layers_to_finetune:
+        Number of final layers removed from the backbone network, recorded in the feature cache manifest. Must be
+        the value the features directory was created for, see `directories.get_features_dir`, so that the cached
+        features are shared with the training script.
+    :param model_config:
+        Configuration of the backbone network run by the inference engine, recorded in the feature cache manifest.
     """
     assisted_tagging = utils.get_project_setting(project_path, 'assisted_tagging')
 
@@ -245,6 +601,9 @@ def compute_frames_and_features(inference_engine: InferenceEngine, project_path:
     os.makedirs(features_dir, exist_ok=True)
     os.makedirs(frames_dir, exist_ok=True)
 
+    manifest = FeatureCacheManifest(features_dir)
+    weights_hash = compute_weights_hash(inference_engine.net) if assisted_tagging else None
+
     # Loop through all videos for the given class-label
     videos = glob.glob(os.path.join(videos_dir, '*.mp4'))
     num_videos = len(videos)
@@ -256,7 +615,12 @@ def compute_frames_and_features(inference_engine: InferenceEngine, project_path:
         path_frames = os.path.join(frames_dir, video_name)
         path_features = os.path.join(features_dir, f'{video_name}.npy')
 
-        features_needed = (assisted_tagging and not os.path.exists(path_features))
+        features_needed = False
+        if assisted_tagging:
+            video_hash = manifest.get_video_hash(path_features, video_path)
+            cache_key = get_feature_cache_key(video_hash, model_config, weights_hash, num_layers_to_finetune,
+                                              num_timesteps=1)
+            features_needed = not manifest.is_valid(path_features, cache_key)
 
         frames = extract_frames(video_path=video_path,
                                 inference_engine=inference_engine,
@@ -269,40 +633,147 @@ def compute_frames_and_features(inference_engine: InferenceEngine, project_path:
                              frames=frames,
                              batch_size=64,
                              num_timesteps=1)
+            manifest.update(path_features, cache_key)
+
+
+# Inference engine of a feature extraction worker process, created in `_init_feature_worker`
+_worker_inference_engine = None
+
+
+def _init_feature_worker(net, num_threads):
+    global _worker_inference_engine
+    torch.set_num_threads(num_threads)
+    _worker_inference_engine = engine.InferenceEngine(net, use_gpu=False)
+
+
+def _compute_video_features(task):
+    video_path, path_features, num_timesteps = task
+    frames = extract_frames(video_path=video_path, inference_engine=_worker_inference_engine)
+    compute_features(path_features=path_features,
+                     inference_engine=_worker_inference_engine,
+                     frames=frames,
+                     batch_size=16,
+                     num_timesteps=num_timesteps)
+    return video_path, path_features
+
+
+def _extract_features_serially(videos_to_process, inference_engine, num_timesteps, log_fn, on_features_computed):
+    num_videos = len(videos_to_process)
+    videos_iterator = iter(videos_to_process)
+    next_video_path, _ = next(videos_iterator, (None, None))
+    next_video_source = prefetch_frames(next_video_path, inference_engine) if next_video_path else None
+    decode_stall_time = 0.
+    compute_stall_time = 0.
+
+    for video_index, (video_path, path_features) in enumerate(videos_to_process):
+        log_fn(f'\rExtract features from video {video_index + 1} / {num_videos}')
+
+        # Read all frames
+        video_source = next_video_source
+        frames = extract_frames(video_path=video_path,
+                                inference_engine=inference_engine,
+                                video_source=video_source)
+
+        # Decode the next video while computing the features of this one
+        next_video_path, _ = next(videos_iterator, (None, None))
+        next_video_source = prefetch_frames(next_video_path, inference_engine) if next_video_path else None
+
+        compute_features(path_features=path_features,
+                         inference_engine=inference_engine,
+                         frames=frames,
+                         batch_size=16,
+                         num_timesteps=num_timesteps)
+        on_features_computed(video_path, path_features)
+        video_source.join()
+        decode_stall_time += video_source.decode_stall_time
+        compute_stall_time += video_source.compute_stall_time
+
+    log_fn(f'\nWaited {decode_stall_time:.2f}s for video decoding, decoding waited {compute_stall_time:.2f}s '
+           f'for feature computation\n')
 
 
 def extract_features(path_in, label_names, model_config, net, num_layers_finetune, use_gpu, num_timesteps=1,
-                     log_fn=print):
-    # Create inference engine
-    inference_engine = engine.InferenceEngine(net, use_gpu=use_gpu)
-
-    # extract features
-    for split in SPLITS:
-        video_files = []
-        videos_dir = directories.get_videos_dir(path_in, split)
-        features_dir = directories.get_features_dir(path_in, split, model_config, num_layers_finetune)
-        for label in label_names:
-            video_files.extend(glob.glob(os.path.join(videos_dir, label, "*.mp4")))
-
-        num_videos = len(video_files)
-        log_fn(f"\nFound {num_videos} videos to process in the {split}-set")
-        for video_index, video_path in enumerate(video_files):
-            log_fn(f'\rExtract features from video {video_index + 1} / {num_videos}')
-            path_features = video_path.replace(videos_dir, features_dir).replace(".mp4", ".npy")
-
-            if os.path.isfile(path_features):
-                log_fn("\tSkipped - feature was already precomputed.")
-            else:
-                # Read all frames
-                frames = extract_frames(video_path=video_path,
-                                        inference_engine=inference_engine)
-                compute_features(path_features=path_features,
-                                 inference_engine=inference_engine,
-                                 frames=frames,
-                                 batch_size=16,
-                                 num_timesteps=num_timesteps)
+                     log_fn=print, num_workers=1, num_threads_per_worker=None):
+    """
+    Compute the features of all videos of the dataset which have not been computed yet, or whose video, backbone
+    network or extraction parameters changed since, as recorded in a `FeatureCacheManifest` next to the features.
+
+    With several workers, videos are distributed over a pool of processes, each one running its own copy
+    of the network on the CPU, so that both video decoding and feature computation scale with the number
+    of cores.
+
+    :param num_workers:
+        Number of worker processes. With a single worker, videos are processed in the current process,
+        decoding the next video in a background thread.
+    :param num_threads_per_worker:
+        Number of threads used by PyTorch in each worker process. Defaults to an even share of the threads
+        PyTorch currently uses, so that workers do not oversubscribe the cores.
+    """
+    if num_workers > 1 and use_gpu:
+        raise ValueError('Feature extraction with several workers is only supported on CPU')
+
+    weights_hash = compute_weights_hash(net)
+
+    pool = None
+    if num_workers > 1:
+        num_threads_per_worker = num_threads_per_worker or max(1, torch.get_num_threads() // num_workers)
+        log_fn(f"Extracting features with {num_workers} workers using {num_threads_per_worker} threads each")
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(num_workers, initializer=_init_feature_worker, initargs=(net, num_threads_per_worker))
+        inference_engine = None
+    else:
+        inference_engine = engine.InferenceEngine(net, use_gpu=use_gpu)
 
-        log_fn('\n')
+    try:
+        for split in SPLITS:
+            video_files = []
+            videos_dir = directories.get_videos_dir(path_in, split)
+            features_dir = directories.get_features_dir(path_in, split, model_config, num_layers_finetune)
+            for label in label_names:
+                video_files.extend(glob.glob(os.path.join(videos_dir, label, "*.mp4")))
+
+            num_videos = len(video_files)
+            log_fn(f"\nFound {num_videos} videos to process in the {split}-set")
+            manifests = {}
+            cache_keys = {}
+            videos_to_process = []
+            for video_path in video_files:
+                path_features = video_path.replace(videos_dir, features_dir).replace(".mp4", ".npy")
+                label_features_dir = os.path.dirname(path_features)
+                if label_features_dir not in manifests:
+                    manifests[label_features_dir] = FeatureCacheManifest(label_features_dir)
+                video_hash = manifests[label_features_dir].get_video_hash(path_features, video_path)
+                cache_keys[video_path] = get_feature_cache_key(video_hash, model_config, weights_hash,
+                                                               num_layers_finetune, num_timesteps)
+                if not manifests[label_features_dir].is_valid(path_features, cache_keys[video_path]):
+                    videos_to_process.append((video_path, path_features))
+
+            num_skipped = num_videos - len(videos_to_process)
+            if num_skipped:
+                log_fn(f"\tSkipped {num_skipped} videos - features were already precomputed.")
+
+            def on_features_computed(video_path, path_features):
+                manifests[os.path.dirname(path_features)].update(path_features, cache_keys[video_path])
+
+            if pool is None:
+                _extract_features_serially(videos_to_process, inference_engine, num_timesteps, log_fn,
+                                           on_features_computed)
+            else:
+                tasks = [(video_path, path_features, num_timesteps)
+                         for video_path, path_features in videos_to_process]
+                for video_index, (video_path, path_features) in enumerate(
+                        pool.imap_unordered(_compute_video_features, tasks)):
+                    on_features_computed(video_path, path_features)
+                    log_fn(f'\rExtract features from video {video_index + 1} / {len(tasks)}')
+    except BaseException:
+        # Do not wait for the remaining videos
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def training_loops(net, train_loader, valid_loader, use_gpu, num_epochs, lr_schedule, label_names, label_names_temporal,
@@ -354,27 +825,111 @@ def training_loops(net, train_loader, valid_loader, use_gpu, num_epochs, lr_sche
     return best_state_dict
 
 
+def _forward_sequences(net, inputs):
+    """
+    Run a batch of sequences of frames of shape (batch_size, num_frames, ...) through the network in a single
+    forward pass, and return the outputs of all sequences one after the other along the first dimension.
+    """
+    set_batch_size(net, len(inputs))
+    try:
+        return net(inputs.flatten(0, 1))
+    finally:
+        set_batch_size(net, 1)
+
+
+def _forward_padded_sequences(net, inputs, num_frames):
+    """
+    Run a batch of sequences padded by `pad_collate` through the network.
+
+    :return:
+        Outputs of shape (batch_size, num_outputs, num_classes) and a boolean mask of the same shape without
+        the last dimension, selecting the outputs that do not depend on padded frames.
+    """
+    outputs = _forward_sequences(net, inputs)
+    outputs = outputs.reshape(len(inputs), -1, *outputs.shape[1:])
+    num_outputs = torch.tensor([get_num_output_frames(net, sample_num_frames)
+                                for sample_num_frames in num_frames.tolist()], device=outputs.device)
+    positions = torch.arange(outputs.shape[1], device=outputs.device)
+    return outputs, positions[None] >= outputs.shape[1] - num_outputs[:, None]
+
+
+def _supports_padded_sequences(net, num_frames_padded, num_frames):
+    padding_multiple = get_padding_multiple(net)
+    return (_supports_batched_sequences(net)
+            and all((num_frames_padded - sample_num_frames) % padding_multiple == 0
+                    for sample_num_frames in num_frames.tolist()))
+
+
+def _evaluate_video(net, criterion, inputs, targets, temporal_annotation_training):
+    """
+    Run the network on all features of a single video of shape (num_frames, ...), with targets of shape (1,)
+    or, for temporal annotations, (num_annotations,).
+
+    :return:
+        The outputs, the targets they are compared to and the loss.
+    """
+    outputs = net(inputs)
+    if temporal_annotation_training:
+        # realign the number of outputs
+        min_pred_number = min(outputs.shape[0], targets.shape[0])
+        targets = targets[0:min_pred_number]
+        outputs = outputs[0:min_pred_number]
+    else:
+        # Average predictions on the time dimension to get a tensor of size 1 x num_classes
+        outputs = torch.mean(outputs, dim=0, keepdim=True)
+    return outputs, targets, criterion(outputs, targets)
+
+
+def _align_temporal_annotations(temporal_annotation, output_mask):
+    """
+    Align the padded temporal annotations of each sample with its first valid outputs, keeping as many
+    frames as both outputs and annotations.
+
+    :return:
+        Targets and a boolean mask of the selected frames, both of the same shape as the output mask.
+    """
+    targets = temporal_annotation.new_full(output_mask.shape, -100)
+    mask = torch.zeros_like(output_mask)
+    num_annotations = (temporal_annotation != -100).sum(dim=1).tolist()
+    for index, (sample_output_mask, sample_num_annotations) in enumerate(zip(output_mask, num_annotations)):
+        first_output = int(sample_output_mask.int().argmax())
+        num_outputs = min(int(sample_output_mask.sum()), sample_num_annotations)
+        targets[index, first_output:first_output + num_outputs] = temporal_annotation[index, :num_outputs]
+        mask[index, first_output:first_output + num_outputs] = True
+    return targets, mask
+
+
 def run_epoch(data_loader, net, criterion, label_names_temporal, optimizer=None, use_gpu=False,
               temporal_annotation_training=False):
     running_loss = 0.0
+    num_loss_terms = 0
     epoch_top_predictions = []
     epoch_labels = []
 
     for i, data in enumerate(data_loader):
-        # get the inputs; data is a list of [inputs, targets]
-        inputs, targets, temporal_annotation = data
+        # get the inputs; data is a list of [inputs, targets], followed by the number of frames of each
+        # input if they were padded by `pad_collate`
+        inputs, targets, temporal_annotation = data[:3]
+        num_frames = data[3] if len(data) > 3 else None
         if temporal_annotation_training:
             targets = temporal_annotation
         if use_gpu:
             inputs = inputs.cuda()
             targets = targets.cuda()
 
+        # Training losses are averaged over batches, validation losses over videos
+        batch_num_loss_terms = 1
+
         # forward + backward + optimize
         if net.training:
-            # Run on each batch element independently
-            outputs = [net(input_i) for input_i in inputs]
-            # Concatenate outputs to get a tensor of size batch_size x num_classes
-            outputs = torch.cat(outputs, dim=0)
+            if _supports_batched_sequences(net):
+                # Run the whole batch in a single forward pass
+                outputs = _forward_sequences(net, inputs)
+            else:
+                # Run on each batch element independently
+                outputs = [net(input_i) for input_i in inputs]
+                # Concatenate outputs to get a tensor of size batch_size x num_classes
+                outputs = torch.cat(outputs, dim=0)
 
             if temporal_annotation_training:
                 # take only targets one batch
@@ -383,21 +938,45 @@ def run_epoch(data_loader, net, criterion, label_names_temporal, optimizer=None,
                 min_pred_number = min(outputs.shape[0], targets.shape[0])
                 targets = targets[0:min_pred_number]
                 outputs = outputs[0:min_pred_number]
+            loss = criterion(outputs, targets)
+        elif num_frames is not None and _supports_padded_sequences(net, inputs.shape[1], num_frames):
+            # Process all available features of whole videos of different lengths in a single forward pass,
+            # with the same results as for each video separately
+            outputs, output_mask = _forward_padded_sequences(net, inputs, num_frames)
+            batch_num_loss_terms = len(inputs)
+            if temporal_annotation_training:
+                targets, mask = _align_temporal_annotations(targets, output_mask)
+                loss = masked_frame_loss(criterion, outputs, targets, mask).mean()
+                targets = targets[mask]
+                outputs = outputs[mask]
+            else:
+                # Average predictions on the time dimension to get a tensor of size batch_size x num_classes
+                outputs = masked_mean(outputs, output_mask)
+                loss = criterion(outputs, targets)
+        elif num_frames is not None:
+            # Padding would shift the temporal windows of the network, process each video separately
+            results = []
+            for sample_inputs, sample_targets, sample_num_frames in zip(inputs, targets, num_frames.tolist()):
+                sample_inputs = sample_inputs[len(sample_inputs) - sample_num_frames:]
+                if temporal_annotation_training:
+                    # Remove the padding of the annotations
+                    sample_targets = sample_targets[:int((sample_targets != -100).sum())]
+                else:
+                    sample_targets = sample_targets[None]
+                results.append(_evaluate_video(net, criterion, sample_inputs, sample_targets,
+                                               temporal_annotation_training))
+            outputs, targets, losses = zip(*results)
+            outputs = torch.cat(outputs)
+            targets = torch.cat(targets)
+            loss = torch.stack(losses).mean()
+            batch_num_loss_terms = len(inputs)
         else:
-            # Average predictions on the time dimension to get a tensor of size 1 x num_classes
             # This assumes validation operates with batch_size=1 and process all available features (no cropping)
             assert data_loader.batch_size == 1
-            outputs = net(inputs[0])
-            if temporal_annotation_training:
-                targets = targets[0]
-                # realign the number of outputs
-                min_pred_number = min(outputs.shape[0], targets.shape[0])
-                targets = targets[0:min_pred_number]
-                outputs = outputs[0:min_pred_number]
-            else:
-                outputs = torch.mean(outputs, dim=0, keepdim=True)
+            outputs, targets, loss = _evaluate_video(net, criterion, inputs[0],
+                                                     targets[0] if temporal_annotation_training else targets,
+                                                     temporal_annotation_training)
 
-        loss = criterion(outputs, targets)
         if optimizer is not None:
             loss.backward()
             optimizer.step()
@@ -408,13 +987,14 @@ def run_epoch(data_loader, net, criterion, label_names_temporal, optimizer=None,
         epoch_top_predictions += list(outputs.argmax(dim=1).cpu().numpy())
 
         # print statistics
-        running_loss += loss.item()
+        running_loss += loss.item() * batch_num_loss_terms
+        num_loss_terms += batch_num_loss_terms
 
     epoch_labels = np.array(epoch_labels)
     epoch_top_predictions = np.array(epoch_top_predictions)
 
     top1 = np.mean(epoch_labels == epoch_top_predictions)
-    loss = running_loss / len(data_loader)
+    loss = running_loss / num_loss_terms
 
     if temporal_annotation_training:
         cnf_matrix = confusion_matrix(epoch_labels, epoch_top_predictions, labels=range(0, len(label_names_temporal)))
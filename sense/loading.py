@@ -10,6 +10,8 @@ from typing import Tuple
 from sense import RESOURCES_DIR
 from sense import SOURCE_DIR
 from sense import backbone_networks
+from sense.export import OnnxRuntimeNeuralNet
+from sense.export import TorchScriptNeuralNet
 
 with open(os.path.join(SOURCE_DIR, 'models.yml')) as f:
     MODELS = yaml.load(f, Loader=yaml.FullLoader)
@@ -234,7 +236,7 @@ def update_backbone_weights(backbone_weights: dict, checkpoint: dict):
 
 
 def build_backbone_network(selected_config: ModelConfig, weights: dict,
-                           weights_finetuned: dict = None):
+                           weights_finetuned: dict = None, optimize: bool = False, quantized: bool = False):
     """
     Creates a backbone network and load provided weights, unless Travis is used.
 
@@ -244,18 +246,61 @@ def build_backbone_network(selected_config: ModelConfig, weights: dict,
         A model state dict.
     :param  weights_finetuned:
         A state dict that contains the finetuned weights of a subset of the model layers.
+    :param optimize:
+        If True, convert the network into a faster eval-only form, which cannot be used for training.
+        The scaling of the frames is then folded into the first convolution, see `optimize_for_inference`.
+    :param quantized:
+        If True, the provided weights are the state dict of an int8 quantized network, as saved by
+        `tools/quantize_backbone.py`. Finetuned weights must then already be part of that state dict.
     :return:
         A backbone network, with pre-trained weights.
     """
     backbone_network = getattr(backbone_networks, selected_config.model_name)()
+    if quantized:
+        if weights_finetuned or optimize:
+            raise ValueError('Quantized backbone networks already contain their finetuned weights and '
+                             'cannot be further optimized.')
+        backbone_network = backbone_networks.build_quantized_backbone(backbone_network)
+        if not running_on_travis():
+            backbone_network.load_state_dict(weights)
+        return backbone_network
+
     if not running_on_travis():
         if weights_finetuned:
             update_backbone_weights(weights, weights_finetuned)
         backbone_network.load_state_dict(weights)
     backbone_network.eval()
+    if optimize:
+        backbone_network = backbone_networks.optimize_for_inference(backbone_network, fold_input_scaling=True)
     return backbone_network
 
 
+def load_torchscript_network(path: str):
+    """
+    Load a network saved by `sense.export.export_torchscript`, ready to be used in InferenceEngine. This
+    does not require the model definitions nor the original checkpoint files.
+
+    :param path:
+        Path to the TorchScript file.
+    :return:
+        A TorchScriptNeuralNet instance, in eval mode.
+    """
+    return TorchScriptNeuralNet(torch.jit.load(path, map_location='cpu')).eval()
+
+
+def load_onnx_network(path: str):
+    """
+    Load a network saved by `sense.export.export_onnx`, to be run with ONNX Runtime in InferenceEngine.
+    This does not require the model definitions nor the original checkpoint files.
+
+    :param path:
+        Path to the ONNX file.
+    :return:
+        An OnnxRuntimeNeuralNet instance.
+    """
+    return OnnxRuntimeNeuralNet(path).eval()
+
+
 def running_on_travis():
     """
     Returns True if Travis is currently being used.
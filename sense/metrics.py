@@ -0,0 +1,180 @@
+"""
+Lightweight registry of latency metrics for the stages of the real-time pipeline: reading and resizing
+frames, assembling clips, running the network, post-processing and rendering the predictions. Comparing
+the percentiles of each stage shows which one limits the throughput on a given machine.
+"""
+import json
+import time
+
+from collections import deque
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class LatencyStats:
+    """
+    Durations of a single stage. Percentiles are computed over the most recent durations, so that they
+    follow changes of the load, while the count and the mean cover all the recorded durations.
+    """
+
+    def __init__(self, window_size: int = 1000):
+        """
+        :param window_size:
+            Number of most recent durations over which the percentiles are computed.
+        """
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._durations = deque(maxlen=window_size)
+        self._lock = Lock()
+
+    def record(self, duration: float):
+        """Add the duration of one run of the stage, in seconds."""
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+            self._durations.append(duration)
+
+    def summary(self) -> dict:
+        """
+        Return the number of runs of the stage along with the mean, the percentiles in `PERCENTILES` and
+        the maximum of the durations, in milliseconds.
+        """
+        with self._lock:
+            durations = np.array(self._durations)
+            summary = {
+                'count': self.count,
+                'mean_ms': 1000 * self.total / self.count if self.count else 0.,
+            }
+            max_ms = 1000 * self.max
+
+        percentiles = np.percentile(durations, PERCENTILES) if len(durations) else [0.] * len(PERCENTILES)
+        for percentile, value in zip(PERCENTILES, percentiles):
+            summary[f'p{percentile}_ms'] = 1000 * float(value)
+        summary['max_ms'] = max_ms
+        return summary
+
+
+class _Timer:
+    """Context manager recording the time spent in its block."""
+
+    def __init__(self, stats: LatencyStats):
+        self.stats = stats
+        self.time_start = None
+
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(time.perf_counter() - self.time_start)
+
+
+class _NoTimer:
+    """Context manager doing nothing, used when metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class MetricsRegistry:
+    """
+    Registry of the latency of named stages, which can be shared by the components of the pipeline
+    running in different threads. Stages are created when they are first recorded.
+
+    Typical use:
+        metrics = MetricsRegistry()
+        with metrics.timer('engine.forward'):
+            predictions = net(clip)
+        print(metrics.to_json())
+    """
+
+    def __init__(self, enabled: bool = True, window_size: int = 1000, log_interval: Optional[float] = None,
+                 log_fn: Callable[[str], None] = print):
+        """
+        :param enabled:
+            If False, nothing is recorded, so that components can time their stages unconditionally.
+        :param window_size:
+            Number of most recent durations of each stage over which percentiles are computed.
+        :param log_interval:
+            Minimal time in seconds between two logs of the summary by `log_periodically`. Nothing is
+            logged if None.
+        :param log_fn:
+            Function used to log the summary.
+        """
+        self.enabled = enabled
+        self.window_size = window_size
+        self.log_interval = log_interval
+        self.log_fn = log_fn
+        self._stats = {}
+        self._lock = Lock()
+        self._last_log_time = time.perf_counter()
+
+    def stats(self, name: str) -> LatencyStats:
+        """Return the latency stats of the given stage, creating them if needed."""
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(name, LatencyStats(self.window_size))
+        return stats
+
+    def record(self, name: str, duration: float):
+        """Add a duration in seconds to the given stage."""
+        if self.enabled:
+            self.stats(name).record(duration)
+
+    def timer(self, name: str):
+        """Return a context manager recording the time spent in its block to the given stage."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self.stats(name))
+
+    def summary(self) -> Dict[str, dict]:
+        """Return the summary of each stage, see `LatencyStats.summary`."""
+        with self._lock:
+            stats = dict(self._stats)
+        return {name: stats[name].summary() for name in sorted(stats)}
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        """
+        Return the summary of all stages as JSON, and write it to a file if a path is given.
+        """
+        summary = json.dumps(self.summary(), indent=2)
+        if path:
+            with open(path, 'w') as f:
+                f.write(summary)
+        return summary
+
+    def format_summary(self) -> str:
+        """Return the summary of all stages as a table, with durations in milliseconds."""
+        columns = ['mean'] + [f'p{percentile}' for percentile in PERCENTILES] + ['max']
+        lines = [f'{"stage":<28}{"count":>10}' + ''.join(f'{column:>10}' for column in columns)]
+        for name, summary in self.summary().items():
+            lines.append(f'{name:<28}{summary["count"]:>10}'
+                         + ''.join(f'{summary[column + "_ms"]:>10.2f}' for column in columns))
+        return '\n'.join(lines)
+
+    def log_periodically(self):
+        """
+        Log the summary of all stages if `log_interval` seconds passed since the last log. Meant to be
+        called on every iteration of the main loop.
+        """
+        if not self.enabled or self.log_interval is None:
+            return
+        now = time.perf_counter()
+        if now - self._last_log_time >= self.log_interval:
+            self._last_log_time = now
+            self.log_fn(self.format_summary())
@@ -0,0 +1,83 @@
+import queue
+
+from typing import Any
+from typing import Optional
+
+QUEUE_POLICIES = ['drop_oldest', 'drop_newest', 'block']
+
+
+class BoundedQueue(queue.Queue):
+    """
+    FIFO queue of bounded size with a backpressure policy, deciding what happens to items added while the
+    queue is full:
+        - 'drop_oldest': the oldest item is removed to make room for the new one, so that consumers
+          always get the most recent data
+        - 'drop_newest': the new item is discarded
+        - 'block': the producer waits until an item is consumed
+
+    Dropped items are counted, and the depth of the queue is tracked along with its maximum, so that an
+    overloaded consumer can be detected and queue sizes tuned.
+    """
+
+    def __init__(self, maxsize: int, policy: str = 'drop_oldest'):
+        """
+        :param maxsize:
+            Maximum number of items in the queue.
+        :param policy:
+            Backpressure policy, one of `QUEUE_POLICIES`.
+        """
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}. Available policies: {QUEUE_POLICIES}')
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.num_dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        """Current number of items in the queue."""
+        return self.qsize()
+
+    def put_with_policy(self, item: Any, timeout: Optional[float] = None, policy: Optional[str] = None) -> bool:
+        """
+        Add an item to the queue, applying the backpressure policy if the queue is full.
+
+        :param item:
+            The item to be added.
+        :param timeout:
+            With the 'block' policy, maximum time to wait in seconds, after which queue.Full is raised.
+            Wait indefinitely if None.
+        :param policy:
+            Policy applied to this item instead of the policy of the queue, e.g. to make sure that an end
+            of stream marker is not dropped.
+        :return:
+            False if an item was dropped, either the new one or the oldest one, True otherwise.
+        """
+        policy = policy or self.policy
+        if policy == 'block':
+            self.put(item, timeout=timeout)
+            self._update_max_depth()
+            return True
+
+        with self.not_full:
+            dropped = self._qsize() >= self.maxsize > 0
+            if dropped:
+                self.num_dropped += 1
+                if policy == 'drop_newest':
+                    return False
+                # Remove the oldest item, which is never marked as done
+                self._get()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.max_depth = max(self.max_depth, self._qsize())
+            self.not_empty.notify()
+        return not dropped
+
+    def _update_max_depth(self):
+        with self.mutex:
+            self.max_depth = max(self.max_depth, self._qsize())
+
+    def stats(self) -> dict:
+        """Return the number of dropped items and the current and maximal depth of the queue."""
+        return {'num_dropped': self.num_dropped, 'depth': self.depth, 'max_depth': self.max_depth}
@@ -0,0 +1,21 @@
+import multiprocessing
+
+from sense.backbone_networks import StridedInflatedMobileNetV2
+
+
+class FailingNetwork(StridedInflatedMobileNetV2):
+    def forward(self, x):
+        raise ValueError('Inference failed')
+
+
+class FailingInChildProcessNetwork(StridedInflatedMobileNetV2):
+    """
+    Network failing only when run in a child process, so that an InferenceProcess can still run it once
+    on creation.
+    """
+
+    def forward(self, x):
+        # multiprocessing.parent_process is not available before Python 3.8
+        if multiprocessing.current_process().name != 'MainProcess':
+            raise ValueError('Inference failed')
+        return super().forward(x)
@@ -0,0 +1,329 @@
+import unittest
+import warnings
+
+import numpy as np
+import torch
+
+from sense.backbone_networks import StridedInflatedEfficientNet
+from sense.backbone_networks import StridedInflatedMobileNetV2
+from sense.backbone_networks import build_quantized_backbone
+from sense.backbone_networks import optimize_for_inference
+from sense.backbone_networks import quantize_backbone
+from sense.backbone_networks.quantization import reset_internal_states
+from sense.backbone_networks.mobilenet import SteppableConv3dAs2d
+from sense.backbone_networks.mobilenet import SteppableSparseConv3dAs2d
+from sense.finetuning import set_batch_size
+from sense.finetuning import set_internal_padding_false
+
+FRAME_SIZE = (64, 64)
+NUM_STEPS = 4
+
+
+def set_reuse_state_buffer(net, reuse_state_buffer):
+    for module in net.modules():
+        if isinstance(module, SteppableConv3dAs2d):
+            module.reuse_state_buffer = reuse_state_buffer
+            module.reset()
+
+
+def run_steps(net, clips):
+    with torch.no_grad():
+        return [net(clip) for clip in clips]
+
+
+class TestSteppableInternalState(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.clips = [torch.rand(4, 3, *FRAME_SIZE) for _ in range(NUM_STEPS)]
+
+    def _assert_same_outputs_with_and_without_buffer(self, net):
+        net.eval()
+        set_reuse_state_buffer(net, False)
+        expected = run_steps(net, self.clips)
+        set_reuse_state_buffer(net, True)
+        outputs = run_steps(net, self.clips)
+
+        for output, expected_output in zip(outputs, expected):
+            assert torch.allclose(output, expected_output, atol=1e-6)
+
+    def test_efficientnet_state_buffer(self):
+        self._assert_same_outputs_with_and_without_buffer(StridedInflatedEfficientNet())
+
+    def test_mobilenet_state_buffer(self):
+        self._assert_same_outputs_with_and_without_buffer(StridedInflatedMobileNetV2())
+
+    def test_state_buffer_reused_across_steps(self):
+        layer = SteppableConv3dAs2d(8, 8, (3, 1, 1)).eval()
+        with torch.no_grad():
+            layer(torch.rand(4, 8, 5, 5))
+            buffer = layer._state_buffer
+            layer(torch.rand(4, 8, 5, 5))
+        assert layer._state_buffer is buffer
+
+    def test_state_buffer_with_short_input(self):
+        layer = SteppableConv3dAs2d(8, 8, (3, 1, 1)).eval()
+        frames = torch.rand(6, 8, 5, 5)
+        with torch.no_grad():
+            expected = layer(frames)
+            layer.reset()
+            outputs = torch.cat([layer(frame[None]) for frame in frames])
+        assert torch.allclose(outputs, expected, atol=1e-6)
+
+
+class TestChannelsLast(unittest.TestCase):
+
+    def test_channels_last_outputs(self):
+        torch.manual_seed(0)
+        clips = [torch.rand(4, 3, *FRAME_SIZE) for _ in range(NUM_STEPS)]
+        for net in [StridedInflatedEfficientNet().eval(), StridedInflatedMobileNetV2().eval()]:
+            expected = run_steps(net, clips)
+            set_reuse_state_buffer(net, True)
+            net.to(memory_format=torch.channels_last)
+            outputs = run_steps(net, [clip.contiguous(memory_format=torch.channels_last) for clip in clips])
+
+            for output, expected_output in zip(outputs, expected):
+                assert torch.allclose(output, expected_output, atol=1e-5)
+
+    def test_channels_last_internal_state(self):
+        for layer in [SteppableConv3dAs2d(8, 8, (3, 1, 1)), SteppableSparseConv3dAs2d(8, 8, 1)]:
+            layer = layer.eval().to(memory_format=torch.channels_last)
+            x = torch.rand(4, 8, 5, 5).contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                frames = layer.step_frames(x)
+            assert frames.is_contiguous(memory_format=torch.channels_last)
+            assert layer._state_buffer.is_contiguous(memory_format=torch.channels_last)
+
+
+class TestSteppableConv3dAs2dRearrangeFrames(unittest.TestCase):
+
+    @staticmethod
+    def concat_rearrange_frames(layer, x):
+        num_frames = x.shape[0]
+        x = torch.cat([x[offset: num_frames - layer.kernel_size_temporal + offset + 1]
+                       for offset in range(layer.kernel_size_temporal)], dim=1)
+        return x[torch.arange(0, x.shape[0], layer.stride_temporal)]
+
+    def _assert_same_as_concat(self, layer, num_frames):
+        x = torch.rand(num_frames, 4, 3, 3)
+        expected = self.concat_rearrange_frames(layer, x)
+        assert torch.equal(layer.rearrange_frames(x), expected)
+
+    def test_rearrange_frames(self):
+        layer = SteppableConv3dAs2d(4, 8, (3, 1, 1))
+        for num_frames in range(3, 8):
+            self._assert_same_as_concat(layer, num_frames)
+
+    def test_rearrange_frames_temporal_stride(self):
+        layer = SteppableConv3dAs2d(4, 8, (3, 1, 1), stride=(2, 1, 1))
+        for num_frames in range(3, 8):
+            self._assert_same_as_concat(layer, num_frames)
+
+    def test_rearrange_frames_channels_last(self):
+        layer = SteppableConv3dAs2d(4, 8, (3, 1, 1), stride=(2, 1, 1))
+        x = torch.rand(7, 4, 3, 3)
+        expected = self.concat_rearrange_frames(layer, x)
+        assert torch.equal(layer.rearrange_frames(x.contiguous(memory_format=torch.channels_last)), expected)
+
+    def test_rearrange_frames_too_few_frames(self):
+        layer = SteppableConv3dAs2d(4, 8, (3, 1, 1), stride=(2, 1, 1))
+        assert layer.rearrange_frames(torch.rand(2, 4, 3, 3)).shape == (0, 12, 3, 3)
+
+
+class TestSteppableSparseConv3dAs2dRearrangeFrames(unittest.TestCase):
+
+    @staticmethod
+    def gather_shift_frames(layer, x):
+        quarter = int(x.shape[1] // 4)
+        half = int(x.shape[1] // 2)
+        out = torch.zeros_like(x[2:])
+        out[:, 0:quarter] = x[0:-2, 0:quarter]
+        out[:, quarter:half] = x[1:-1, quarter:half]
+        out[:, half:] = x[2:, half:]
+        indices = [-1 - offset for offset in range(0, out.shape[0], layer.stride_temporal)]
+        return out[indices[::-1]]
+
+    def _assert_same_as_gather(self, layer, num_channels):
+        for num_frames in range(3, 8):
+            x = torch.rand(num_frames, num_channels, 3, 3)
+            expected = self.gather_shift_frames(layer, x)
+            with torch.no_grad():
+                assert torch.equal(layer.rearrange_frames(x), expected)
+            assert torch.equal(layer.rearrange_frames(x), expected)
+
+    def test_rearrange_frames(self):
+        for num_channels in [8, 10]:
+            layer = SteppableSparseConv3dAs2d(num_channels, 8, 1)
+            self._assert_same_as_gather(layer, num_channels)
+
+    def test_rearrange_frames_temporal_stride(self):
+        for num_channels in [8, 10]:
+            layer = SteppableSparseConv3dAs2d(num_channels, 8, 1, stride=(2, 1, 1))
+            self._assert_same_as_gather(layer, num_channels)
+
+    def test_output_buffer_reused_across_steps(self):
+        layer = SteppableSparseConv3dAs2d(8, 8, 1)
+        with torch.no_grad():
+            out = layer.rearrange_frames(torch.rand(6, 8, 3, 3))
+            assert layer.rearrange_frames(torch.rand(6, 8, 3, 3)) is out
+
+    def test_output_buffer_cleared_on_reset(self):
+        layer = SteppableSparseConv3dAs2d(8, 8, 1)
+        with torch.no_grad():
+            out = layer.rearrange_frames(torch.rand(6, 8, 3, 3))
+            layer.reset()
+            assert layer._shift_buffer is None
+            assert layer.rearrange_frames(torch.rand(6, 8, 3, 3)) is not out
+
+    def test_other_kernel_size_and_shift_ratios(self):
+        layer = SteppableSparseConv3dAs2d(8, 8, 1, kernel_size_temporal=2, shift_ratios=(0.125, 0.875))
+        assert layer.temporal_footprint == 1
+        x = torch.rand(5, 8, 3, 3)
+        out = layer.rearrange_frames(x)
+        assert torch.equal(out[:, :1], x[:-1, :1])
+        assert torch.equal(out[:, 1:], x[1:, 1:])
+
+    def test_invalid_shift_ratios(self):
+        self.assertRaises(ValueError, SteppableSparseConv3dAs2d, 8, 8, 1, shift_ratios=(0.5, 0.5))
+
+
+class TestBatchedSequences(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.net = StridedInflatedMobileNetV2().train()
+        self.net.apply(set_internal_padding_false)
+        self.sequences = torch.rand(3, 48, 3, 32, 32)
+
+    def test_same_outputs_as_each_sequence(self):
+        expected = torch.cat([self.net(sequence) for sequence in self.sequences])
+        set_batch_size(self.net, len(self.sequences))
+        outputs = self.net(self.sequences.flatten(0, 1))
+
+        assert outputs.shape == expected.shape
+        assert torch.allclose(outputs, expected, atol=1e-5)
+
+    def test_internal_padding_not_supported(self):
+        net = StridedInflatedMobileNetV2()
+        set_batch_size(net, len(self.sequences))
+        self.assertRaises(ValueError, net, self.sequences.flatten(0, 1))
+
+
+class TestOptimizeForInference(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.clips = [torch.rand(4, 3, *FRAME_SIZE) for _ in range(NUM_STEPS)]
+
+    def _assert_same_outputs_after_optimization(self, net):
+        net.eval()
+        expected = run_steps(net, self.clips)
+        state_dict = net.state_dict()
+        set_reuse_state_buffer(net, True)
+        optimized_net = optimize_for_inference(net)
+        outputs = run_steps(optimized_net, self.clips)
+
+        for output, expected_output in zip(outputs, expected):
+            assert torch.allclose(output, expected_output, atol=1e-6)
+        assert state_dict.keys() == optimized_net.state_dict().keys()
+
+    def test_optimize_efficientnet(self):
+        self._assert_same_outputs_after_optimization(StridedInflatedEfficientNet())
+
+    def test_optimize_mobilenet(self):
+        self._assert_same_outputs_after_optimization(StridedInflatedMobileNetV2())
+
+    def test_optimized_network_cannot_be_trained(self):
+        optimized_net = optimize_for_inference(StridedInflatedMobileNetV2())
+        self.assertRaises(RuntimeError, optimized_net.train)
+
+    def test_fold_input_scaling(self):
+        net = StridedInflatedMobileNetV2().eval()
+        clip = np.random.randint(0, 256, (1, NUM_STEPS * 4, *FRAME_SIZE, 3)).astype(np.uint8)
+        with torch.no_grad():
+            expected = net(net.preprocess(clip))
+            reset_internal_states(net)
+            optimized_net = optimize_for_inference(net, fold_input_scaling=True)
+            outputs = optimized_net(optimized_net.preprocess(clip))
+        assert torch.allclose(outputs, expected, atol=1e-5)
+
+    def test_fold_input_scaling_after_loading_weights(self):
+        net = StridedInflatedMobileNetV2().eval()
+        clip = np.random.randint(0, 256, (1, NUM_STEPS * 4, *FRAME_SIZE, 3)).astype(np.uint8)
+        optimized_net = optimize_for_inference(StridedInflatedMobileNetV2(), fold_input_scaling=True)
+        with torch.no_grad():
+            optimized_net(optimized_net.preprocess(clip))
+            scaled_weight = optimized_net.cnn[0].scaled_weight
+            reset_internal_states(optimized_net)
+            optimized_net(optimized_net.preprocess(clip))
+            # Weights are only scaled once
+            assert optimized_net.cnn[0].scaled_weight is scaled_weight
+
+            expected = net(net.preprocess(clip))
+            optimized_net.load_state_dict(net.state_dict())
+            reset_internal_states(optimized_net)
+            outputs = optimized_net(optimized_net.preprocess(clip))
+        assert torch.allclose(outputs, expected, atol=1e-5)
+
+
+class TestPreprocess(unittest.TestCase):
+
+    def setUp(self) -> None:
+        np.random.seed(0)
+        self.net = StridedInflatedMobileNetV2()
+        self.clip = np.random.randint(0, 256, (1, 4, *FRAME_SIZE, 3)).astype(np.uint8)
+        self.expected = torch.Tensor(self.clip[0].transpose(0, 3, 1, 2) / 255.)
+
+    def test_uint8_clip(self):
+        frames = self.net.preprocess(self.clip)
+        assert frames.dtype == torch.float32
+        assert frames.is_contiguous()
+        assert torch.allclose(frames, self.expected)
+
+    def test_channels_last_frames(self):
+        self.net.channels_last_frames = True
+        frames = self.net.preprocess(self.clip)
+        assert frames.is_contiguous(memory_format=torch.channels_last)
+        assert torch.allclose(frames, self.expected)
+
+    def test_float_clip_unchanged(self):
+        clip = self.clip.astype(np.float32)
+        assert torch.allclose(self.net.preprocess(clip), self.expected)
+        assert np.array_equal(clip, self.clip)
+
+
+class TestQuantizeBackbone(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.clip = torch.rand(16, 3, *FRAME_SIZE)
+        self.net = StridedInflatedMobileNetV2().eval()
+        with torch.no_grad():
+            self.expected = self.net(self.clip)
+        reset_internal_states(self.net)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.quantized_net = quantize_backbone(self.net, [self.clip])
+
+    def test_quantized_outputs_close_to_full_precision(self):
+        with torch.no_grad():
+            outputs = self.quantized_net(self.clip)
+        assert outputs.shape == self.expected.shape
+        assert (outputs - self.expected).abs().max() < 0.1 * self.expected.abs().max()
+
+    def test_quantized_streaming(self):
+        with torch.no_grad():
+            expected = self.quantized_net(self.clip)
+            reset_internal_states(self.quantized_net)
+            outputs = torch.cat([self.quantized_net(step) for step in self.clip.split(4)])
+        assert torch.equal(outputs, expected)
+
+    def test_load_quantized_state_dict(self):
+        loaded_net = build_quantized_backbone(StridedInflatedMobileNetV2())
+        loaded_net.load_state_dict(self.quantized_net.state_dict())
+        with torch.no_grad():
+            assert torch.equal(loaded_net(self.clip), self.quantized_net(self.clip))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,19 @@
 import os
+import tempfile
 import unittest
 from unittest.mock import patch
 
 import cv2
 import numpy as np
 
+from sense.camera import AsyncVideoWriter
+from sense.camera import letterbox
+from sense.camera import PrefetchingVideoSource
 from sense.camera import uniform_frame_sample
 from sense.camera import VideoSource
 from sense.camera import VideoStream
 from sense.camera import VideoWriter
+from sense.camera import write_synchronized
 
 VIDEO_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'test_video.mp4')
 
@@ -30,18 +35,114 @@ class TestUniformFrameSample(unittest.TestCase):
         assert np.array_equal(same_video, self.VIDEO)
 
 
+class TestLetterbox(unittest.TestCase):
+
+    def _assert_same_as_pad_and_resize(self, image_shape, size, max_difference=0):
+        img = cv2.GaussianBlur(np.random.randint(0, 256, image_shape).astype(np.uint8), (0, 0), 3)
+        expected = cv2.resize(VideoSource.pad_to_square(None, img), size)
+        scaled_img = letterbox(img, size)
+        assert scaled_img.shape == expected.shape
+        assert np.abs(scaled_img.astype(int) - expected).max() <= max_difference
+
+    def test_landscape(self):
+        self._assert_same_as_pad_and_resize((480, 640, 3), (256, 256))
+
+    def test_portrait(self):
+        self._assert_same_as_pad_and_resize((640, 480, 3), (256, 256))
+
+    def test_unaligned_borders(self):
+        self._assert_same_as_pad_and_resize((481, 639, 3), (256, 256), max_difference=1)
+
+    def test_destination(self):
+        img = np.random.randint(0, 256, (480, 640, 3)).astype(np.uint8)
+        dst = np.full((256, 256, 3), 255, dtype=np.uint8)
+        assert letterbox(img, (256, 256), dst=dst) is dst
+        assert np.array_equal(dst, letterbox(img, (256, 256)))
+
+
 class TestVideoSource(unittest.TestCase):
 
     def test_from_file(self):
         video_source = VideoSource(filename=VIDEO_PATH)
-        assert video_source._frames is None
+        assert video_source._resampled_frames is None
         assert video_source.get_image() is not None
 
     def test_from_file_change_fps(self):
         video_source = VideoSource(filename=VIDEO_PATH, target_fps=5)
-        assert video_source._frames is not None  # Frames should be pre-computed and resampled
+        assert video_source._resampled_frames is not None  # Frames should be resampled
         assert video_source.get_image() is not None
 
+    @staticmethod
+    def _read_frames(video_source):
+        frames = []
+        img_tuple = video_source.get_image()
+        while img_tuple is not None:
+            frames.append(img_tuple[0])
+            img_tuple = video_source.get_image()
+        return frames
+
+    def _assert_same_frames_as_uniform_frame_sample(self, target_fps):
+        video_source = VideoSource(filename=VIDEO_PATH)
+        video = self._read_frames(video_source)
+        video_fps = video_source._cam.get(cv2.CAP_PROP_FPS)
+        expected = uniform_frame_sample(np.array(video), target_fps / video_fps)
+
+        frames = self._read_frames(VideoSource(filename=VIDEO_PATH, target_fps=target_fps))
+
+        assert np.array_equal(np.array(frames), expected)
+
+    @staticmethod
+    def _patch_frame_count(frame_count_offset=None):
+        video_capture = cv2.VideoCapture
+
+        class VideoCaptureWithWrongFrameCount:
+            def __init__(self, *args):
+                self._cam = video_capture(*args)
+
+            def get(self, prop_id):
+                value = self._cam.get(prop_id)
+                if prop_id == cv2.CAP_PROP_FRAME_COUNT:
+                    return 0. if frame_count_offset is None else value + frame_count_offset
+                return value
+
+            def __getattr__(self, name):
+                return getattr(self._cam, name)
+
+        return patch('cv2.VideoCapture', VideoCaptureWithWrongFrameCount)
+
+    def test_streaming_downsampling(self):
+        self._assert_same_frames_as_uniform_frame_sample(target_fps=5)
+
+    def test_streaming_upsampling(self):
+        self._assert_same_frames_as_uniform_frame_sample(target_fps=16)
+
+    def _assert_sampled_over_whole_video(self, video, frames, target_fps):
+        # Frames are sampled in order, at the target frame rate and over the whole video
+        frame_indices = [next(idx for idx, video_frame in enumerate(video) if np.array_equal(frame, video_frame))
+                         for frame in frames]
+        assert frame_indices == sorted(set(frame_indices))
+        assert frame_indices[-1] >= len(video) - 3
+        assert abs(len(frames) - round(len(video) * target_fps / 12)) <= 1
+
+    def test_streaming_without_frame_count(self):
+        video = self._read_frames(VideoSource(filename=VIDEO_PATH))
+        with self._patch_frame_count():
+            video_source = VideoSource(filename=VIDEO_PATH, target_fps=5)
+            # The first frame is returned without going through the video first
+            img, _ = video_source.get_image()
+            assert video_source._cam.get(cv2.CAP_PROP_POS_FRAMES) == 1
+            frames = [img] + self._read_frames(video_source)
+
+        self._assert_sampled_over_whole_video(video, frames, target_fps=5)
+
+    def test_streaming_with_wrong_frame_count(self):
+        video = self._read_frames(VideoSource(filename=VIDEO_PATH))
+        for frame_count_offset in [-5, 5]:
+            with self._patch_frame_count(frame_count_offset):
+                frames = self._read_frames(VideoSource(filename=VIDEO_PATH, target_fps=5))
+
+            self._assert_sampled_over_whole_video(video, frames, target_fps=5)
+
     def test_from_camera(self):
         class MockVideoSource:
             def __init__(self, *args):
@@ -55,7 +156,7 @@ class TestVideoSource(unittest.TestCase):
 
         with patch('cv2.VideoCapture', MockVideoSource):
             video_source = VideoSource(camera_id=0)
-        assert video_source._frames is None
+        assert video_source._resampled_frames is None
         assert video_source.get_image() is not None
 
 
@@ -79,6 +180,60 @@ class TestVideoStream(unittest.TestCase):
         self.stream.run()
         self.assertTrue(self.stream.frames.full())
         self.assertTrue(self.stream._shutdown)
+        # 13 frames and the end of the stream in a queue of 4
+        assert self.stream.stats() == {'num_dropped_frames': 10, 'queue_depth': 4, 'max_queue_depth': 4}
+
+    def test_drop_newest(self):
+        stream = VideoStream(video_source=self.video, fps=1000., policy='drop_newest')
+        stream.run()
+        frames = [stream.get_image() for _ in range(4)]
+        assert stream.stats()['num_dropped_frames'] == 10
+        # The first frames are kept, except for the oldest one which makes room for the end of the stream
+        assert frames[-1] is None
+        video = VideoSource(filename=VIDEO_PATH)
+        expected_frames = [video.get_image()[0] for _ in range(4)]
+        for frame, expected_frame in zip(frames[:3], expected_frames[1:]):
+            assert np.array_equal(frame[0], expected_frame)
+
+
+class TestPrefetchingVideoSource(unittest.TestCase):
+
+    def test_same_frames_as_video_source(self):
+        video_source = VideoSource(filename=VIDEO_PATH, size=(32, 32))
+        prefetching_video_source = PrefetchingVideoSource(VideoSource(filename=VIDEO_PATH, size=(32, 32)),
+                                                          queue_size=2)
+        prefetching_video_source.start()
+
+        img_tuple = video_source.get_image()
+        while img_tuple is not None:
+            prefetched_img_tuple = prefetching_video_source.get_image()
+            for img, prefetched_img in zip(img_tuple, prefetched_img_tuple):
+                assert np.array_equal(img, prefetched_img)
+            img_tuple = video_source.get_image()
+
+        assert prefetching_video_source.get_image() is None
+        assert prefetching_video_source.get_image() is None
+        prefetching_video_source.join(timeout=1)
+        assert not prefetching_video_source.is_alive()
+
+    def test_stop(self):
+        prefetching_video_source = PrefetchingVideoSource(VideoSource(filename=VIDEO_PATH), queue_size=1)
+        prefetching_video_source.start()
+        prefetching_video_source.stop()
+        prefetching_video_source.join(timeout=1)
+        assert not prefetching_video_source.is_alive()
+
+    def test_error(self):
+        class FailingVideoSource(VideoSource):
+            def _get_frame(self):
+                raise RuntimeError('Corrupted video')
+
+        prefetching_video_source = PrefetchingVideoSource(FailingVideoSource(filename=VIDEO_PATH), queue_size=1)
+        prefetching_video_source.start()
+        self.assertRaises(RuntimeError, prefetching_video_source.get_image)
+        self.assertRaises(RuntimeError, prefetching_video_source.get_image)
+        prefetching_video_source.join(timeout=1)
+        assert not prefetching_video_source.is_alive()
 
 
 class TestVideoWriter(unittest.TestCase):
@@ -118,5 +273,62 @@ class TestVideoWriter(unittest.TestCase):
         self.assertFalse(self.videowriter.writer.isOpened())
 
 
+class TestAsyncVideoWriter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'output.mp4')
+        self.frames = [np.full((30, 40, 3), 40 * index, dtype=np.uint8) for index in range(3)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _count_written_frames(self):
+        video = cv2.VideoCapture(self.path)
+        num_frames = 0
+        while video.read()[0]:
+            num_frames += 1
+        return num_frames
+
+    def test_block(self):
+        video_writer = AsyncVideoWriter(self.path, fps=12., queue_size=1)
+        video_writer.start()
+        assert all(video_writer.write(frame) for frame in self.frames)
+        video_writer.release()
+        assert self._count_written_frames() == len(self.frames)
+
+    def test_drop(self):
+        video_writer = AsyncVideoWriter(self.path, fps=12., policy='drop', queue_size=2)
+        # Not started yet, so that the queue is full after two frames
+        assert [video_writer.write(frame) for frame in self.frames] == [True, True, False]
+        assert video_writer.num_dropped_frames == 1
+        video_writer.start()
+        video_writer.release()
+        assert self._count_written_frames() == 2
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, AsyncVideoWriter, self.path, fps=12., policy='drop_oldest')
+
+    def test_error(self):
+        video_writer = AsyncVideoWriter(os.path.join(self.tmp_dir.name, 'missing', 'output.mp4'), fps=12.,
+                                        queue_size=1)
+        video_writer.start()
+        video_writer.write(self.frames[0])
+        video_writer.join(timeout=10)
+
+        # The error is raised instead of waiting forever for space in the queue
+        self.assertRaises(RuntimeError, video_writer.write, self.frames[1])
+        video_writer.release()
+
+    def test_write_synchronized(self):
+        video_writers = [AsyncVideoWriter(self.path, fps=12., policy='drop', queue_size=size) for size in (2, 3)]
+        results = [write_synchronized(video_writers, [frame, frame]) for frame in self.frames]
+
+        # Frames are dropped from both videos as soon as one of the queues is full
+        assert results == [True, True, False]
+        assert [video_writer.frames.qsize() for video_writer in video_writers] == [2, 2]
+        assert [video_writer.num_dropped_frames for video_writer in video_writers] == [1, 1]
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,209 @@
+import copy
+import os
+import tempfile
+import time
+import unittest
+
+import cv2
+
+import numpy as np
+
+from sense.backbone_networks import StridedInflatedMobileNetV2
+from sense.controller import ClipBuffer
+from sense.controller import Controller
+from sense.controller import get_recording_paths
+from sense.controller import render_recording
+from sense.display import DisplayResults
+from sense.metrics import MetricsRegistry
+from networks import FailingInChildProcessNetwork
+from networks import FailingNetwork
+
+VIDEO_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'test_video.mp4')
+NUM_VIDEO_FRAMES = 17  # 13 frames at 12 fps, resampled to 16 fps
+
+CLIP_LENGTH = 4
+FRAME_SIZE = (6, 8)
+
+
+class TestClipBuffer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.clip_buffer = ClipBuffer(CLIP_LENGTH, FRAME_SIZE)
+        self.frames = [np.full((*FRAME_SIZE, 3), index, dtype=np.uint8) for index in range(3 * CLIP_LENGTH)]
+
+    def test_clip_every_clip_length_frames(self):
+        for index, frame in enumerate(self.frames):
+            clip = self.clip_buffer.add_frame(frame)
+            if (index + 1) % CLIP_LENGTH:
+                assert clip is None
+            else:
+                assert clip.shape == (1, CLIP_LENGTH, *FRAME_SIZE, 3)
+                assert clip.dtype == np.uint8
+                assert clip.flags['C_CONTIGUOUS']
+                assert np.array_equal(clip[0], self.frames[index + 1 - CLIP_LENGTH:index + 1])
+
+    def test_previous_clips_not_overwritten(self):
+        clips = [clip for clip in map(self.clip_buffer.add_frame, self.frames) if clip is not None]
+        assert len(clips) == 3
+        for index, clip in enumerate(clips):
+            assert np.array_equal(clip[0], self.frames[index * CLIP_LENGTH:(index + 1) * CLIP_LENGTH])
+
+
+class TestController(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.net = StridedInflatedMobileNetV2().eval()
+
+    def _run_offline(self, results_display=None, **controller_options):
+        predictions = []
+
+        def record_prediction(prediction_postprocessed):
+            if prediction_postprocessed['prediction'] is not None:
+                predictions.append(prediction_postprocessed['prediction'])
+            return True
+
+        controller = Controller(copy.deepcopy(self.net), post_processors=[], results_display=results_display,
+                                callbacks=[record_prediction], path_in=VIDEO_PATH, use_gpu=False, offline=True,
+                                **controller_options)
+        controller.run_inference()
+        return predictions
+
+    @staticmethod
+    def _count_frames(path):
+        video = cv2.VideoCapture(path)
+        num_frames = 0
+        while video.read()[0]:
+            num_frames += 1
+        video.release()
+        return num_frames
+
+    def test_offline_headless(self):
+        predictions = self._run_offline()
+        assert len(predictions) == NUM_VIDEO_FRAMES // self.net.step_size
+
+        # Predictions are the same for every run
+        for prediction, repeated_prediction in zip(predictions, self._run_offline()):
+            assert np.allclose(prediction, repeated_prediction)
+
+    def test_offline_display(self):
+        rendered_images = []
+        results_display = DisplayResults(display_ops=[], display_fn=rendered_images.append)
+        predictions = self._run_offline(results_display)
+        assert len(predictions) == NUM_VIDEO_FRAMES // self.net.step_size
+        assert len(rendered_images) == NUM_VIDEO_FRAMES
+
+    def test_render_in_thread(self):
+        rendered_images = []
+        results_display = DisplayResults(display_ops=[], display_fn=rendered_images.append)
+        predictions = self._run_offline(results_display, render_in_thread=True)
+        assert len(predictions) == NUM_VIDEO_FRAMES // self.net.step_size
+        assert 0 < len(rendered_images) <= NUM_VIDEO_FRAMES
+
+    def test_render_thread_error(self):
+        def fail_to_display(img):
+            raise ValueError('Display failed')
+
+        results_display = DisplayResults(display_ops=[], display_fn=fail_to_display)
+        self.assertRaises(ValueError, self._run_offline, results_display, render_in_thread=True)
+
+    def test_recording_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The videos cannot be opened in a missing directory
+            path_out = os.path.join(tmp_dir, 'missing', 'output.mp4')
+            for render_in_thread in [False, True]:
+                results_display = DisplayResults(display_ops=[], display_fn=lambda img: None)
+                self.assertRaises(RuntimeError, self._run_offline, results_display, path_out=path_out,
+                                  render_in_thread=render_in_thread)
+
+    def test_metrics(self):
+        metrics = MetricsRegistry()
+        results_display = DisplayResults(display_ops=[], display_fn=lambda img: None)
+        self._run_offline(results_display, metrics=metrics)
+        summary = metrics.summary()
+
+        for stage in ['video_source.grab', 'video_source.resize', 'controller.frame_wait', 'display.show',
+                      'controller.clip_assembly', 'controller.postprocess']:
+            assert summary[stage]['count'] >= NUM_VIDEO_FRAMES
+        for stage in ['engine.queue_wait', 'engine.preprocess', 'engine.to_device', 'engine.forward',
+                      'engine.to_host']:
+            assert summary[stage]['count'] == NUM_VIDEO_FRAMES // self.net.step_size
+
+    def test_record_raw_only(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_out = os.path.join(tmp_dir, 'output.mp4')
+            predictions = self._run_offline(path_out=path_out, record_raw_only=True)
+            path_raw, path_predictions = get_recording_paths(path_out)
+            assert not os.path.exists(path_out)
+
+            # The predictions of the last clip are logged without recording the last frame again
+            with open(path_predictions) as predictions_log:
+                assert len(predictions_log.readlines()) == NUM_VIDEO_FRAMES + 1
+            assert self._count_frames(path_raw) == NUM_VIDEO_FRAMES
+
+            rendered_predictions = []
+            results_display = DisplayResults(display_ops=[], display_fn=lambda img: None)
+            render_recording(path_out, post_processors=[lambda prediction: rendered_predictions.append(prediction)
+                                                        or {}], results_display=results_display)
+
+            num_rendered_frames = self._count_frames(path_out)
+
+        assert num_rendered_frames == NUM_VIDEO_FRAMES
+        rendered_predictions = [prediction for prediction in rendered_predictions if prediction is not None]
+        assert len(rendered_predictions) == len(predictions)
+        for prediction, rendered_prediction in zip(predictions, rendered_predictions):
+            assert np.array_equal(prediction, rendered_prediction)
+
+    def test_offline_inference_error(self):
+        controller = Controller(FailingNetwork().eval(), post_processors=[], results_display=None,
+                                path_in=VIDEO_PATH, use_gpu=False, offline=True)
+        self.assertRaises(ValueError, controller.run_inference)
+
+    def test_inference_error_with_block_policy(self):
+        controller = Controller(FailingNetwork().eval(), post_processors=[], results_display=None,
+                                path_in=VIDEO_PATH, use_gpu=False, queue_policy='block')
+        self.assertRaises(ValueError, controller.run_inference)
+
+    def test_inference_process_error(self):
+        num_frames = 0
+
+        def wait_for_failure(_):
+            # Wait for the inference process to fail on the first clip, before the end of the short video
+            nonlocal num_frames
+            num_frames += 1
+            if num_frames == controller.inference_engine.step_size:
+                deadline = time.perf_counter() + 60
+                while controller.inference_engine.is_alive() and time.perf_counter() < deadline:
+                    time.sleep(0.1)
+            return True
+
+        controller = Controller(FailingInChildProcessNetwork().eval(), post_processors=[], results_display=None,
+                                callbacks=[wait_for_failure], path_in=VIDEO_PATH, use_gpu=False,
+                                use_inference_process=True)
+        self.assertRaises(ValueError, controller.run_inference)
+
+    def test_stats_with_inference_process(self):
+        controller = Controller(self.net, post_processors=[], results_display=None, path_in=VIDEO_PATH,
+                                use_gpu=False, use_inference_process=True)
+        stats = controller.stats()
+        assert stats['num_dropped_clips'] == stats['num_dropped_predictions'] == 0
+
+    def test_offline_requires_video_file(self):
+        self.assertRaises(ValueError, Controller, self.net, post_processors=[], results_display=None,
+                          use_gpu=False, offline=True)
+
+    def test_unknown_queue_policy(self):
+        self.assertRaises(ValueError, Controller, self.net, post_processors=[], results_display=None,
+                          path_in=VIDEO_PATH, use_gpu=False, queue_policy='drop')
+
+    def test_recording_paths(self):
+        assert get_recording_paths('out.mp4') == ('out_raw.mp4', 'out_predictions.jsonl')
+        assert get_recording_paths('out.avi') == ('out_raw.avi', 'out_predictions.jsonl')
+        assert get_recording_paths('out') == ('out_raw', 'out_predictions.jsonl')
+
+    def test_headless_recording(self):
+        self.assertRaises(ValueError, Controller, self.net, post_processors=[], results_display=None,
+                          path_in=VIDEO_PATH, path_out='output.mp4', use_gpu=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
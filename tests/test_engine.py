@@ -0,0 +1,278 @@
+import copy
+import time
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import numpy as np
+import torch
+
+from sense.backbone_networks import StridedInflatedMobileNetV2
+from sense.downstream_tasks.nn_utils import LogisticRegression
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.engine import bfloat16_autocast_available
+from sense.engine import InferenceEngine
+from sense.engine import InferenceProcess
+from sense.engine import MultiStreamInferenceEngine
+from networks import FailingInChildProcessNetwork
+from networks import FailingNetwork
+
+
+class TestInferenceEngineModes(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.weights = StridedInflatedMobileNetV2().state_dict()
+        self.clip = np.random.randint(0, 256, (1, 8, 64, 64, 3)).astype(np.float32)
+
+    def _infer(self, **engine_options):
+        net = StridedInflatedMobileNetV2()
+        net.load_state_dict(self.weights)
+        inference_engine = InferenceEngine(net.eval(), **engine_options)
+        return inference_engine.infer(self.clip.copy())
+
+    def test_channels_last(self):
+        expected = self._infer()
+        predictions = self._infer(use_channels_last=True)
+        assert np.allclose(predictions, expected, atol=1e-4)
+
+    def test_channels_last_frames(self):
+        net = StridedInflatedMobileNetV2()
+        assert net.preprocess(self.clip).is_contiguous()
+        InferenceEngine(net, use_channels_last=True)
+        assert net.preprocess(self.clip).is_contiguous(memory_format=torch.channels_last)
+
+    @unittest.skipUnless(bfloat16_autocast_available(), 'bfloat16 autocast requires PyTorch 1.10 or newer')
+    def test_bfloat16(self):
+        expected = self._infer()
+        predictions = self._infer(use_bfloat16=True)
+        assert predictions.dtype == np.float32
+        assert predictions.shape == expected.shape
+        assert np.allclose(predictions, expected, rtol=5e-2, atol=5e-2)
+
+    @patch('sense.engine.bfloat16_autocast_available', return_value=False)
+    def test_bfloat16_without_autocast(self, _):
+        self.assertRaises(RuntimeError, InferenceEngine, StridedInflatedMobileNetV2(), use_bfloat16=True)
+
+    def test_bfloat16_on_gpu(self):
+        self.assertRaises(ValueError, InferenceEngine, StridedInflatedMobileNetV2(), use_gpu=True,
+                          use_bfloat16=True)
+
+    def test_lossless(self):
+        net = StridedInflatedMobileNetV2().eval()
+        clips = [np.random.randint(0, 256, (1, 4, 64, 64, 3)).astype(np.uint8) for _ in range(4)]
+        expected = InferenceEngine(copy.deepcopy(net)).infer(np.concatenate(clips, axis=1))
+
+        inference_engine = InferenceEngine(net, lossless=True)
+        inference_engine.start()
+        predictions = []
+        try:
+            inference_engine.put(clips[0], timeout=10)
+            for clip in clips[1:]:
+                # Predictions are not dropped even when new clips are added before they are retrieved
+                inference_engine.put(clip, timeout=10)
+                predictions.append(inference_engine.get(timeout=10))
+            predictions.append(inference_engine.get(timeout=10))
+        finally:
+            inference_engine.stop()
+
+        assert len(predictions) == len(clips)
+        assert np.allclose(predictions, expected, atol=1e-5)
+
+    def test_stats(self):
+        inference_engine = InferenceEngine(StridedInflatedMobileNetV2().eval(), queue_size=2,
+                                           input_policy='drop_newest')
+        clips = [np.zeros((1, 4, 64, 64, 3), dtype=np.uint8) for _ in range(3)]
+        for clip in clips:
+            inference_engine.put_nowait(clip)
+
+        stats = inference_engine.stats()
+        assert stats['num_dropped_clips'] == 1
+        assert stats['input_queue_depth'] == stats['max_input_queue_depth'] == 2
+        assert stats['num_dropped_predictions'] == 0
+        assert inference_engine.get_nowait() is None
+
+    def test_block_on_failed_inference(self):
+        inference_engine = InferenceEngine(FailingNetwork().eval(), input_policy='block')
+        inference_engine.start()
+        clip = np.zeros((1, 4, 64, 64, 3), dtype=np.uint8)
+        inference_engine.put_nowait(clip)
+        inference_engine.join(timeout=10)
+
+        # The first clip failed, the next one fills the queue and the error is raised instead of waiting forever
+        inference_engine.put_nowait(clip)
+        self.assertRaises(ValueError, inference_engine.put_nowait, clip)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, InferenceEngine, StridedInflatedMobileNetV2(), backend='tensorrt')
+
+    def test_onnxruntime_backend_on_gpu(self):
+        self.assertRaises(ValueError, InferenceEngine, StridedInflatedMobileNetV2(), use_gpu=True,
+                          backend='onnxruntime')
+
+
+class TestMultiStreamInferenceEngine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        backbone_network = StridedInflatedMobileNetV2()
+        heads = [LogisticRegression(num_in=backbone_network.feature_dim, num_out=num_out) for num_out in (3, 7)]
+        self.net = Pipe(backbone_network, heads).eval()
+
+    def _random_clip(self):
+        return np.random.randint(0, 256, (1, self.net.step_size, *self.net.expected_frame_size, 3)).astype(np.float32)
+
+    def _single_stream_predictions(self, clips):
+        inference_engine = InferenceEngine(copy.deepcopy(self.net))
+        return [inference_engine.infer(clip.copy()) for clip in clips]
+
+    def test_same_predictions_as_single_stream(self):
+        num_streams = 3
+        num_steps = 3
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=4, max_batch_size=2)
+        stream_ids = [inference_engine.add_stream() for _ in range(num_streams)]
+        clips = {stream_id: [self._random_clip() for _ in range(num_steps)] for stream_id in stream_ids}
+
+        predictions = {stream_id: [] for stream_id in stream_ids}
+        for step in range(num_steps):
+            # Streams are not always ready at the same time
+            ready_stream_ids = stream_ids if step != 1 else stream_ids[:1]
+            step_predictions = inference_engine.infer({stream_id: clips[stream_id][len(predictions[stream_id])].copy()
+                                                       for stream_id in ready_stream_ids})
+            for stream_id, stream_predictions in step_predictions.items():
+                predictions[stream_id].append(stream_predictions)
+
+        for stream_id in stream_ids:
+            expected = self._single_stream_predictions(clips[stream_id][:len(predictions[stream_id])])
+            for stream_predictions, expected_predictions in zip(predictions[stream_id], expected):
+                for output, expected_output in zip(stream_predictions, expected_predictions):
+                    assert np.allclose(output, expected_output, atol=1e-5)
+
+    def test_new_stream_starts_from_zero_states(self):
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=1)
+        clip = self._random_clip()
+        stream_id = inference_engine.add_stream()
+        expected = inference_engine.infer({stream_id: clip.copy()})[stream_id]
+        inference_engine.infer({stream_id: self._random_clip()})
+
+        inference_engine.remove_stream(stream_id)
+        stream_id = inference_engine.add_stream()
+        predictions = inference_engine.infer({stream_id: clip.copy()})[stream_id]
+        for output, expected_output in zip(predictions, expected):
+            assert np.allclose(output, expected_output)
+
+    def test_stream_replaced_during_inference(self):
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=1)
+        clip = self._random_clip()
+        stream_id = inference_engine.add_stream()
+        expected = inference_engine.infer({stream_id: clip.copy()})[stream_id]
+
+        forward_streams = inference_engine.stateless_network.forward_streams
+
+        def replace_stream(*args):
+            inference_engine.remove_stream(stream_id)
+            inference_engine.add_stream()
+            return forward_streams(*args)
+
+        # The predictions and states of the removed stream are discarded
+        inference_engine.stateless_network.forward_streams = replace_stream
+        assert inference_engine.infer({stream_id: self._random_clip()}) == {}
+
+        inference_engine.stateless_network.forward_streams = forward_streams
+        predictions = inference_engine.infer({stream_id: clip.copy()})[stream_id]
+        for output, expected_output in zip(predictions, expected):
+            assert np.allclose(output, expected_output)
+
+    def test_failed_inference(self):
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=1)
+        inference_engine.stateless_network.forward_streams = Mock(side_effect=ValueError('Inference failed'))
+        stream_id = inference_engine.add_stream()
+        inference_engine.start()
+        inference_engine.put_nowait(stream_id, self._random_clip())
+        inference_engine.join(timeout=10)
+
+        self.assertRaises(ValueError, inference_engine.get_nowait, stream_id)
+        self.assertRaises(ValueError, inference_engine.put_nowait, stream_id, self._random_clip())
+
+    def test_max_num_streams(self):
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=1)
+        inference_engine.add_stream()
+        self.assertRaises(RuntimeError, inference_engine.add_stream)
+
+    def test_stats(self):
+        inference_engine = MultiStreamInferenceEngine(self.net, max_num_streams=2)
+        stream_ids = [inference_engine.add_stream() for _ in range(2)]
+        for _ in range(3):
+            inference_engine.put_nowait(stream_ids[0], self._random_clip())
+        inference_engine.put_nowait(stream_ids[1], self._random_clip())
+
+        assert inference_engine.stats(stream_ids[0]) == {'num_dropped_clips': 2, 'num_dropped_predictions': 0}
+        assert inference_engine.stats(stream_ids[1]) == {'num_dropped_clips': 0, 'num_dropped_predictions': 0}
+        # Drops of removed streams are still counted in total
+        inference_engine.remove_stream(stream_ids[0])
+        assert inference_engine.stats() == {'num_dropped_clips': 2, 'num_dropped_predictions': 0}
+
+
+class TestInferenceProcess(unittest.TestCase):
+
+    def test_same_predictions_as_inference_engine(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        net = StridedInflatedMobileNetV2().eval()
+        # Float frames which do not fit into uint8
+        clip = np.random.uniform(0, 255, (1, net.step_size, *net.expected_frame_size, 3)).astype(np.float32)
+        expected = InferenceEngine(copy.deepcopy(net)).infer(clip.copy())[0]
+
+        inference_process = InferenceProcess(net, clip_dtype=np.float32)
+        assert inference_process.get_nowait() is None
+
+        inference_process.start()
+        try:
+            inference_process.put_nowait(clip)
+            predictions = None
+            time_start = time.perf_counter()
+            while predictions is None and time.perf_counter() - time_start < 60:
+                time.sleep(0.01)
+                predictions = inference_process.get_nowait()
+        finally:
+            inference_process.stop()
+
+        assert predictions is not None
+        assert np.allclose(predictions, expected, atol=1e-5)
+        assert inference_process.get_nowait() is None
+
+    def test_unexpected_clip_dtype(self):
+        net = StridedInflatedMobileNetV2().eval()
+        inference_process = InferenceProcess(net)
+        clip = np.zeros((1, net.step_size, *net.expected_frame_size, 3), dtype=np.float32)
+        self.assertRaises(TypeError, inference_process.put_nowait, clip)
+
+    def test_error(self):
+        net = FailingInChildProcessNetwork().eval()
+        inference_process = InferenceProcess(net)
+        inference_process.start()
+        try:
+            assert inference_process.is_alive()
+            assert inference_process.error is None
+            inference_process.put_nowait(np.zeros((1, net.step_size, *net.expected_frame_size, 3), dtype=np.uint8))
+            inference_process._process.join(timeout=60)
+            assert not inference_process.is_alive()
+            assert isinstance(inference_process.error, ValueError)
+            assert inference_process.get_nowait() is None
+        finally:
+            inference_process.stop()
+
+    def test_stats(self):
+        net = StridedInflatedMobileNetV2().eval()
+        inference_process = InferenceProcess(net)
+        clip = np.zeros((1, net.step_size, *net.expected_frame_size, 3), dtype=np.uint8)
+        # Not started, so that clips are replaced before being processed
+        for _ in range(3):
+            inference_process.put_nowait(clip)
+        assert inference_process.stats() == {'num_dropped_clips': 2, 'num_dropped_predictions': 0}
+
+
+if __name__ == '__main__':
+    unittest.main()
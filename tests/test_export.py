@@ -0,0 +1,144 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from sense.backbone_networks import optimize_for_inference
+from sense.backbone_networks import StridedInflatedEfficientNet
+from sense.backbone_networks import StridedInflatedMobileNetV2
+from sense.downstream_tasks.nn_utils import LogisticRegression
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.engine import InferenceEngine
+from sense.engine import InferenceProcess
+from sense.export import export_onnx
+from sense.export import export_torchscript
+from sense.export import onnxruntime
+from sense.loading import load_onnx_network
+from sense.loading import load_torchscript_network
+
+NUM_STEPS = 3
+
+
+class TestExportTorchScript(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'network.pt')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _assert_same_streaming_outputs(self, net, multiple_outputs=False):
+        net.eval()
+        export_torchscript(net, self.path)
+        scripted_net = load_torchscript_network(self.path)
+
+        frames = torch.rand(NUM_STEPS * net.step_size, 3, 64, 64)
+        with torch.no_grad():
+            for step in frames.split(net.step_size):
+                expected = net(step)
+                outputs = scripted_net(step)
+                if not multiple_outputs:
+                    expected, outputs = [expected], [outputs]
+                assert len(outputs) == len(expected)
+                for output, expected_output in zip(outputs, expected):
+                    assert torch.allclose(output, expected_output, atol=1e-5)
+
+    def test_backbone_network(self):
+        self._assert_same_streaming_outputs(StridedInflatedMobileNetV2())
+
+    def test_pipe(self):
+        backbone_network = StridedInflatedEfficientNet()
+        head = LogisticRegression(num_in=backbone_network.feature_dim, num_out=5)
+        self._assert_same_streaming_outputs(Pipe(backbone_network, head))
+
+    def test_pipe_multiple_heads(self):
+        backbone_network = StridedInflatedMobileNetV2()
+        heads = [LogisticRegression(num_in=backbone_network.feature_dim, num_out=num_out) for num_out in (3, 7)]
+        self._assert_same_streaming_outputs(Pipe(backbone_network, heads), multiple_outputs=True)
+
+    def test_reset(self):
+        export_torchscript(StridedInflatedMobileNetV2(), self.path)
+        scripted_net = load_torchscript_network(self.path)
+
+        frames = torch.rand(4, 3, 64, 64)
+        with torch.no_grad():
+            expected = scripted_net(frames)
+            scripted_net(frames)
+            scripted_net.reset()
+            assert torch.allclose(scripted_net(frames), expected)
+
+    def test_inference_engine(self):
+        net = StridedInflatedMobileNetV2().eval()
+        export_torchscript(net, self.path)
+        scripted_net = load_torchscript_network(self.path)
+
+        assert scripted_net.fps == net.fps
+        assert scripted_net.step_size == net.step_size
+        assert scripted_net.expected_frame_size == net.expected_frame_size
+
+        clip = np.random.randint(0, 256, (1, 8, 64, 64, 3)).astype(np.float32)
+        expected = InferenceEngine(net).infer(clip.copy())
+        predictions = InferenceEngine(scripted_net).infer(clip.copy())
+        assert np.allclose(predictions, expected, atol=1e-5)
+
+    def test_optimized_network(self):
+        net = optimize_for_inference(StridedInflatedMobileNetV2())
+        self.assertRaises(ValueError, export_torchscript, net, self.path)
+
+
+@unittest.skipIf(onnxruntime is None, 'onnxruntime is not installed')
+class TestExportOnnx(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'network.onnx')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_pipe_multiple_heads(self):
+        backbone_network = StridedInflatedMobileNetV2()
+        heads = [LogisticRegression(num_in=backbone_network.feature_dim, num_out=num_out) for num_out in (3, 7)]
+        net = Pipe(backbone_network, heads).eval()
+        export_onnx(net, self.path)
+        onnx_net = load_onnx_network(self.path)
+
+        assert onnx_net.fps == net.fps
+        assert onnx_net.step_size == net.step_size
+        assert onnx_net.expected_frame_size == net.expected_frame_size
+
+        frames = torch.rand(NUM_STEPS * net.step_size, 3, *net.expected_frame_size)
+        with torch.no_grad():
+            for step in frames.split(net.step_size):
+                outputs = onnx_net(step)
+                expected = net(step)
+                assert len(outputs) == len(expected)
+                for output, expected_output in zip(outputs, expected):
+                    assert torch.allclose(output, expected_output, atol=1e-5)
+
+    def test_inference_engine(self):
+        net = StridedInflatedMobileNetV2().eval()
+        clip = np.random.randint(0, 256, (1, 2 * net.step_size, *net.expected_frame_size, 3)).astype(np.float32)
+        expected = InferenceEngine(net).infer(clip.copy())
+        predictions = InferenceEngine(net, backend='onnxruntime').infer(clip.copy())
+        assert np.allclose(predictions, expected, atol=1e-5)
+
+    def test_inference_process(self):
+        export_onnx(StridedInflatedMobileNetV2(), self.path)
+        self.assertRaises(TypeError, InferenceProcess, load_onnx_network(self.path))
+
+    def test_incomplete_step(self):
+        export_onnx(StridedInflatedMobileNetV2(), self.path)
+        onnx_net = load_onnx_network(self.path)
+        self.assertRaises(ValueError, onnx_net, torch.rand(onnx_net.step_size + 1, 3, *onnx_net.expected_frame_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import glob
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from sense.backbone_networks import StridedInflatedEfficientNet
+from sense.backbone_networks import StridedInflatedMobileNetV2
+from sense.downstream_tasks.nn_utils import LogisticRegression
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.finetuning import build_feature_store
+from sense.finetuning import compute_file_hash
+from sense.finetuning import extract_features
+from sense.finetuning import FeaturesDataset
+from sense.finetuning import get_padding_multiple
+from sense.finetuning import pad_collate
+from sense.finetuning import prefetch_frames
+from sense.finetuning import run_epoch
+from sense.finetuning import set_internal_padding_false
+from sense.loading import ModelConfig
+from tools import directories
+
+VIDEO_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'test_video.mp4')
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.features_dir = self.tmp_dir.name
+        self.features = {}
+        for label, num_videos in [('a', 2), ('b', 1)]:
+            os.makedirs(os.path.join(self.features_dir, label))
+            for index in range(num_videos):
+                path = os.path.join(self.features_dir, label, f'{index}.npy')
+                self.features[path] = np.random.rand(10 + index, 8).astype(np.float32)
+                np.save(path, self.features[path])
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_same_features_as_files(self):
+        feature_store = build_feature_store(self.features_dir)
+        for path, features in self.features.items():
+            assert path in feature_store
+            assert np.array_equal(feature_store.get(path), features)
+
+    def test_rebuilt_when_features_change(self):
+        build_feature_store(self.features_dir)
+        path = next(iter(self.features))
+        features = np.random.rand(12, 8).astype(np.float32)
+        np.save(path, features)
+        os.utime(path, ns=(0, 0))
+
+        assert np.array_equal(build_feature_store(self.features_dir).get(path), features)
+
+    def test_empty_directory(self):
+        with tempfile.TemporaryDirectory() as features_dir:
+            assert build_feature_store(features_dir) is None
+
+    def test_dataset_windows(self):
+        files = list(self.features)
+        feature_store = build_feature_store(self.features_dir)
+        dataset = FeaturesDataset(files, [0, 0, 1], [None] * len(files), full_network_minimum_frames=1,
+                                  num_timesteps=4, feature_store=feature_store)
+        for index, path in enumerate(files):
+            features, _, _ = dataset[index]
+            assert not isinstance(features, np.memmap)
+            assert features.shape == (4, 8)
+            # The window is one of the windows of the video features
+            assert any(np.array_equal(features, self.features[path][position:position + 4])
+                       for position in range(len(self.features[path]) - 3))
+
+
+class TestBatchedValidation(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        np.random.seed(0)
+
+    @staticmethod
+    def _finetuned_net(backbone_network, first_layer):
+        finetuned_layers = backbone_network.cnn[first_layer:]
+        finetuned_layers.apply(set_internal_padding_false)
+        return Pipe(finetuned_layers, LogisticRegression(num_in=backbone_network.feature_dim, num_out=3,
+                                                         use_softmax=False)).eval()
+
+    @staticmethod
+    def _samples(video_lengths, feature_shape, dtype=np.float32):
+        samples = []
+        for num_frames in video_lengths:
+            features = np.random.rand(num_frames, *feature_shape).astype(dtype)
+            # Fewer or more annotations than outputs
+            num_annotations = num_frames - 6 if num_frames > 10 else num_frames
+            temporal_annotation = np.random.randint(0, 3, num_annotations)
+            samples.append([features, np.random.randint(3), temporal_annotation])
+        return samples
+
+    def _assert_same_results_as_each_video(self, net, samples, temporal_annotation_training, atol=1e-6):
+        args = (net, nn.CrossEntropyLoss(), ['background', 'tag1', 'tag2'])
+        expected = run_epoch(torch.utils.data.DataLoader(samples, batch_size=1), *args,
+                             temporal_annotation_training=temporal_annotation_training)
+        results = run_epoch(torch.utils.data.DataLoader(samples, batch_size=4, collate_fn=pad_collate), *args,
+                            temporal_annotation_training=temporal_annotation_training)
+
+        assert np.isclose(results[0], expected[0], rtol=0., atol=atol)
+        assert results[1] == expected[1]
+        assert np.array_equal(results[2], expected[2])
+
+    def test_classification(self):
+        net = self._finetuned_net(StridedInflatedMobileNetV2(), -4)
+        samples = self._samples([5, 12, 8, 20, 9], (160, 2, 2))
+        self._assert_same_results_as_each_video(net, samples, temporal_annotation_training=False)
+
+    def test_temporal_annotations(self):
+        net = self._finetuned_net(StridedInflatedMobileNetV2(), -4)
+        samples = self._samples([5, 12, 8, 20, 9], (160, 2, 2))
+        self._assert_same_results_as_each_video(net, samples, temporal_annotation_training=True)
+
+    def test_temporal_stride_from_first_frame(self):
+        # The windows of the temporally strided layer cnn[14] start from the first frame, so that only the
+        # second batch, padded by multiples of the stride, can be processed in a single forward pass. The
+        # shift of the windows in the first batch changes the results by little, hence the double precision
+        net = self._finetuned_net(StridedInflatedEfficientNet(), 13).double()
+        assert get_padding_multiple(net) == 2
+        samples = self._samples([30, 33, 36, 41, 37, 45, 41], (112, 2, 2), dtype=np.float64)
+        for temporal_annotation_training in [False, True]:
+            self._assert_same_results_as_each_video(net, samples, temporal_annotation_training, atol=1e-12)
+
+
+class TestExtractFeatures(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.net = StridedInflatedMobileNetV2().eval()
+        self.model_config = ModelConfig('StridedInflatedMobileNetV2', 'pro', [])
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _extract_features(self, dataset_name, **kwargs):
+        path_in = os.path.join(self.tmp_dir.name, dataset_name)
+        for split, num_videos in [('train', 2), ('valid', 1)]:
+            videos_dir = directories.get_videos_dir(path_in, split, 'a')
+            os.makedirs(videos_dir)
+            for index in range(num_videos):
+                shutil.copy(VIDEO_PATH, os.path.join(videos_dir, f'{index}.mp4'))
+
+        extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None,
+                         **kwargs)
+
+        features = {}
+        for split in ['train', 'valid']:
+            features_dir = directories.get_features_dir(path_in, split, self.model_config, 0)
+            for path in glob.glob(os.path.join(features_dir, 'a', '*.npy')):
+                features[split, os.path.basename(path)] = np.load(path)
+        return features
+
+    def test_same_features_with_workers(self):
+        expected = self._extract_features('serial')
+        features = self._extract_features('parallel', num_workers=2, num_threads_per_worker=1)
+
+        assert len(expected) == 3
+        assert features.keys() == expected.keys()
+        for key, value in expected.items():
+            assert np.allclose(features[key], value, atol=1e-5)
+
+    def test_cache(self):
+        features = self._extract_features('dataset')
+        path_in = os.path.join(self.tmp_dir.name, 'dataset')
+        features_dir = directories.get_features_dir(path_in, 'train', self.model_config, 0, 'a')
+        modification_times = {name: os.stat(os.path.join(features_dir, name)).st_mtime_ns
+                              for name in ['0.npy', '1.npy']}
+
+        # Re-record a video under the same name
+        with open(os.path.join(directories.get_videos_dir(path_in, 'train', 'a'), '1.mp4'), 'ab') as f:
+            f.write(b'0')
+        extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None)
+        assert os.stat(os.path.join(features_dir, '0.npy')).st_mtime_ns == modification_times['0.npy']
+        assert os.stat(os.path.join(features_dir, '1.npy')).st_mtime_ns != modification_times['1.npy']
+
+        # Change the weights of the backbone
+        with torch.no_grad():
+            next(self.net.parameters()).add_(1.)
+        extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None)
+        assert not np.allclose(np.load(os.path.join(features_dir, '0.npy')), features['train', '0.npy'])
+
+    def test_cache_without_rehashing(self):
+        self._extract_features('dataset')
+        path_in = os.path.join(self.tmp_dir.name, 'dataset')
+        features_dir = directories.get_features_dir(path_in, 'train', self.model_config, 0, 'a')
+        path_features = os.path.join(features_dir, '0.npy')
+        modification_time = os.stat(path_features).st_mtime_ns
+
+        # Unchanged videos are not hashed again
+        with patch('sense.finetuning.compute_file_hash') as mock_compute_file_hash:
+            extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None)
+        mock_compute_file_hash.assert_not_called()
+        assert os.stat(path_features).st_mtime_ns == modification_time
+
+        # A video with the same content but a new modification time is hashed again, but its features are kept
+        path_video = os.path.join(directories.get_videos_dir(path_in, 'train', 'a'), '0.mp4')
+        os.utime(path_video, ns=(modification_time, modification_time + 10 ** 9))
+        with patch('sense.finetuning.compute_file_hash', wraps=compute_file_hash) as mock_compute_file_hash:
+            extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None)
+            extract_features(path_in, ['a'], self.model_config, self.net, 0, use_gpu=False, log_fn=lambda _: None)
+        mock_compute_file_hash.assert_called_once_with(path_video)
+        assert os.stat(path_features).st_mtime_ns == modification_time
+
+    def test_prefetch_bounded(self):
+        # Upsample the video to more frames than the size of the prefetching queue
+        inference_engine = types.SimpleNamespace(expected_frame_size=(32, 32), fps=100)
+        video_source = prefetch_frames(VIDEO_PATH, inference_engine)
+
+        # Only a few frames are decoded while none is consumed, e.g. during feature computation
+        video_source.join(timeout=1)
+        assert video_source.is_alive()
+        assert video_source.frames.full()
+
+        num_frames = 0
+        while video_source.get_image() is not None:
+            num_frames += 1
+        video_source.join(timeout=10)
+        assert not video_source.is_alive()
+        assert num_frames > video_source.frames.maxsize
+
+    def test_workers_on_gpu(self):
+        self.assertRaises(ValueError, extract_features, self.tmp_dir.name, ['a'], self.model_config, self.net, 0,
+                          use_gpu=True, num_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
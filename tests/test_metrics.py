@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sense.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.metrics = MetricsRegistry(window_size=100)
+
+    def test_percentiles(self):
+        for duration in range(1, 201):
+            self.metrics.record('stage', duration / 1000)
+        summary = self.metrics.summary()['stage']
+
+        # Percentiles are computed over the last 100 durations only
+        assert summary['count'] == 200
+        assert summary['mean_ms'] == 100.5
+        assert summary['p50_ms'] == 150.5
+        assert summary['max_ms'] == 200.
+
+    def test_timer(self):
+        with self.metrics.timer('stage'):
+            pass
+        with self.metrics.timer('other_stage'):
+            pass
+        summary = self.metrics.summary()
+        assert list(summary) == ['other_stage', 'stage']
+        assert summary['stage']['count'] == 1
+
+    def test_disabled(self):
+        metrics = MetricsRegistry(enabled=False)
+        metrics.record('stage', 1.)
+        with metrics.timer('other_stage'):
+            pass
+        assert metrics.summary() == {}
+
+    def test_to_json(self):
+        self.metrics.record('stage', 0.5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metrics.json')
+            summary = self.metrics.to_json(path)
+            with open(path) as f:
+                assert f.read() == summary
+        assert json.loads(summary)['stage']['p99_ms'] == 500.
+
+    def test_log_periodically(self):
+        logs = []
+        metrics = MetricsRegistry(log_interval=0., log_fn=logs.append)
+        metrics.record('stage', 0.5)
+        metrics.log_periodically()
+        assert len(logs) == 1
+        assert logs[0].splitlines()[1].startswith('stage')
+
+        # Nothing is logged before the interval has passed
+        metrics.log_interval = 3600.
+        metrics.log_periodically()
+        assert len(logs) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import queue
+import unittest
+
+from sense.queues import BoundedQueue
+
+
+class TestBoundedQueue(unittest.TestCase):
+
+    def _fill(self, policy):
+        bounded_queue = BoundedQueue(2, policy)
+        added = [bounded_queue.put_with_policy(item) for item in range(3)]
+        return bounded_queue, added
+
+    def test_drop_oldest(self):
+        bounded_queue, added = self._fill('drop_oldest')
+        assert added == [True, True, False]
+        assert [bounded_queue.get_nowait() for _ in range(2)] == [1, 2]
+        assert bounded_queue.stats() == {'num_dropped': 1, 'depth': 0, 'max_depth': 2}
+
+    def test_drop_newest(self):
+        bounded_queue, added = self._fill('drop_newest')
+        assert added == [True, True, False]
+        assert [bounded_queue.get_nowait() for _ in range(2)] == [0, 1]
+        assert bounded_queue.num_dropped == 1
+
+    def test_block(self):
+        bounded_queue = BoundedQueue(2, 'block')
+        for item in range(2):
+            assert bounded_queue.put_with_policy(item)
+        self.assertRaises(queue.Full, bounded_queue.put_with_policy, 2, timeout=0.01)
+        assert bounded_queue.stats() == {'num_dropped': 0, 'depth': 2, 'max_depth': 2}
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, BoundedQueue, 2, 'drop')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the streaming inference of the backbone networks on CPU. Networks are built
+with random weights, since latencies do not depend on the actual weight values.
+
+Commands:
+  state_buffer     Compare preallocated internal state buffers with concatenating the internal
+                   state to each new input in the steppable convolutions.
+  rearrange_frames Compare the latency of each steppable convolution layer with its strided frame
+                   rearrangement and with the previous implementation based on concatenation
+                   (or on a gather for temporal shifts).
+  optimize         Compare the latency per clip of a backbone before and after converting it with
+                   `optimize_for_inference`.
+  engine           Compare the latency per step of `InferenceEngine.infer` in its default mode with
+                   its channels-last mode, in which both the weights and the preprocessed frames are
+                   channels-last, with its bfloat16 mode (PyTorch 1.10 or newer) and with the
+                   onnxruntime backend.
+  torchscript      Compare the latency per step and the loading time of a backbone with its stateless
+                   TorchScript export.
+  multi_stream     Compare the latency of one inference step for several streams with one InferenceEngine
+                   per stream and with a single batched MultiStreamInferenceEngine.
+  preprocess       Compare the latency of preprocessing, alone and followed by an inference step, for
+                   the previous float64 clips and for uint8 clips, with and without the scaling of the
+                   frames folded into the first convolution. Steps are of 4 frames at 16 fps, as for
+                   all backbone networks.
+
+Usage:
+  benchmark_backbone.py state_buffer [--model_name=NAME]
+                                     [--num_steps=NUM]
+                                     [--num_threads=NUM]
+  benchmark_backbone.py rearrange_frames [--model_name=NAME]
+                                         [--num_steps=NUM]
+                                         [--num_threads=NUM]
+  benchmark_backbone.py optimize [--model_name=NAME]
+                                 [--num_steps=NUM]
+                                 [--num_threads=NUM]
+  benchmark_backbone.py engine [--model_name=NAME]
+                               [--num_steps=NUM]
+                               [--num_threads=NUM]
+  benchmark_backbone.py torchscript [--model_name=NAME]
+                                    [--num_steps=NUM]
+                                    [--num_threads=NUM]
+  benchmark_backbone.py multi_stream [--model_name=NAME]
+                                     [--num_steps=NUM]
+                                     [--num_threads=NUM]
+                                     [--num_streams=NUM]
+  benchmark_backbone.py preprocess [--model_name=NAME]
+                                   [--num_steps=NUM]
+                                   [--num_threads=NUM]
+  benchmark_backbone.py (-h | --help)
+
+Options:
+  --model_name=NAME    Name of the backbone to benchmark. Both StridedInflatedEfficientNet and
+                       StridedInflatedMobileNetV2 are benchmarked if not provided.
+  --num_steps=NUM      Number of timed inference steps [default: 50]
+  --num_threads=NUM    Number of threads used by PyTorch. Left unchanged if not provided.
+  --num_streams=NUM    Number of video streams served at the same time [default: 4]
+"""
+import os
+import tempfile
+import time
+
+from docopt import docopt
+import numpy as np
+import torch
+import torch.nn as nn
+
+from sense import backbone_networks
+from sense.backbone_networks import optimize_for_inference
+from sense.backbone_networks.mobilenet import SteppableConv3dAs2d
+from sense.backbone_networks.mobilenet import SteppableSparseConv3dAs2d
+from sense.engine import bfloat16_autocast_available
+from sense.engine import bfloat16_supported
+from sense.engine import InferenceEngine
+from sense.engine import MultiStreamInferenceEngine
+from sense.export import export_torchscript
+from sense.export import onnxruntime
+from sense.loading import load_torchscript_network
+
+MODEL_NAMES = ['StridedInflatedEfficientNet', 'StridedInflatedMobileNetV2']
+NUM_WARMUP_STEPS = 5
+
+
+def build_random_backbone(model_name):
+    """
+    Create a backbone network in eval mode with randomly initialized weights.
+    """
+    return getattr(backbone_networks, model_name)().eval()
+
+
+def random_step_input(net):
+    """
+    Create an input tensor for one inference step of the given network.
+    """
+    return torch.rand(net.step_size, 3, *net.expected_frame_size)
+
+
+def time_steps(step_fn, num_steps):
+    """
+    Call the given function for a few warm-up steps and then time each of the following steps.
+
+    :return:
+        Latencies of the timed steps in milliseconds.
+    """
+    for _ in range(NUM_WARMUP_STEPS):
+        step_fn()
+
+    latencies = []
+    for _ in range(num_steps):
+        time_start = time.perf_counter()
+        step_fn()
+        latencies.append(1000 * (time.perf_counter() - time_start))
+    return np.array(latencies)
+
+
+def concat_rearrange_frames(layer, x):
+    """
+    Previous implementation of `SteppableConv3dAs2d.rearrange_frames`, kept as a reference.
+    """
+    num_frames = x.shape[0]
+    x = torch.cat([x[offset: num_frames - layer.kernel_size_temporal + offset + 1]
+                   for offset in range(layer.kernel_size_temporal)], dim=1)
+    x = x[torch.arange(0, x.shape[0], layer.stride_temporal)]
+    return x
+
+
+def gather_shift_frames(layer, x):
+    """
+    Previous implementation of `SteppableSparseConv3dAs2d.rearrange_frames`, kept as a reference.
+    """
+    quarter = int(x.shape[1] // 4)
+    half = int(x.shape[1] // 2)
+    out = torch.zeros_like(x[2:])
+    out[:, 0:quarter] = x[0:-2, 0:quarter]
+    out[:, quarter:half] = x[1:-1, quarter:half]
+    out[:, half:] = x[2:, half:]
+    indices = [-1 - offset for offset in range(0, out.shape[0], layer.stride_temporal)]
+    out = out[indices[::-1]]
+    return out
+
+
+# Maps each steppable layer type to the reference implementation of its frame rearrangement
+REFERENCE_REARRANGE_FRAMES = {
+    SteppableConv3dAs2d: concat_rearrange_frames,
+    SteppableSparseConv3dAs2d: gather_shift_frames,
+}
+
+
+def reference_preprocess(clip):
+    """
+    Previous implementation of `StridedInflatedMobileNetV2.preprocess`, kept as a reference.
+    """
+    clip /= 255.
+    clip = clip.transpose(0, 1, 4, 2, 3)
+    clip = torch.Tensor(clip).float()
+    return clip[0]
+
+
+def capture_padded_inputs(net, clip):
+    """
+    Run one inference step and return the steppable convolution layers of the network together
+    with the shape of their padded input.
+    """
+    padded_input_shapes = {}
+
+    def capture(layer, inputs):
+        padded_input_shapes[layer] = (layer.temporal_footprint + inputs[0].shape[0], *inputs[0].shape[1:])
+
+    hooks = [module.register_forward_pre_hook(capture) for module in net.modules()
+             if type(module) in REFERENCE_REARRANGE_FRAMES]
+    with torch.no_grad():
+        net(clip)
+    for hook in hooks:
+        hook.remove()
+
+    return padded_input_shapes
+
+
+def print_latencies(title, latencies_per_mode):
+    """
+    Print mean and percentiles of the step latencies for each benchmarked mode.
+    """
+    print(f'\n{title}')
+    print(f'  {"mode":<24}{"mean":>10}{"p50":>10}{"p90":>10}  (ms/step)')
+    for mode, latencies in latencies_per_mode.items():
+        print(f'  {mode:<24}{latencies.mean():>10.2f}{np.percentile(latencies, 50):>10.2f}'
+              f'{np.percentile(latencies, 90):>10.2f}')
+
+
+def benchmark_state_buffer(model_name, num_steps):
+    net = build_random_backbone(model_name)
+    clip = random_step_input(net)
+
+    latencies_per_mode = {}
+    for mode, reuse_state_buffer in [('concatenation', False), ('preallocated buffer', True)]:
+        for module in net.modules():
+            if isinstance(module, SteppableConv3dAs2d):
+                module.reuse_state_buffer = reuse_state_buffer
+                module.reset()
+
+        with torch.no_grad():
+            latencies_per_mode[mode] = time_steps(lambda: net(clip), num_steps)
+
+    print_latencies(f'{model_name} - internal state', latencies_per_mode)
+
+
+def benchmark_rearrange_frames(model_name, num_steps):
+    net = build_random_backbone(model_name)
+    padded_input_shapes = capture_padded_inputs(net, random_step_input(net))
+
+    print(f'\n{model_name} - rearrange frames + convolution per layer')
+    print(f'  {"layer":<10}{"input shape":<24}{"reference":>12}{"strided":>14}  (mean ms/step)')
+    for name, module in net.named_modules():
+        if module not in padded_input_shapes:
+            continue
+
+        x = torch.rand(padded_input_shapes[module])
+        reference_rearrange_frames = REFERENCE_REARRANGE_FRAMES[type(module)]
+        with torch.no_grad():
+            reference = time_steps(
+                lambda: nn.Conv2d.forward(module, reference_rearrange_frames(module, x)), num_steps)
+            strided = time_steps(lambda: nn.Conv2d.forward(module, module.rearrange_frames(x)), num_steps)
+
+        layer_name = name.split('.')[1]
+        print(f'  {layer_name:<10}{str(tuple(x.shape)):<24}{reference.mean():>12.3f}{strided.mean():>14.3f}')
+
+
+def benchmark_optimize(model_name, num_steps):
+    net = build_random_backbone(model_name)
+    clip = random_step_input(net)
+
+    latencies_per_mode = {}
+    with torch.no_grad():
+        latencies_per_mode['original'] = time_steps(lambda: net(clip), num_steps)
+        optimized_net = optimize_for_inference(net)
+        latencies_per_mode['optimized'] = time_steps(lambda: optimized_net(clip), num_steps)
+
+    print_latencies(f'{model_name} - inference optimization', latencies_per_mode)
+
+
+def benchmark_engine(model_name, num_steps):
+    engine_modes = {
+        'baseline': {},
+        'channels last': {'use_channels_last': True},
+    }
+    if not bfloat16_autocast_available():
+        print(f'\nbfloat16 modes require PyTorch 1.10 or newer, skipped with PyTorch {torch.__version__}')
+    else:
+        engine_modes['bfloat16'] = {'use_bfloat16': True}
+        engine_modes['channels last + bfloat16'] = {'use_channels_last': True, 'use_bfloat16': True}
+        if not bfloat16_supported():
+            print('\nbfloat16 is not natively supported by this CPU, bfloat16 modes are emulated')
+    if onnxruntime is not None:
+        engine_modes['onnxruntime'] = {'backend': 'onnxruntime'}
+
+    latencies_per_mode = {}
+    for mode, engine_options in engine_modes.items():
+        net = build_random_backbone(model_name)
+        inference_engine = InferenceEngine(net, **engine_options)
+        clip = np.random.randint(0, 256, (1, net.step_size, *net.expected_frame_size, 3)).astype(np.float32)
+        latencies_per_mode[mode] = time_steps(lambda: inference_engine.infer(clip.copy()), num_steps)
+
+    print_latencies(f'{model_name} - inference engine modes', latencies_per_mode)
+
+
+def benchmark_torchscript(model_name, num_steps):
+    net = build_random_backbone(model_name)
+    clip = random_step_input(net)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_weights = os.path.join(tmp_dir, 'backbone.ckpt')
+        path_scripted = os.path.join(tmp_dir, 'backbone.pt')
+        torch.save(net.state_dict(), path_weights)
+        export_torchscript(net, path_scripted)
+
+        time_start = time.perf_counter()
+        eager_net = build_random_backbone(model_name)
+        eager_net.load_state_dict(torch.load(path_weights))
+        eager_load_time = 1000 * (time.perf_counter() - time_start)
+
+        time_start = time.perf_counter()
+        scripted_net = load_torchscript_network(path_scripted)
+        scripted_load_time = 1000 * (time.perf_counter() - time_start)
+
+    latencies_per_mode = {}
+    with torch.no_grad():
+        latencies_per_mode['eager'] = time_steps(lambda: eager_net(clip), num_steps)
+        latencies_per_mode['torchscript'] = time_steps(lambda: scripted_net(clip), num_steps)
+
+    print_latencies(f'{model_name} - TorchScript export', latencies_per_mode)
+    print(f'  loading time: eager {eager_load_time:.0f} ms, torchscript {scripted_load_time:.0f} ms')
+
+
+def benchmark_multi_stream(model_name, num_steps, num_streams):
+    net = build_random_backbone(model_name)
+    clip = np.random.randint(0, 256, (1, net.step_size, *net.expected_frame_size, 3)).astype(np.float32)
+
+    inference_engines = [InferenceEngine(build_random_backbone(model_name)) for _ in range(num_streams)]
+    multi_stream_inference_engine = MultiStreamInferenceEngine(net, max_num_streams=num_streams)
+    stream_ids = [multi_stream_inference_engine.add_stream() for _ in range(num_streams)]
+
+    def infer_independently():
+        for inference_engine in inference_engines:
+            inference_engine.infer(clip.copy())
+
+    def infer_batched():
+        multi_stream_inference_engine.infer({stream_id: clip.copy() for stream_id in stream_ids})
+
+    latencies_per_mode = {'independent engines': time_steps(infer_independently, num_steps)}
+    for max_batch_size in [1, 2, num_streams]:
+        multi_stream_inference_engine.max_batch_size = max_batch_size
+        latencies_per_mode[f'batches of {max_batch_size} streams'] = time_steps(infer_batched, num_steps)
+    print_latencies(f'{model_name} - {num_streams} streams', latencies_per_mode)
+
+
+def benchmark_preprocess(model_name, num_steps):
+    net = optimize_for_inference(build_random_backbone(model_name))
+    folded_net = optimize_for_inference(build_random_backbone(model_name), fold_input_scaling=True)
+    clip = np.random.randint(0, 256, (1, net.step_size, *net.expected_frame_size, 3)).astype(np.uint8)
+
+    preprocess_modes = {
+        'float64 (previous)': (lambda: reference_preprocess(clip.astype(np.float64)), net),
+        'uint8': (lambda: net.preprocess(clip), net),
+        'uint8 + folded scaling': (lambda: folded_net.preprocess(clip), folded_net),
+    }
+
+    preprocess_latencies_per_mode = {}
+    step_latencies_per_mode = {}
+    with torch.no_grad():
+        for mode, (preprocess, mode_net) in preprocess_modes.items():
+            preprocess_latencies_per_mode[mode] = time_steps(preprocess, num_steps)
+            step_latencies_per_mode[mode] = time_steps(lambda: mode_net(preprocess()), num_steps)
+
+    print_latencies(f'{model_name} - preprocessing', preprocess_latencies_per_mode)
+    print_latencies(f'{model_name} - preprocessing + inference', step_latencies_per_mode)
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    args = docopt(__doc__)
+    _model_names = [args['--model_name']] if args['--model_name'] else MODEL_NAMES
+    _num_steps = int(args['--num_steps'])
+
+    if args['--num_threads']:
+        torch.set_num_threads(int(args['--num_threads']))
+
+    for _model_name in _model_names:
+        if args['state_buffer']:
+            benchmark_state_buffer(_model_name, _num_steps)
+        elif args['rearrange_frames']:
+            benchmark_rearrange_frames(_model_name, _num_steps)
+        elif args['optimize']:
+            benchmark_optimize(_model_name, _num_steps)
+        elif args['engine']:
+            benchmark_engine(_model_name, _num_steps)
+        elif args['torchscript']:
+            benchmark_torchscript(_model_name, _num_steps)
+        elif args['multi_stream']:
+            benchmark_multi_stream(_model_name, _num_steps, int(args['--num_streams']))
+        elif args['preprocess']:
+            benchmark_preprocess(_model_name, _num_steps)
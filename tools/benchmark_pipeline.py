@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the streaming pipeline on CPU: frames are decoded from a video file, resized and
+gathered into clips as in the Controller, but as fast as possible instead of at the camera frame rate.
+The throughput of the pipeline, both in frames read and in predictions made per second, is compared
+when the network runs in an InferenceEngine thread and in an InferenceProcess. The backbone network is
+built with random weights, since throughput does not depend on the actual weight values.
+
+The latency of each stage of the pipeline is printed after the throughput of each engine, to find which
+stage limits the throughput. Network stages are only recorded for the InferenceEngine, which runs in the
+same process.
+
+Usage:
+  benchmark_pipeline.py --path_in=FILENAME
+                        [--model_name=NAME]
+                        [--duration=SECONDS]
+                        [--num_threads=NUM]
+                        [--path_metrics=FILENAME]
+  benchmark_pipeline.py (-h | --help)
+
+Options:
+  --path_in=FILENAME   Video file to stream from. It is read in a loop during the benchmark.
+  --model_name=NAME    Name of the backbone to benchmark [default: StridedInflatedEfficientNet]
+  --duration=SECONDS   Duration of the benchmark of each engine [default: 20]
+  --num_threads=NUM    Number of threads used by PyTorch for inference. Left unchanged if not provided.
+  --path_metrics=FILENAME
+                       If provided, write the latency of each stage of the pipeline for each engine
+                       to this JSON file.
+"""
+import json
+import time
+
+from docopt import docopt
+import torch
+
+from sense import backbone_networks
+from sense.camera import VideoSource
+from sense.controller import ClipBuffer
+from sense.engine import InferenceEngine
+from sense.engine import InferenceProcess
+from sense.metrics import MetricsRegistry
+
+
+def run_pipeline(inference_engine, path_in, duration, metrics):
+    """
+    Stream frames through the inference engine as fast as possible for the given duration in seconds,
+    recording the latency of each stage in the given metrics registry.
+
+    :return:
+        Number of frames and number of predictions per second.
+    """
+    video_source = VideoSource(filename=path_in, size=inference_engine.expected_frame_size, metrics=metrics)
+    clip_buffer = ClipBuffer(inference_engine.step_size, inference_engine.expected_frame_size)
+    num_frames = 0
+    num_predictions = 0
+
+    inference_engine.start()
+    time_start = time.perf_counter()
+    while time.perf_counter() - time_start < duration:
+        num_frames += 1
+        img_tuple = video_source.get_image()
+        if img_tuple is None:
+            # Read the video again from the beginning
+            video_source = VideoSource(filename=path_in, size=inference_engine.expected_frame_size,
+                                       metrics=metrics)
+            img_tuple = video_source.get_image()
+
+        with metrics.timer('controller.clip_assembly'):
+            clip = clip_buffer.add_frame(img_tuple[1])
+        if clip is not None:
+            inference_engine.put_nowait(clip)
+
+        if inference_engine.get_nowait() is not None:
+            num_predictions += 1
+    duration = time.perf_counter() - time_start
+    inference_engine.stop()
+
+    return num_frames / duration, num_predictions / duration
+
+
+def benchmark_pipeline(path_in, model_name, duration, num_threads, path_metrics):
+    net = getattr(backbone_networks, model_name)().eval()
+
+    metrics = {
+        'InferenceEngine': MetricsRegistry(),
+        'InferenceProcess': MetricsRegistry(),
+    }
+    inference_engines = {
+        'InferenceEngine': InferenceEngine(net, metrics=metrics['InferenceEngine']),
+        'InferenceProcess': InferenceProcess(net, num_threads=num_threads),
+    }
+
+    print(f'\n{model_name} - end-to-end pipeline throughput')
+    print(f'  {"engine":<24}{"frames/s":>10}{"predictions/s":>16}')
+    for name, inference_engine in inference_engines.items():
+        frames_per_second, predictions_per_second = run_pipeline(inference_engine, path_in, duration,
+                                                                 metrics[name])
+        print(f'  {name:<24}{frames_per_second:>10.1f}{predictions_per_second:>16.2f}')
+
+    for name, engine_metrics in metrics.items():
+        print(f'\n{model_name} - stage latencies in ms with {name}')
+        print(engine_metrics.format_summary())
+
+    if path_metrics:
+        with open(path_metrics, 'w') as f:
+            json.dump({name: engine_metrics.summary() for name, engine_metrics in metrics.items()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    args = docopt(__doc__)
+    _num_threads = int(args['--num_threads']) if args['--num_threads'] else None
+
+    if _num_threads:
+        torch.set_num_threads(_num_threads)
+
+    benchmark_pipeline(
+        path_in=args['--path_in'],
+        model_name=args['--model_name'],
+        duration=float(args['--duration']),
+        num_threads=_num_threads,
+        path_metrics=args['--path_metrics'],
+    )
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+"""
+Export a backbone network and its classifier head as a single TorchScript file, in which the internal
+states of the steppable convolutions are explicit inputs and outputs of the network.
+
+The exported network can be run without the model definitions and checkpoint files with:
+    net = sense.loading.load_torchscript_network(path)
+    InferenceEngine(net)
+
+
+Usage:
+  export_torchscript.py --classifier=CLASSIFIER --output_name=OUTPUT_NAME
+                        [--backbone_name=BACKBONE_NAME]
+                        [--backbone_version=BACKBONE_VERSION]
+                        [--path_in=PATH]
+  export_torchscript.py (-h | --help)
+
+Options:
+  --classifier=CLASSIFIER              Name of the classifier model. Either one of the pre-trained classifiers
+                                       such as "action_recognition" or "fitness_activity_recognition",
+                                       "custom_classifier" for exporting a custom trained one, or "backbone"
+                                       for exporting the backbone network alone.
+                                       For the pre-trained classifiers, a name and version for the backbone model
+                                       need to be provided. For a custom classifier, path_in needs to be provided.
+  --output_name=OUTPUT_NAME            Base name of the output file.
+  --backbone_name=BACKBONE_NAME        Name of the backbone model, e.g. "StridedInflatedEfficientNet"
+  --backbone_version=BACKBONE_VERSION  Version of the backbone model, e.g. "pro" or "lite"
+  --path_in=PATH                       Path to the trained classifier directory if exporting a custom classifier.
+
+  -h --help
+"""
+import os
+
+from docopt import docopt
+
+from sense import RESOURCES_DIR
+from sense.downstream_tasks.nn_utils import LogisticRegression
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.export import export_torchscript
+from sense.loading import build_backbone_network
+from sense.loading import ModelConfig
+from tools.conversion.weights_loader import load_custom_classifier_weights
+
+
+def build_network(model_config, weights, classifier_name):
+    if classifier_name == 'backbone':
+        return build_backbone_network(model_config, weights['backbone'])
+
+    classifier_weights = weights[classifier_name]
+    backbone_network = build_backbone_network(model_config, weights['backbone'],
+                                              weights_finetuned=classifier_weights)
+    classifier = LogisticRegression(num_in=backbone_network.feature_dim,
+                                    num_out=classifier_weights['0.weight'].shape[0])
+    classifier.load_state_dict(classifier_weights)
+    classifier.eval()
+
+    return Pipe(backbone_network, classifier)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    classifier_name = args["--classifier"]
+    output_name = args["--output_name"]
+    backbone_name = args["--backbone_name"]
+    backbone_version = args["--backbone_version"]
+    path_in = args["--path_in"]
+
+    if classifier_name == "custom_classifier":
+        if not path_in:
+            raise ValueError("You have to provide the directory used to train the custom classifier")
+
+        backbone_model_config, weights = load_custom_classifier_weights(path_in)
+    else:
+        if not backbone_name or not backbone_version:
+            raise ValueError("You have to provide the name and version for the backbone model")
+
+        feature_converters = [] if classifier_name == 'backbone' else [classifier_name]
+        backbone_model_config = ModelConfig(backbone_name, backbone_version, feature_converters)
+        weights = backbone_model_config.load_weights()
+
+    net = build_network(backbone_model_config, weights, classifier_name)
+
+    output_dir = os.path.join(RESOURCES_DIR, "model_conversion")
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, output_name + ".pt")
+    export_torchscript(net, output_file)
+    print(f"Saved TorchScript network to {output_file}")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Post-training int8 quantization of a backbone network for CPU inference. Activation ranges are
+calibrated on videos from the training set of a Sense Studio project.
+
+One quantized backbone is saved per downstream task, since some tasks use finetuned backbone layers.
+For each task, a report compares the predictions and the latency per inference step of the quantized
+network with the full precision one. Accuracy is measured as the rate of agreement between the top-1
+predictions of both networks, since the project videos do not share the labels of the downstream tasks.
+
+A quantized backbone can then be loaded with:
+    build_backbone_network(model_config, load_weights(path), quantized=True)
+
+Usage:
+  quantize_backbone.py --path_in=PATH
+                       [--model_name=NAME]
+                       [--model_version=VERSION]
+                       [--downstream_tasks=TASKS]
+                       [--num_calibration_videos=NUM]
+                       [--num_evaluation_videos=NUM]
+                       [--path_out=PATH]
+  quantize_backbone.py (-h | --help)
+
+Options:
+  --path_in=PATH                  Path to the Sense Studio project. Calibration videos are taken from its
+                                  `videos_train` folder and evaluation videos from `videos_valid`.
+  --model_name=NAME               Name of the backbone model to quantize [default: StridedInflatedEfficientNet]
+  --model_version=VERSION         Version of the backbone model to quantize [default: pro]
+  --downstream_tasks=TASKS        Comma-separated list of downstream tasks to evaluate
+                                  [default: action_recognition,gesture_control,fitness_activity_recognition]
+  --num_calibration_videos=NUM    Maximum number of videos used for calibration [default: 20]
+  --num_evaluation_videos=NUM     Maximum number of videos used for the report [default: 20]
+  --path_out=PATH                 Where to save the quantized backbones and the report.
+                                  Will default to `path_in` if not provided.
+"""
+import copy
+import glob
+import importlib
+import json
+import os
+import time
+
+from docopt import docopt
+import numpy as np
+import torch
+
+from sense.backbone_networks import quantize_backbone
+from sense.backbone_networks.quantization import reset_internal_states
+from sense.downstream_tasks.nn_utils import LogisticRegression
+from sense.downstream_tasks.nn_utils import Pipe
+from sense.engine import InferenceEngine
+from sense.finetuning import extract_frames
+from sense.loading import build_backbone_network
+from sense.loading import ModelConfig
+from tools import directories
+
+
+def find_videos(path_in, split, max_num_videos):
+    video_files = sorted(glob.glob(os.path.join(directories.get_videos_dir(path_in, split), '*', '*.mp4')))
+    return video_files[:max_num_videos]
+
+
+def load_clips(video_files, backbone_network):
+    """
+    Read the frames of each video at the frame rate of the network and yield the preprocessed clips one
+    by one, so that only the clip of the video being processed is kept in memory.
+    """
+    inference_engine = InferenceEngine(backbone_network)
+    for video_path in video_files:
+        frames = extract_frames(video_path=video_path, inference_engine=inference_engine)
+        yield backbone_network.preprocess(frames[None].astype(np.float32))
+
+
+def build_networks(model_config, weights, downstream_task, calibration_clips):
+    """
+    Build the full precision and quantized networks, both made of the backbone and the classifier
+    head of the given downstream task.
+    """
+    head_weights = copy.deepcopy(weights[downstream_task])
+    backbone_network = build_backbone_network(model_config, copy.deepcopy(weights['backbone']),
+                                              weights_finetuned=head_weights)
+    quantized_backbone_network = quantize_backbone(copy.deepcopy(backbone_network), calibration_clips)
+
+    int2lab = importlib.import_module(f'sense.downstream_tasks.{downstream_task}').INT2LAB
+    classifier = LogisticRegression(num_in=backbone_network.feature_dim, num_out=len(int2lab))
+    classifier.load_state_dict(head_weights)
+    classifier.eval()
+
+    return Pipe(backbone_network, classifier), Pipe(quantized_backbone_network, classifier)
+
+
+def stream_predictions(net, clip):
+    """
+    Run the network on the clip one inference step at a time.
+
+    :return:
+        Predictions for each step and latency of each step in milliseconds.
+    """
+    reset_internal_states(net)
+    predictions = []
+    latencies = []
+    with torch.no_grad():
+        for step in torch.Tensor.split(clip, net.step_size):
+            time_start = time.perf_counter()
+            predictions.append(net(step))
+            latencies.append(1000 * (time.perf_counter() - time_start))
+    return torch.cat(predictions).numpy(), latencies
+
+
+def evaluate(net, quantized_net, evaluation_clips):
+    agreements = []
+    probability_errors = []
+    latencies = []
+    quantized_latencies = []
+    for clip in evaluation_clips:
+        predictions, clip_latencies = stream_predictions(net, clip)
+        quantized_predictions, clip_quantized_latencies = stream_predictions(quantized_net, clip)
+
+        agreements.extend(predictions.argmax(axis=1) == quantized_predictions.argmax(axis=1))
+        probability_errors.extend(np.abs(predictions - quantized_predictions).max(axis=1))
+        latencies.extend(clip_latencies)
+        quantized_latencies.extend(clip_quantized_latencies)
+
+    return {
+        'top1_agreement': float(np.mean(agreements)),
+        'mean_max_probability_error': float(np.mean(probability_errors)),
+        'float_latency_ms': float(np.mean(latencies)),
+        'int8_latency_ms': float(np.mean(quantized_latencies)),
+    }
+
+
+def quantize(path_in, path_out, model_name, model_version, downstream_tasks, num_calibration_videos,
+             num_evaluation_videos, log_fn=print):
+    os.makedirs(path_out, exist_ok=True)
+
+    model_config = ModelConfig(model_name, model_version, downstream_tasks)
+    weights = model_config.load_weights(log_fn)
+    if weights is None:
+        raise FileNotFoundError(f'Weights missing for {model_config.combined_model_name}')
+
+    # Clips are read again for each downstream task, instead of keeping all videos in memory
+    reader_network = build_backbone_network(model_config, copy.deepcopy(weights['backbone']))
+    calibration_videos = find_videos(path_in, 'train', num_calibration_videos)
+    evaluation_videos = find_videos(path_in, 'valid', num_evaluation_videos) or calibration_videos
+    if not calibration_videos:
+        videos_dir = directories.get_videos_dir(path_in, 'train')
+        raise FileNotFoundError(f'No videos found in {videos_dir}')
+    log_fn(f'Calibrating on {len(calibration_videos)} videos, evaluating on {len(evaluation_videos)} videos')
+
+    report = {}
+    for downstream_task in downstream_tasks:
+        calibration_clips = load_clips(calibration_videos, reader_network)
+        net, quantized_net = build_networks(model_config, weights, downstream_task, calibration_clips)
+
+        path_quantized = os.path.join(path_out, f'{model_config.combined_model_name}_{downstream_task}_int8.ckpt')
+        torch.save(quantized_net.feature_extractor.state_dict(), path_quantized)
+
+        report[downstream_task] = evaluate(net, quantized_net, load_clips(evaluation_videos, reader_network))
+        report[downstream_task]['path'] = path_quantized
+
+    log_fn(f'\n{model_config.combined_model_name} - int8 quantization')
+    log_fn(f'  {"downstream task":<32}{"top1 agreement":>16}{"max proba error":>17}'
+           f'{"float ms/step":>15}{"int8 ms/step":>14}')
+    for downstream_task, results in report.items():
+        log_fn(f'  {downstream_task:<32}{results["top1_agreement"]:>16.3f}'
+               f'{results["mean_max_probability_error"]:>17.4f}'
+               f'{results["float_latency_ms"]:>15.1f}{results["int8_latency_ms"]:>14.1f}')
+
+    with open(os.path.join(path_out, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    args = docopt(__doc__)
+    _path_in = args['--path_in']
+    _path_out = args['--path_out'] or _path_in
+
+    quantize(
+        path_in=_path_in,
+        path_out=_path_out,
+        model_name=args['--model_name'],
+        model_version=args['--model_version'],
+        downstream_tasks=args['--downstream_tasks'].split(','),
+        num_calibration_videos=int(args['--num_calibration_videos']),
+        num_evaluation_videos=int(args['--num_evaluation_videos']),
+    )
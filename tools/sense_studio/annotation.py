@@ -25,6 +25,10 @@ from tools.sense_studio import utils
 
 annotation_bp = Blueprint('annotation_bp', __name__)
 
+# Features used for annotation are computed with the full backbone network, i.e. in the same directory and with
+# the same cache key as when training a classifier without finetuning any layer
+NUM_LAYERS_TO_FINETUNE = 0
+
 
 @annotation_bp.route('/<string:project>/<string:split>/<string:label>')
 def show_video_list(project, split, label):
@@ -42,7 +46,7 @@ def show_video_list(project, split, label):
 
     videos_dir = directories.get_videos_dir(path, split, label)
     frames_dir = directories.get_frames_dir(path, split, label)
-    features_dir = directories.get_features_dir(path, split, model_config, label=label)
+    features_dir = directories.get_features_dir(path, split, model_config, NUM_LAYERS_TO_FINETUNE, label=label)
     tags_dir = directories.get_tags_dir(path, split, label)
 
     os.makedirs(tags_dir, exist_ok=True)
@@ -52,7 +56,9 @@ def show_video_list(project, split, label):
                                 project_path=path,
                                 videos_dir=videos_dir,
                                 frames_dir=frames_dir,
-                                features_dir=features_dir)
+                                features_dir=features_dir,
+                                num_layers_to_finetune=NUM_LAYERS_TO_FINETUNE,
+                                model_config=model_config)
 
     videos = os.listdir(frames_dir)
     videos = natsorted(videos, alg=ns.IC)
@@ -90,7 +96,7 @@ def annotate(project, split, label, idx):
     _, model_config = utils.load_feature_extractor(path)
 
     frames_dir = directories.get_frames_dir(path, split, label)
-    features_dir = directories.get_features_dir(path, split, model_config, label=label)
+    features_dir = directories.get_features_dir(path, split, model_config, NUM_LAYERS_TO_FINETUNE, label=label)
     tags_dir = directories.get_tags_dir(path, split, label)
     logreg_dir = directories.get_logreg_dir(path, model_config)
 
@@ -206,7 +212,7 @@ def train_logreg(path):
         for label, class_tags in classes.items():
             videos_dir = directories.get_videos_dir(path, split, label)
             frames_dir = directories.get_frames_dir(path, split, label)
-            features_dir = directories.get_features_dir(path, split, model_config, label=label)
+            features_dir = directories.get_features_dir(path, split, model_config, NUM_LAYERS_TO_FINETUNE, label=label)
             tags_dir = directories.get_tags_dir(path, split, label)
 
             if not os.path.exists(tags_dir):
@@ -217,7 +223,9 @@ def train_logreg(path):
                                         project_path=path,
                                         videos_dir=videos_dir,
                                         frames_dir=frames_dir,
-                                        features_dir=features_dir)
+                                        features_dir=features_dir,
+                                        num_layers_to_finetune=NUM_LAYERS_TO_FINETUNE,
+                                        model_config=model_config)
 
             video_tag_files = os.listdir(tags_dir)
 
@@ -13,6 +13,9 @@ Usage:
                        [--temporal_training]
                        [--resume]
                        [--overwrite]
+                       [--valid_batch_size=NUM]
+                       [--num_workers=NUM]
+                       [--use_feature_store]
   train_classifier.py  (-h | --help)
 
 Options:
@@ -27,6 +30,12 @@ Options:
                                  annotations tool
   --resume                       Initialize weights from the last saved checkpoint and restart training
   --overwrite                    Allow overwriting existing checkpoint files in the output folder (path_out)
+  --valid_batch_size=NUM         Number of validation videos processed in a single forward pass. Larger batches
+                                 mostly pay off on GPU or with many CPU cores [default: 1].
+  --num_workers=NUM              Number of processes extracting features in parallel, each with its own copy
+                                 of the backbone network. Only supported on CPU [default: 1].
+  --use_feature_store            Consolidate the features of each split into a single memory-mapped file, which
+                                 speeds up data loading at the cost of a second copy of the features on disk
 """
 import datetime
 import json
@@ -62,7 +71,7 @@ SUPPORTED_MODEL_CONFIGURATIONS = [
 
 def train_model(path_in, path_out, model_name, model_version, num_layers_to_finetune, epochs,
                 use_gpu=True, overwrite=True, temporal_training=None, resume=False, log_fn=print,
-                confmat_event=None):
+                confmat_event=None, valid_batch_size=1, num_workers=1, use_feature_store=False):
     os.makedirs(path_out, exist_ok=True)
 
     # Check for existing files
@@ -144,7 +153,7 @@ def train_model(path_in, path_out, model_name, model_version, num_layers_to_fine
 
     # Extract features for all videos
     extract_features(path_in, label_names, selected_config, backbone_network, num_layers_to_finetune, use_gpu,
-                     num_timesteps=num_timesteps, log_fn=log_fn)
+                     num_timesteps=num_timesteps, log_fn=log_fn, num_workers=num_workers)
 
     extractor_stride = backbone_network.num_required_frames_per_layer_padding[0]
 
@@ -161,6 +170,7 @@ def train_model(path_in, path_out, model_name, model_version, num_layers_to_fine
         num_timesteps=num_timesteps,
         stride=extractor_stride,
         temporal_annotation_only=temporal_training,
+        use_feature_store=use_feature_store,
     )
 
     features_dir = directories.get_features_dir(path_in, 'valid', selected_config, num_layers_to_finetune)
@@ -173,10 +183,11 @@ def train_model(path_in, path_out, model_name, model_version, num_layers_to_fine
         label2int,
         label2int_temporal_annotation,
         num_timesteps=None,
-        batch_size=1,
+        batch_size=valid_batch_size,
         shuffle=False,
         stride=extractor_stride,
         temporal_annotation_only=temporal_training,
+        use_feature_store=use_feature_store,
     )
 
     # Check if the data is loaded fully
@@ -262,6 +273,9 @@ if __name__ == "__main__":
     _temporal_training = args['--temporal_training']
     _resume = args['--resume']
     _overwrite = args['--overwrite']
+    _valid_batch_size = int(args['--valid_batch_size'])
+    _num_workers = int(args['--num_workers'])
+    _use_feature_store = args['--use_feature_store']
 
     train_model(
         path_in=_path_in,
@@ -274,4 +288,7 @@ if __name__ == "__main__":
         overwrite=_overwrite,
         temporal_training=_temporal_training,
         resume=_resume,
+        valid_batch_size=_valid_batch_size,
+        num_workers=_num_workers,
+        use_feature_store=_use_feature_store,
     )